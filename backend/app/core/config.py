@@ -1,4 +1,5 @@
 from pydantic_settings import BaseSettings
+from typing import List
 
 class Settings(BaseSettings):
     PROJECT_NAME: str = "CONVO"
@@ -8,6 +9,132 @@ class Settings(BaseSettings):
     ALGORITHM: str = "HS256"
     ACCESS_TOKEN_EXPIRE_MINUTES: int = 30
 
+    # Database engine and connection pool
+    DB_ECHO: bool = False  # log every SQL statement; development only
+    DB_POOL_SIZE: int = 10
+    DB_MAX_OVERFLOW: int = 20  # extra connections allowed above DB_POOL_SIZE
+    DB_POOL_TIMEOUT: float = 30.0  # seconds to wait for a free connection
+    DB_POOL_RECYCLE: int = 1800  # seconds before a connection is replaced
+    DB_POOL_PRE_PING: bool = True  # test connections on checkout
+    # Run create_all and the search DDL when a worker starts. Off by default:
+    # the schema belongs to `alembic upgrade head`, run once per deploy.
+    DB_CREATE_SCHEMA: bool = False
+
+    # WebSocket delivery
+    WS_SEND_QUEUE_SIZE: int = 256  # per connection
+    WS_SEND_TIMEOUT: float = 10.0  # seconds a single send may take
+    WS_SLOW_CONSUMER_POLICY: str = "disconnect"  # "disconnect" or "drop" when a queue is full
+    WS_FANOUT_CHUNK: int = 256  # connections per step of a chat fan-out before yielding to the loop
+    WS_FANOUT_STATS_SIZE: int = 1000  # chats whose fan-out cost is tracked
+    # "-deflate" wire formats compress frames at least this large, once per fan-out
+    WS_COMPRESS_MIN_BYTES: int = 512
+    WS_COMPRESS_LEVEL: int = 6  # zlib level, 1 (fastest) to 9
+    # Largest frame a client may send once decompressed; uvicorn's --ws-max-size default
+    WS_MAX_MESSAGE_BYTES: int = 16 * 1024 * 1024
+    WS_BATCH_MAX_FRAMES: int = 100  # events per batch frame, in either direction
+    # Connections opened with ?acks=1: unacknowledged batch frames in flight,
+    # seconds without an ack before they are resent, and resends before dropping
+    WS_ACK_WINDOW: int = 16
+    WS_ACK_TIMEOUT: float = 10.0
+    WS_ACK_RETRIES: int = 2
+    # "memory://" only reaches sockets in the same process; use a redis:// URL
+    # to route events between uvicorn workers and nodes
+    BACKPLANE_URL: str = "memory://"
+
+    # Chat membership cache used by the WebSocket hot path
+    MEMBERSHIP_CACHE_SIZE: int = 10000  # chats
+    MEMBERSHIP_CACHE_TTL: float = 60.0  # seconds; bounds staleness across workers
+
+    # Password hashing pool: "process", "thread" (only helps if the hash
+    # backend releases the GIL) or "inline" (on the event loop, as before)
+    PASSWORD_HASH_EXECUTOR: str = "process"
+    PASSWORD_HASH_WORKERS: int = 2
+    PASSWORD_HASH_CONCURRENCY: int = 8  # hashes queued or running at once
+
+    # Rate limits: token buckets that refill at *_RATE per second up to *_BURST.
+    # "memory://" keeps buckets per process; a redis:// URL shares them
+    # between workers and nodes at one round trip per check.
+    RATE_LIMIT_ENABLED: bool = True
+    RATE_LIMIT_URL: str = "memory://"
+    RATE_LIMIT_MAX_KEYS: int = 100000  # buckets kept by the memory backend
+    RATE_LIMIT_LOGIN_RATE: float = 0.2  # per client address
+    RATE_LIMIT_LOGIN_BURST: float = 10
+    RATE_LIMIT_SEARCH_RATE: float = 5.0  # per user
+    RATE_LIMIT_SEARCH_BURST: float = 20
+    RATE_LIMIT_UPLOAD_BYTES_RATE: float = 10 * 1024 * 1024  # bytes/sec per user
+    RATE_LIMIT_UPLOAD_BYTES_BURST: float = 100 * 1024 * 1024
+    RATE_LIMIT_WS_FRAME_RATE: float = 100.0  # any frame, per connection
+    RATE_LIMIT_WS_FRAME_BURST: float = 300
+    RATE_LIMIT_WS_TEXT_RATE: float = 10.0  # text/media messages, per user
+    RATE_LIMIT_WS_TEXT_BURST: float = 50
+    RATE_LIMIT_WS_TYPING_RATE: float = 20.0  # per user
+    RATE_LIMIT_WS_TYPING_BURST: float = 60
+    RATE_LIMIT_WS_SIGNAL_RATE: float = 50.0  # call signaling, per user
+    RATE_LIMIT_WS_SIGNAL_BURST: float = 200
+    # Refused frames in a row before the socket is closed with 1013 (try again later)
+    RATE_LIMIT_WS_MAX_REFUSED: int = 100
+
+    UPLOAD_DIR: str = "backend/uploads"
+    MAX_UPLOAD_BYTES: int = 100 * 1024 * 1024
+    UPLOAD_CHUNK_SIZE: int = 1024 * 1024  # bytes per disk write / hash update
+    UPLOAD_SESSION_TTL: float = 24 * 3600  # seconds an idle resumable upload is kept
+
+    # Thumbnails / waveforms: "process" (local pool), "celery" or "off"
+    MEDIA_JOB_BACKEND: str = "process"
+    MEDIA_JOB_WORKERS: int = 2
+    CELERY_BROKER_URL: str = "redis://localhost:6379/1"
+    THUMBNAIL_SIZES: List[int] = [160, 320, 640]  # longest edge, px
+    WAVEFORM_BUCKETS: int = 64  # peaks per voice note
+
+    # Authenticated user snapshots, keyed by the token's user id
+    PRINCIPAL_CACHE_SIZE: int = 10000
+    PRINCIPAL_CACHE_TTL: float = 30.0  # seconds; 0 disables the cache
+
+    # Write-behind batching of WebSocket messages (off = one transaction per message)
+    MESSAGE_BATCHING: bool = False
+    MESSAGE_BATCH_SIZE: int = 100
+    MESSAGE_BATCH_WINDOW_MS: float = 5.0
+    # "flush": the socket waits for the batch to commit before the next frame.
+    # "enqueue": the socket moves on and the broadcast follows the commit.
+    MESSAGE_ACK_MODE: str = "flush"
+
+    # Read/delivered acks from one socket are coalesced for this long
+    RECEIPT_FLUSH_INTERVAL_MS: float = 250.0
+
+    # Presence: a user goes offline only after this long without any device,
+    # and status changes are sent to their contacts as one diff per interval
+    PRESENCE_OFFLINE_GRACE: float = 5.0  # seconds
+    PRESENCE_BROADCAST_INTERVAL_MS: float = 1000.0
+    PRESENCE_CONTACTS_CACHE_SIZE: int = 10000  # users
+    PRESENCE_CONTACTS_CACHE_TTL: float = 60.0  # seconds
+    # With a redis:// backplane, devices held by a node that has not checked
+    # in for this long (it crashed) no longer keep their users online
+    PRESENCE_NODE_TTL: float = 30.0  # seconds
+
+    # Per-user friend sets behind the contact list, mutual friends and suggestions
+    FRIENDS_CACHE_SIZE: int = 10000  # users
+    FRIENDS_CACHE_TTL: float = 60.0  # seconds
+
+    # Messages for users with no open socket: kept in memory up to these
+    # limits or this age, then stored in pending_deliveries; replayed on reconnect
+    OFFLINE_QUEUE_MAX_EVENTS: int = 100  # per user
+    OFFLINE_QUEUE_MAX_BYTES: int = 16 * 1024 * 1024  # all users, per process
+    OFFLINE_QUEUE_SPILL_AFTER: float = 30.0  # seconds
+    OFFLINE_REPLAY_CHUNK: int = 200  # messages per acknowledged replay step
+    # Stored messages replayed per user (the newest); older ones, and any
+    # stored longer than the retention, are left to the history API
+    OFFLINE_REPLAY_MAX_EVENTS: int = 1000
+    OFFLINE_RETENTION: float = 7 * 24 * 3600.0  # seconds
+    OFFLINE_PURGE_INTERVAL: float = 3600.0  # seconds between retention sweeps
+
+    # /metrics (Prometheus text format), per process
+    METRICS_ENABLED: bool = True
+    EVENT_LOOP_PROBE_INTERVAL: float = 0.5  # seconds between loop-lag samples
+
+    # Message search ranks only the caller's most recent N matches, which
+    # keeps very common terms from scoring the whole corpus
+    SEARCH_RANK_WINDOW: int = 2000
+
     class Config:
         env_file = ".env"
 
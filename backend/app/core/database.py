@@ -1,8 +1,56 @@
+import time
+from sqlalchemy import exc, func
+from sqlalchemy.engine import make_url
 from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.orm import sessionmaker, declarative_base
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
 from app.core.config import settings
+from app.core import metrics
 
-engine = create_async_engine(settings.DATABASE_URL, echo=True)
+class PoolMetrics:
+    """How long checkouts waited for a pooled connection, and how many timed out."""
+
+    def __init__(self):
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+
+    def observe(self, seconds: float):
+        self.checkouts += 1
+        self.wait_seconds_total += seconds
+        if seconds > self.wait_seconds_max:
+            self.wait_seconds_max = seconds
+
+pool_metrics = PoolMetrics()
+
+class TimedQueuePool(AsyncAdaptedQueuePool):
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            pool_metrics.timeouts += 1
+            raise
+        finally:
+            pool_metrics.observe(time.perf_counter() - start)
+
+def _engine_options(url: str) -> dict:
+    options = {"echo": settings.DB_ECHO, "pool_pre_ping": settings.DB_POOL_PRE_PING}
+    parsed = make_url(url)
+    if parsed.get_backend_name() == "sqlite" and parsed.database in (None, "", ":memory:"):
+        # In-memory SQLite lives in one connection (StaticPool); nothing to size
+        return options
+    return {
+        **options,
+        "poolclass": TimedQueuePool,
+        "pool_size": settings.DB_POOL_SIZE,
+        "max_overflow": settings.DB_MAX_OVERFLOW,
+        "pool_timeout": settings.DB_POOL_TIMEOUT,
+        "pool_recycle": settings.DB_POOL_RECYCLE,
+    }
+
+engine = create_async_engine(settings.DATABASE_URL, **_engine_options(settings.DATABASE_URL))
 
 SessionLocal = sessionmaker(
     autocommit=False,
@@ -16,3 +64,31 @@ Base = declarative_base()
 async def get_db():
     async with SessionLocal() as session:
         yield session
+
+def insert_for(db: AsyncSession):
+    """(insert, greatest, least) for the session's dialect, for upserts that
+    only move a column forward."""
+    if db.bind.dialect.name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+        return insert, func.greatest, func.least
+    from sqlalchemy.dialects.sqlite import insert
+    # SQLite's two-argument max()/min() are scalar functions, not the aggregates
+    return insert, func.max, func.min
+
+def _pool_gauge(name: str, documentation: str, attribute: str):
+    pool = engine.sync_engine.pool
+    if isinstance(pool, QueuePool):
+        metrics.registry.register(metrics.Gauge(name, documentation, function=getattr(pool, attribute)))
+
+_pool_gauge("convo_db_pool_checked_out", "Pooled connections currently in use.", "checkedout")
+_pool_gauge("convo_db_pool_idle", "Pooled connections open and idle.", "checkedin")
+metrics.registry.register(metrics.Counter("convo_db_pool_checkouts_total", "Connection checkouts.", function=lambda: pool_metrics.checkouts))
+metrics.registry.register(metrics.Counter("convo_db_pool_timeouts_total", "Checkouts that gave up after DB_POOL_TIMEOUT.", function=lambda: pool_metrics.timeouts))
+metrics.registry.register(metrics.Counter("convo_db_pool_wait_seconds_total", "Time spent waiting for a pooled connection.", function=lambda: pool_metrics.wait_seconds_total))
+
+def pool_status() -> dict:
+    pool = engine.sync_engine.pool
+    status = {"pool": type(pool).__name__, **vars(pool_metrics)}
+    if isinstance(pool, QueuePool):
+        status.update(size=pool.size(), checked_out=pool.checkedout(), overflow=max(pool.overflow(), 0), idle=pool.checkedin())
+    return status
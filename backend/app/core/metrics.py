@@ -0,0 +1,300 @@
+"""In-process metrics in the Prometheus text format, served at /metrics.
+
+Values are plain ints and floats, updated only from the event loop thread,
+so recording takes no lock. ``labels()`` returns a child that callers can
+keep (pre-bound) and repeated calls with the same values return the same
+child. Every process has its own registry; with several uvicorn workers
+each one is scraped, and aggregated, separately.
+"""
+import asyncio
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+# Buckets in seconds, from in-memory fan-out up to slow queries
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def _format_labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _number(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class _CounterChild:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+class _GaugeChild(_CounterChild):
+    __slots__ = ()
+
+    def set(self, value: float):
+        self.value = value
+
+    def dec(self, amount: float = 1):
+        self.value -= amount
+
+class _HistogramChild:
+    __slots__ = ("buckets", "counts", "sum")
+
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        # One slot per bucket plus +Inf; made cumulative only when rendered
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+class _Metric:
+    type = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.children: Dict[Tuple[str, ...], object] = {}
+        if not self.labelnames:
+            self.children[()] = self._new_child()
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def labels(self, *values: str):
+        child = self.children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f"{self.name} takes labels {self.labelnames}")
+            child = self.children[values] = self._new_child()
+        return child
+
+    def _samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def render(self) -> List[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}", *self._samples()]
+
+class Counter(_Metric):
+    """A counter incremented by callers, or read from ``function`` at scrape
+    time when the count already lives elsewhere."""
+
+    type = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = (), function: Optional[Callable[[], float]] = None):
+        super().__init__(name, documentation, labelnames)
+        self.function = function
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount: float = 1):
+        self.children[()].inc(amount)
+
+    def _samples(self) -> List[str]:
+        if self.function is not None:
+            return [f"{self.name} {_number(self.function())}"]
+        return [f"{self.name}{_format_labels(self.labelnames, values)} {_number(child.value)}" for values, child in self.children.items()]
+
+class Gauge(Counter):
+    type = "gauge"
+
+    def _new_child(self):
+        return _GaugeChild()
+
+    def set(self, value: float):
+        self.children[()].set(value)
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = (), buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames)
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value: float):
+        self.children[()].observe(value)
+
+    def _samples(self) -> List[str]:
+        lines = []
+        for values, child in self.children.items():
+            cumulative = 0
+            for bound, count in zip((*self.buckets, float("inf")), child.counts):
+                cumulative += count
+                le = 'le="' + _number(bound) + '"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, values, le)} {cumulative}")
+            labels = _format_labels(self.labelnames, values)
+            lines.append(f"{self.name}_sum{labels} {_number(child.sum)}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+class Registry:
+    def __init__(self):
+        self.metrics: List[_Metric] = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+registry = Registry()
+
+# --- WebSocket ---
+
+WS_FRAME_TYPES = ("text", "media", "read", "delivered", "typing", "call-offer", "call-answer", "ice-candidate", "call-reject", "presence", "message", "batch", "ack", "rate_limited")
+
+ws_frames_in = registry.register(Counter("convo_ws_frames_in_total", "WebSocket frames received, by type.", ["type"]))
+ws_frames_out = registry.register(Counter("convo_ws_frames_out_total", "WebSocket frames queued for sending, by type.", ["type"]))
+ws_fanout_seconds = registry.register(Histogram("convo_ws_fanout_seconds", "Time spent in one send_personal_message call (local delivery and backplane publish)."))
+ws_dropped_connections = registry.register(Counter("convo_ws_dropped_connections_total", "Connections closed as slow or broken consumers."))
+ws_retransmits = registry.register(Counter("convo_ws_retransmitted_batches_total", "Batch frames sent again because they were not acknowledged in time."))
+ws_chat_fanout_seconds = registry.register(Histogram("convo_ws_chat_fanout_seconds", "Time spent delivering one event to a chat, by member count.", ["size"]))
+
+CHAT_SIZE_CLASSES = ("1-10", "11-100", "101-1000", "1001+")
+
+def chat_size_class(members: int) -> str:
+    if members <= 10:
+        return "1-10"
+    if members <= 100:
+        return "11-100"
+    if members <= 1000:
+        return "101-1000"
+    return "1001+"
+
+# Pre-bound children; unknown types share "other" so clients cannot grow the label set.
+# The type comes straight from client JSON, so it may not even be hashable.
+_frames_in = {frame_type: ws_frames_in.labels(frame_type) for frame_type in WS_FRAME_TYPES}
+_frames_out = {frame_type: ws_frames_out.labels(frame_type) for frame_type in WS_FRAME_TYPES}
+_frames_in_other = ws_frames_in.labels("other")
+_frames_out_other = ws_frames_out.labels("other")
+
+def frame_in(frame_type) -> None:
+    (_frames_in.get(frame_type, _frames_in_other) if isinstance(frame_type, str) else _frames_in_other).value += 1
+
+def frame_out(frame_type) -> None:
+    (_frames_out.get(frame_type, _frames_out_other) if isinstance(frame_type, str) else _frames_out_other).value += 1
+
+# --- HTTP and database ---
+
+http_request_seconds = registry.register(Histogram("convo_http_request_duration_seconds", "HTTP request duration, by route handler and method.", ["handler", "method"]))
+http_responses = registry.register(Counter("convo_http_responses_total", "HTTP responses, by route handler, method and status code.", ["handler", "method", "status"]))
+db_query_seconds = registry.register(Histogram("convo_db_query_duration_seconds", "Duration of single SQL statements, by the route handler that issued them.", ["handler"]))
+
+# The ASGI scope of the request or WebSocket being handled. The router adds
+# the matched endpoint to this same dict, so the label is known at query time.
+current_scope: ContextVar[Optional[dict]] = ContextVar("current_scope", default=None)
+_handler_names: Dict[Callable, str] = {}
+
+def route_label(scope: Optional[dict]) -> str:
+    """"<routes module>.<function>" of the matched endpoint, e.g. "chat.get_inbox".
+
+    Routes are labelled by handler rather than path: paths under included
+    routers are only known relative to their prefix, and "/" alone is ambiguous.
+    """
+    if scope is None:
+        return "background"
+    endpoint = scope.get("endpoint")
+    if endpoint is None:
+        # Unmatched paths (404s) share one label
+        return "unmatched"
+    name = _handler_names.get(endpoint)
+    if name is None:
+        name = _handler_names[endpoint] = f"{endpoint.__module__.rsplit('.', 1)[-1]}.{endpoint.__name__}"
+    return name
+
+class MetricsMiddleware:
+    """Times every HTTP request and labels it with its route handler.
+
+    Plain ASGI, so it adds no per-request task or body buffering. WebSocket
+    scopes are only tagged, for the database query label.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] not in ("http", "websocket"):
+            return await self.app(scope, receive, send)
+        token = current_scope.set(scope)
+        if scope["type"] == "websocket":
+            try:
+                return await self.app(scope, receive, send)
+            finally:
+                current_scope.reset(token)
+
+        status = 500
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            route = route_label(scope)
+            http_request_seconds.labels(route, scope["method"]).observe(time.perf_counter() - start)
+            http_responses.labels(route, scope["method"], str(status)).inc()
+            current_scope.reset(token)
+
+def instrument_engine(sync_engine):
+    """Record every statement's duration under the current route."""
+    from sqlalchemy import event
+
+    @event.listens_for(sync_engine, "before_cursor_execute")
+    def _start(conn, cursor, statement, parameters, context, executemany):
+        conn.info["query_start"] = time.perf_counter()
+
+    @event.listens_for(sync_engine, "after_cursor_execute")
+    def _end(conn, cursor, statement, parameters, context, executemany):
+        start = conn.info.pop("query_start", None)
+        if start is not None:
+            db_query_seconds.labels(route_label(current_scope.get())).observe(time.perf_counter() - start)
+
+# --- Uploads ---
+
+upload_bytes = registry.register(Counter("convo_upload_bytes_total", "Bytes received by the upload endpoints; rate() gives bytes/sec."))
+
+# --- Rate limits ---
+
+RATE_LIMIT_SCOPES = ("login", "search", "upload", "ws_frame", "ws_text", "ws_typing", "ws_signal")
+
+rate_limited_total = registry.register(Counter("convo_rate_limited_total", "Requests and WebSocket frames refused by a rate limit, by scope.", ["scope"]))
+_rate_limited = {scope: rate_limited_total.labels(scope) for scope in RATE_LIMIT_SCOPES}
+
+def rate_limited(scope: str) -> None:
+    _rate_limited[scope].value += 1
+
+# --- Event loop ---
+
+event_loop_lag = registry.register(Histogram("convo_event_loop_lag_seconds", "How late the event loop woke up a periodic probe."))
+
+async def probe_event_loop(interval: float):
+    """Sleep ``interval`` in a loop; anything beyond it was time the loop was busy."""
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        event_loop_lag.observe(max(0.0, loop.time() - start - interval))
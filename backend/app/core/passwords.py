@@ -0,0 +1,90 @@
+"""Password hashing off the event loop.
+
+sha256_crypt costs a few hundred milliseconds per hash or verify and the
+os_crypt backend holds the GIL while it runs. Running it inline, or even in
+a thread, stalls every request and WebSocket in the process. The async
+helpers below hand the work to a small process pool instead. A semaphore
+caps how many hashes can be queued or running at once, so a login storm
+waits its turn rather than piling up work. Workers run at a lower priority
+so that on small machines the event loop keeps its CPU.
+
+passlib is only imported on the first hash or verify, in the pool workers
+(or wherever the hashing runs), so neither the app nor the workers pay for
+it at startup.
+"""
+import asyncio
+import multiprocessing
+import os
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Optional, Tuple
+from app.core.config import settings
+
+_pwd_context = None
+
+def get_pwd_context():
+    global _pwd_context
+    if _pwd_context is None:
+        from passlib.context import CryptContext
+        _pwd_context = CryptContext(schemes=["sha256_crypt"], deprecated="auto")
+    return _pwd_context
+
+def verify_password(plain_password, hashed_password):
+    return get_pwd_context().verify(plain_password, hashed_password)
+
+def get_password_hash(password):
+    return get_pwd_context().hash(password)
+
+def verify_and_update(plain_password, hashed_password) -> Tuple[bool, Optional[str]]:
+    """(valid, new_hash); new_hash is only set when the stored hash is outdated."""
+    try:
+        return get_pwd_context().verify_and_update(plain_password, hashed_password)
+    except ValueError:
+        # Unrecognised or malformed stored hash
+        return False, None
+
+def lower_priority():
+    # Pool workers yield the CPU to the event-loop process when cores are scarce
+    try:
+        os.nice(10)
+    except OSError:
+        pass
+
+_executor: Optional[Executor] = None
+_slots: Optional[asyncio.Semaphore] = None
+
+def _get_executor() -> Optional[Executor]:
+    global _executor
+    if _executor is None and settings.PASSWORD_HASH_EXECUTOR != "inline":
+        if settings.PASSWORD_HASH_EXECUTOR == "thread":
+            _executor = ThreadPoolExecutor(settings.PASSWORD_HASH_WORKERS, thread_name_prefix="password-hash")
+        else:
+            # spawn: forking a process that already runs an event loop and DB threads is unsafe
+            _executor = ProcessPoolExecutor(
+                settings.PASSWORD_HASH_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=lower_priority,
+            )
+    return _executor
+
+async def _run(func, *args):
+    global _slots
+    executor = _get_executor()
+    if executor is None:
+        return func(*args)
+    if _slots is None:
+        _slots = asyncio.Semaphore(settings.PASSWORD_HASH_CONCURRENCY)
+    async with _slots:
+        return await asyncio.get_running_loop().run_in_executor(executor, func, *args)
+
+async def hash_password(password: str) -> str:
+    return await _run(get_password_hash, password)
+
+async def check_password(plain_password: str, hashed_password: str) -> Tuple[bool, Optional[str]]:
+    """Async ``verify_and_update``."""
+    return await _run(verify_and_update, plain_password, hashed_password)
+
+def shutdown():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
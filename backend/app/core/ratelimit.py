@@ -0,0 +1,195 @@
+"""Token-bucket rate limits.
+
+A bucket holds up to ``burst`` tokens and refills at ``rate`` tokens per
+second. A request costing more tokens than are left is refused with the
+number of seconds until it would fit. A check is O(1): one lookup and a
+little arithmetic, with no timers or background refills.
+
+RATE_LIMIT_URL picks where buckets live:
+- "memory://" (default): in the process, an LRU of RATE_LIMIT_MAX_KEYS
+  buckets. Each worker enforces its own limits.
+- a redis:// URL: in Redis, updated by a Lua script in one round trip, so
+  a limit holds across workers and nodes. If Redis cannot be reached the
+  check lets the request through.
+"""
+import logging
+import math
+import time
+from collections import OrderedDict
+from typing import AsyncIterator, Hashable, NamedTuple
+from fastapi import HTTPException
+from app.core import metrics
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+class Limit(NamedTuple):
+    rate: float  # tokens per second
+    burst: float  # bucket size
+
+class RateLimited(Exception):
+    def __init__(self, retry_after: float):
+        super().__init__(retry_after)
+        self.retry_after = retry_after
+
+class TokenBucket:
+    __slots__ = ("tokens", "updated")
+
+    def __init__(self, limit: Limit):
+        self.tokens = limit.burst
+        self.updated = time.monotonic()
+
+    def take(self, limit: Limit, cost: float = 1) -> float:
+        """Take ``cost`` tokens. Returns 0.0, or seconds until they would be available."""
+        now = time.monotonic()
+        self.tokens = min(limit.burst, self.tokens + (now - self.updated) * limit.rate)
+        self.updated = now
+        # A cost above the burst could never be paid; charge a full bucket
+        cost = min(cost, limit.burst)
+        if self.tokens >= cost:
+            self.tokens -= cost
+            return 0.0
+        return (cost - self.tokens) / limit.rate
+
+class RateLimiter:
+    async def acquire(self, key: Hashable, limit: Limit, cost: float = 1) -> float:
+        """Take ``cost`` tokens from ``key``'s bucket. Returns 0.0 if allowed,
+        else seconds until the request would be."""
+        raise NotImplementedError
+
+    async def close(self):
+        pass
+
+class MemoryRateLimiter(RateLimiter):
+    def __init__(self, maxsize: int = 100000):
+        self.maxsize = maxsize
+        self._buckets: "OrderedDict[Hashable, TokenBucket]" = OrderedDict()
+
+    def take(self, key: Hashable, limit: Limit, cost: float = 1) -> float:
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = TokenBucket(limit)
+            if len(self._buckets) > self.maxsize:
+                # The least recently used bucket has had the longest to refill
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(key)
+        return bucket.take(limit, cost)
+
+    async def acquire(self, key: Hashable, limit: Limit, cost: float = 1) -> float:
+        return self.take(key, limit, cost)
+
+    def __len__(self):
+        return len(self._buckets)
+
+# KEYS[1] = bucket; ARGV = rate, burst, cost. Returns the wait as a string
+# (Lua numbers are truncated to integers on the way out).
+_TAKE_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local cost = math.min(tonumber(ARGV[3]), burst)
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(state[1]) or burst
+local updated = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+local wait = 0
+if tokens >= cost then
+    tokens = tokens - cost
+else
+    wait = (cost - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+redis.call('PEXPIRE', KEYS[1], math.ceil(burst / rate * 1000) + 1000)
+return tostring(wait)
+"""
+
+class RedisRateLimiter(RateLimiter):
+    """Buckets shared through Redis. Pass ``client`` to use an existing
+    ``redis.asyncio`` client."""
+
+    def __init__(self, url: str = "redis://localhost:6379/0", client=None, prefix: str = "convo:ratelimit:"):
+        if client is None:
+            import redis.asyncio as redis
+            client = redis.from_url(url)
+        self.redis = client
+        self.prefix = prefix
+        self.script = client.register_script(_TAKE_SCRIPT)
+
+    async def acquire(self, key: Hashable, limit: Limit, cost: float = 1) -> float:
+        try:
+            wait = await self.script(keys=[f"{self.prefix}{key}"], args=[limit.rate, limit.burst, cost])
+        except Exception as exc:
+            logger.warning("Rate limit check failed, allowing: %s", exc)
+            return 0.0
+        return float(wait)
+
+    async def close(self):
+        await self.redis.aclose()
+
+def create_rate_limiter(url: str) -> RateLimiter:
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        return RedisRateLimiter(url)
+    return MemoryRateLimiter(settings.RATE_LIMIT_MAX_KEYS)
+
+rate_limiter = create_rate_limiter(settings.RATE_LIMIT_URL)
+
+LOGIN = Limit(settings.RATE_LIMIT_LOGIN_RATE, settings.RATE_LIMIT_LOGIN_BURST)
+SEARCH = Limit(settings.RATE_LIMIT_SEARCH_RATE, settings.RATE_LIMIT_SEARCH_BURST)
+UPLOAD_BYTES = Limit(settings.RATE_LIMIT_UPLOAD_BYTES_RATE, settings.RATE_LIMIT_UPLOAD_BYTES_BURST)
+WS_FRAMES = Limit(settings.RATE_LIMIT_WS_FRAME_RATE, settings.RATE_LIMIT_WS_FRAME_BURST)
+
+# WebSocket frame type -> (scope, limit); types not listed only count
+# against the per-connection WS_FRAMES bucket
+_WS_TEXT = Limit(settings.RATE_LIMIT_WS_TEXT_RATE, settings.RATE_LIMIT_WS_TEXT_BURST)
+_WS_TYPING = Limit(settings.RATE_LIMIT_WS_TYPING_RATE, settings.RATE_LIMIT_WS_TYPING_BURST)
+_WS_SIGNAL = Limit(settings.RATE_LIMIT_WS_SIGNAL_RATE, settings.RATE_LIMIT_WS_SIGNAL_BURST)
+WS_LIMITS = {
+    "text": ("ws_text", _WS_TEXT),
+    "media": ("ws_text", _WS_TEXT),
+    "typing": ("ws_typing", _WS_TYPING),
+    "call-offer": ("ws_signal", _WS_SIGNAL),
+    "call-answer": ("ws_signal", _WS_SIGNAL),
+    "ice-candidate": ("ws_signal", _WS_SIGNAL),
+    "call-reject": ("ws_signal", _WS_SIGNAL),
+}
+
+def retry_after_seconds(wait: float) -> int:
+    # Retry-After takes whole seconds
+    return max(1, math.ceil(wait))
+
+async def acquire(scope: str, key: Hashable, limit: Limit, cost: float = 1) -> float:
+    """``rate_limiter.acquire`` on the "scope:key" bucket; always 0.0 when
+    RATE_LIMIT_ENABLED is off."""
+    if not settings.RATE_LIMIT_ENABLED:
+        return 0.0
+    wait = await rate_limiter.acquire(f"{scope}:{key}", limit, cost)
+    if wait:
+        metrics.rate_limited(scope)
+    return wait
+
+async def check(scope: str, key: Hashable, limit: Limit, cost: float = 1):
+    """Raise 429 with a Retry-After header if the request is over the limit."""
+    wait = await acquire(scope, key, limit, cost)
+    if wait:
+        seconds = retry_after_seconds(wait)
+        raise HTTPException(
+            status_code=429,
+            detail=f"Rate limit exceeded, retry in {seconds}s",
+            headers={"Retry-After": str(seconds)},
+        )
+
+async def metered(chunks: AsyncIterator[bytes], key: Hashable) -> AsyncIterator[bytes]:
+    """Pass an upload through, charging its bytes to ``key``'s upload bucket
+    about every UPLOAD_CHUNK_SIZE bytes. Raises 429 part way through once
+    the bucket runs dry."""
+    owed = 0
+    async for chunk in chunks:
+        owed += len(chunk)
+        if owed >= settings.UPLOAD_CHUNK_SIZE:
+            await check("upload", key, UPLOAD_BYTES, owed)
+            owed = 0
+        yield chunk
+    if owed:
+        await check("upload", key, UPLOAD_BYTES, owed)
@@ -1,15 +1,7 @@
-from passlib.context import CryptContext
 from datetime import datetime, timedelta
-from jose import jwt
 from app.core.config import settings
-
-pwd_context = CryptContext(schemes=["sha256_crypt"], deprecated="auto")
-
-def verify_password(plain_password, hashed_password):
-    return pwd_context.verify(plain_password, hashed_password)
-
-def get_password_hash(password):
-    return pwd_context.hash(password)
+# Blocking helpers; async routes should use passwords.hash_password / check_password
+from app.core.passwords import get_pwd_context, verify_password, get_password_hash  # noqa: F401
 
 def create_access_token(data: dict, expires_delta: timedelta | None = None):
     to_encode = data.copy()
@@ -18,6 +10,8 @@ def create_access_token(data: dict, expires_delta: timedelta | None = None):
     else:
         expire = datetime.utcnow() + timedelta(minutes=15)
     to_encode.update({"exp": expire})
+    # jose pulls in its crypto backends; load it on first use, not at startup
+    from jose import jwt
     encoded_jwt = jwt.encode(to_encode, settings.SECRET_KEY, algorithm=settings.ALGORITHM)
     return encoded_jwt
 
@@ -25,27 +19,72 @@ from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
+from typing import Optional
+from app.core.cache import TTLCache
 from app.core.database import get_db
 from app.models.user import User
+from app.schemas.user import UserOut
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl=f"{settings.API_V1_STR}/auth/login")
 
-async def get_current_user(db: AsyncSession = Depends(get_db), token: str = Depends(oauth2_scheme)):
-    credentials_exception = HTTPException(
-        status_code=status.HTTP_401_UNAUTHORIZED,
-        detail="Could not validate credentials",
-        headers={"WWW-Authenticate": "Bearer"},
+class Principal(UserOut):
+    """Read-only snapshot of the authenticated user.
+
+    Served from ``principal_cache`` for up to PRINCIPAL_CACHE_TTL seconds, so
+    routes that change the user must load the row themselves and call
+    ``invalidate_principal`` afterwards.
+    """
+
+    class Config:
+        from_attributes = True
+        frozen = True
+
+principal_cache = TTLCache(maxsize=settings.PRINCIPAL_CACHE_SIZE, ttl=settings.PRINCIPAL_CACHE_TTL)
+
+def create_user_token(user_id: int, email: str) -> str:
+    # The subject is the user id so the lookup hits the primary key
+    return create_access_token(
+        data={"sub": str(user_id), "email": email},
+        expires_delta=timedelta(minutes=settings.ACCESS_TOKEN_EXPIRE_MINUTES),
     )
+
+def invalidate_principal(user_id: int):
+    principal_cache.invalidate(user_id)
+
+async def resolve_principal(db: AsyncSession, token: str) -> Optional[Principal]:
+    """Return the user a token belongs to, or None if it is invalid."""
+    from jose import jwt
     try:
         payload = jwt.decode(token, settings.SECRET_KEY, algorithms=[settings.ALGORITHM])
-        email: str = payload.get("sub")
-        if email is None:
-            raise credentials_exception
+        subject = payload.get("sub")
     except Exception:
-        raise credentials_exception
-    
-    result = await db.execute(select(User).where(User.email == email))
-    user = result.scalars().first()
+        return None
+    if not isinstance(subject, str):
+        return None
+
+    if subject.isdigit():
+        user_id = int(subject)
+        principal = principal_cache.get(user_id)
+        if principal is not None:
+            return principal
+        user = await db.get(User, user_id)
+    else:
+        # Tokens issued before subjects were user ids carry the email
+        result = await db.execute(select(User).where(User.email == subject))
+        user = result.scalars().first()
     if user is None:
-        raise credentials_exception
-    return user
+        return None
+
+    principal = Principal.model_validate(user)
+    principal_cache.set(principal.user_id, principal)
+    return principal
+
+async def get_current_user(db: AsyncSession = Depends(get_db), token: str = Depends(oauth2_scheme)) -> Principal:
+    principal = await resolve_principal(db, token)
+    if principal is None:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Could not validate credentials",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+    return principal
@@ -1,10 +1,19 @@
+import asyncio
 from fastapi import FastAPI
+from fastapi.responses import PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
 from app.core.config import settings
-from app.routes import auth, chat, user, media, social
-from app.core.database import engine, Base
-from fastapi.staticfiles import StaticFiles
-import os
+from app.routes import auth, chat, user, media, social, uploads
+from app.core.database import engine, Base, pool_status
+from app.core import metrics, passwords
+from app.core.ratelimit import rate_limiter
+from app.websocket.manager import manager
+from app.websocket.backplane import create_backplane
+from app.services.message_writer import message_writer
+from app.services.search_service import ensure_search_schema
+from app.services.presence_service import presence
+from app.services.delivery_service import pending_deliveries
+from app.workers.queue import job_queue
 
 app = FastAPI(title=settings.PROJECT_NAME, openapi_url=f"{settings.API_V1_STR}/openapi.json")
 
@@ -17,6 +26,10 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+if settings.METRICS_ENABLED:
+    app.add_middleware(metrics.MetricsMiddleware)
+    metrics.instrument_engine(engine.sync_engine)
+
 # Routers
 app.include_router(auth.router, prefix=f"{settings.API_V1_STR}/auth", tags=["auth"])
 app.include_router(chat.router, prefix=f"{settings.API_V1_STR}/chat", tags=["chat"])
@@ -24,16 +37,43 @@ app.include_router(user.router, prefix=f"{settings.API_V1_STR}/users", tags=["us
 app.include_router(media.router, prefix=f"{settings.API_V1_STR}/media", tags=["media"])
 app.include_router(social.router, prefix=f"{settings.API_V1_STR}/social", tags=["social"])
 
-# Mount uploads static directory
-if not os.path.exists("backend/uploads"):
-    os.makedirs("backend/uploads")
-app.mount("/uploads", StaticFiles(directory="backend/uploads"), name="uploads")
+# Uploaded media (Range, ETag and immutable caching; see routes/uploads.py).
+# UPLOAD_DIR is created by the first upload, not at import.
+app.include_router(uploads.router, prefix="/uploads", tags=["uploads"])
 
 @app.on_event("startup")
 async def startup():
-    async with engine.begin() as conn:
-        await conn.run_sync(Base.metadata.create_all)
+    if settings.DB_CREATE_SCHEMA:
+        # Development only; concurrent workers would race on the DDL
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+            await conn.run_sync(ensure_search_schema)
+    await manager.start(create_backplane(settings.BACKPLANE_URL))
+    if settings.METRICS_ENABLED:
+        app.state.loop_probe = asyncio.create_task(metrics.probe_event_loop(settings.EVENT_LOOP_PROBE_INTERVAL))
+
+@app.on_event("shutdown")
+async def shutdown():
+    if getattr(app.state, "loop_probe", None):
+        app.state.loop_probe.cancel()
+    await message_writer.close()
+    await presence.close()
+    await pending_deliveries.close()
+    await manager.stop()
+    await rate_limiter.close()
+    passwords.shutdown()
+    if job_queue is not None:
+        job_queue.shutdown()
 
 @app.get("/")
 async def root():
     return {"message": "Welcome to CONVO API"}
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics_endpoint():
+    return PlainTextResponse(metrics.registry.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/health")
+async def health():
+    # Connection pool occupancy and checkout waits for this process
+    return {"status": "ok", "db_pool": pool_status(), "costliest_chat_fanouts": manager.fanout_stats.top()}
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Boolean, DateTime, ForeignKey, Text
+from sqlalchemy import Column, Integer, String, Boolean, DateTime, ForeignKey, Text, Index
 from sqlalchemy.orm import relationship
 from app.core.database import Base
 from sqlalchemy.sql import func
@@ -15,6 +15,9 @@ class Chat(Base):
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
 
+    # Read-only; load explicitly with selectinload(Chat.members)
+    members = relationship("ChatMember", viewonly=True, lazy="raise")
+
 class ChatMember(Base):
     __tablename__ = "chat_members"
 
@@ -23,6 +26,11 @@ class ChatMember(Base):
     role = Column(String(20), default="member")
     joined_at = Column(DateTime(timezone=True), server_default=func.now())
 
+    __table_args__ = (
+        # "Chats of user X": the primary key only serves lookups by chat_id
+        Index("ix_chat_members_user_id", "user_id"),
+    )
+
 class Message(Base):
     __tablename__ = "messages"
 
@@ -36,3 +44,38 @@ class Message(Base):
     reply_to_message_id = Column(Integer, ForeignKey("messages.message_id"), nullable=True)
     is_deleted = Column(Boolean, default=False)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
+
+    __table_args__ = (
+        # Keyset pagination and incremental sync walk a chat by message_id
+        Index("ix_messages_chat_id_message_id", "chat_id", "message_id"),
+        # Time-bounded reads of one chat (history by date, retention sweeps)
+        Index("ix_messages_chat_id_created_at", "chat_id", "created_at"),
+    )
+
+class ChatReadState(Base):
+    """Per-member receipt watermarks: everything in the chat up to these ids has
+    been delivered to / read by the user. Replaces per-message status rows."""
+    __tablename__ = "chat_read_states"
+
+    chat_id = Column(Integer, ForeignKey("chats.chat_id"), primary_key=True)
+    user_id = Column(Integer, ForeignKey("users.user_id"), primary_key=True)
+    last_read_message_id = Column(Integer, nullable=False, default=0)
+    last_delivered_message_id = Column(Integer, nullable=False, default=0)
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+
+class PendingDelivery(Base):
+    """Messages of a chat a user missed while offline and has not
+    acknowledged yet: those from first_message_id to last_message_id, with
+    no message of the chat in between that the user got.
+
+    Written only when the in-memory log of pending deliveries spills over,
+    one row per run of consecutive missed messages in a chat; rows are
+    trimmed as the replay on reconnect is acknowledged."""
+    __tablename__ = "pending_deliveries"
+
+    user_id = Column(Integer, ForeignKey("users.user_id", ondelete="CASCADE"), primary_key=True)
+    chat_id = Column(Integer, ForeignKey("chats.chat_id", ondelete="CASCADE"), primary_key=True)
+    first_message_id = Column(Integer, primary_key=True)
+    last_message_id = Column(Integer, nullable=False)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
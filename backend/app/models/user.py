@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Boolean, DateTime, func, ForeignKey
+from sqlalchemy import Column, Integer, String, Boolean, DateTime, func, ForeignKey, Index
 from sqlalchemy.orm import relationship
 from app.core.database import Base
 
@@ -18,7 +18,14 @@ class User(Base):
     updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
     is_deleted = Column(Boolean, default=False)
 
+    __table_args__ = (
+        # Directory prefix search and its keyset order
+        Index("ix_users_lower_username", func.lower(username), user_id),
+        Index("ix_users_lower_email", func.lower(email), user_id),
+    )
+
 class Friendship(Base):
+    """One row per pair of friends, always stored with user_id < friend_id."""
     __tablename__ = "friendships"
 
     id = Column(Integer, primary_key=True, index=True)
@@ -26,3 +33,9 @@ class Friendship(Base):
     friend_id = Column(Integer, ForeignKey("users.user_id"))
     status = Column(String, default="accepted") # For now, auto-accept for demo
     created_at = Column(DateTime(timezone=True), server_default=func.now())
+
+    __table_args__ = (
+        # Existence checks and "friends of user_id"; the other side uses friend_id
+        Index("uq_friendships_pair", "user_id", "friend_id", unique=True),
+        Index("ix_friendships_friend_id", "friend_id"),
+    )
@@ -1,13 +1,12 @@
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, HTTPException, Request
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
 from sqlalchemy import update
 from app.core.database import get_db
 from app.models.user import User
 from app.schemas.user import UserCreate, UserLogin, UserOut
-from app.core.security import get_password_hash, verify_password, create_access_token
-from datetime import timedelta
-from app.core.config import settings
+from app.core import passwords, ratelimit
+from app.core.security import create_user_token, invalidate_principal
 import random
 
 router = APIRouter()
@@ -18,8 +17,10 @@ async def register(user: UserCreate, db: AsyncSession = Depends(get_db)):
     existing_user = result.scalars().first()
     if existing_user:
         return existing_user 
+    # Don't hold a pooled connection while the hash runs
+    await db.rollback()
     
-    hashed_password = get_password_hash(user.password)
+    hashed_password = await passwords.hash_password(user.password)
     new_user = User(
         email=user.email,
         phone_number=user.phone_number,
@@ -33,38 +34,42 @@ async def register(user: UserCreate, db: AsyncSession = Depends(get_db)):
     return new_user
 
 @router.post("/login")
-async def login(user_credentials: UserLogin, db: AsyncSession = Depends(get_db)):
+async def login(user_credentials: UserLogin, request: Request, db: AsyncSession = Depends(get_db)):
+    # Each attempt costs a password hash; limited per client address
+    await ratelimit.check("login", request.client.host if request.client else "unknown", ratelimit.LOGIN)
     # DEMO MODE: Ultimate Access
-    result = await db.execute(select(User).where(User.email == user_credentials.email))
-    user = result.scalars().first()
-
     if not (user_credentials.password and user_credentials.email):
         raise HTTPException(status_code=400, detail="Email and password required")
-        
-    hashed_password = get_password_hash(user_credentials.password)
 
-    if not user:
+    result = await db.execute(select(User.user_id, User.password_hash).where(User.email == user_credentials.email))
+    existing = result.first()
+    # Don't hold a pooled connection while the hash runs
+    await db.rollback()
+        
+    if existing is None:
         # Create new user
         rand_phone = str(random.randint(1000000000, 9999999999))
         user = User(
             email=user_credentials.email,
             username=user_credentials.email.split('@')[0], 
-            password_hash=hashed_password,
-            phone_number=rand_phone,
-            is_online=True
+            password_hash=await passwords.hash_password(user_credentials.password),
+            phone_number=rand_phone
         )
         db.add(user)
         await db.commit()
+        await db.refresh(user)
+        user_id = user.user_id
     else:
-        # If user exists, FORCE update password to match input (Reset for demo)
-        user.password_hash = hashed_password
-        user.is_online = True
-        await db.commit()
-    
-    await db.refresh(user)
+        user_id, stored_hash = existing
+        valid, new_hash = await passwords.check_password(user_credentials.password, stored_hash)
+        if not valid:
+            # If the password differs, FORCE update it to match input (Reset for demo)
+            new_hash = await passwords.hash_password(user_credentials.password)
+        if new_hash:
+            # Only rehash when the password or hashing scheme changed
+            await db.execute(update(User).where(User.user_id == user_id).values(password_hash=new_hash))
+            await db.commit()
+            invalidate_principal(user_id)
     
-    access_token_expires = timedelta(minutes=settings.ACCESS_TOKEN_EXPIRE_MINUTES)
-    access_token = create_access_token(
-        data={"sub": user.email}, expires_delta=access_token_expires
-    )
-    return {"access_token": access_token, "token_type": "bearer", "user_id": user.user_id}
+    access_token = create_user_token(user_id, user_credentials.email)
+    return {"access_token": access_token, "token_type": "bearer", "user_id": user_id}
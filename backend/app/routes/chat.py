@@ -1,30 +1,92 @@
-from fastapi import APIRouter, Depends, WebSocket, WebSocketDisconnect, HTTPException
+from fastapi import APIRouter, Depends, WebSocket, WebSocketDisconnect, HTTPException, Query, status
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
 from sqlalchemy.orm import selectinload
-from app.core.database import get_db
+from app.core.database import SessionLocal, get_db
 from app.models.chat import Chat, ChatMember, Message
-from app.models.user import User
-from app.schemas.chat import ChatCreate, ChatOut, MessageOut
+from app.schemas.chat import ChatCreate, ChatOut, MessageOut, MessageSearchOut, MessageSyncOut, InboxChatOut, InboxOut
 from app.websocket.manager import manager
-from app.core.security import get_current_user
-from typing import List
+from app.websocket.protocol import Frame, FrameTooLarge, ProtocolError, negotiate
+from app.services import chat_service, receipt_service, search_service
+from app.services.delivery_service import pending_deliveries
+from app.services.presence_service import invalidate_contacts, presence
+from app.core import ratelimit
+from app.core.security import Principal, get_current_user, resolve_principal
+from typing import Dict, List, Optional
 
 router = APIRouter()
 
 @router.get("/", response_model=List[ChatOut])
-async def get_my_chats(db: AsyncSession = Depends(get_db), current_user: User = Depends(get_current_user)):
+async def get_my_chats(db: AsyncSession = Depends(get_db), current_user: Principal = Depends(get_current_user)):
     # Find all chats where user is a member
-    stmt = select(Chat).join(ChatMember).where(ChatMember.user_id == current_user.user_id)
+    stmt = (
+        select(Chat)
+        .join(ChatMember)
+        .where(ChatMember.user_id == current_user.user_id)
+        .options(selectinload(Chat.members))
+    )
     result = await db.execute(stmt)
     return result.scalars().all()
 
+@router.get("/inbox", response_model=InboxOut)
+async def get_inbox(
+    cursor: Optional[str] = None,
+    limit: int = Query(30, ge=1, le=100),
+    db: AsyncSession = Depends(get_db),
+    current_user: Principal = Depends(get_current_user)
+):
+    position = None
+    if cursor:
+        try:
+            activity, chat_id = (int(part) for part in cursor.split(":"))
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+        position = (activity, chat_id)
+
+    rows = await chat_service.get_inbox(db, current_user.user_id, limit=limit, cursor=position)
+    # Members are already loaded with the chats
+    summaries = await receipt_service.get_receipt_summaries(
+        db, [chat.chat_id for chat, last_message, _, _ in rows if last_message],
+        members={chat.chat_id: [member.user_id for member in chat.members] for chat, _, _, _ in rows},
+    )
+    chats = [
+        InboxChatOut(
+            **ChatOut.model_validate(chat).model_dump(),
+            last_message=with_receipt_status(last_message, summaries[chat.chat_id]) if last_message else None,
+            unread_count=unread_count,
+        )
+        for chat, last_message, unread_count, _ in rows
+    ]
+    next_cursor = None
+    if len(rows) == limit:
+        _, _, _, activity = rows[-1]
+        next_cursor = f"{activity}:{rows[-1][0].chat_id}"
+    return InboxOut(chats=chats, next_cursor=next_cursor)
+
+@router.get("/search", response_model=List[MessageSearchOut])
+async def search_messages(
+    q: str = Query(..., min_length=1, max_length=200),
+    chat_id: Optional[int] = None,
+    limit: int = Query(20, ge=1, le=100),
+    offset: int = Query(0, ge=0, le=1000),
+    db: AsyncSession = Depends(get_db),
+    current_user: Principal = Depends(get_current_user)
+):
+    await ratelimit.check("search", current_user.user_id, ratelimit.SEARCH)
+    # Only chats the caller belongs to are searched
+    rows = await search_service.search_messages(db, current_user.user_id, q, limit=limit, offset=offset, chat_id=chat_id)
+    summaries = await receipt_service.get_receipt_summaries(db, {row["chat_id"] for row in rows})
+    return [
+        MessageSearchOut(**row, status=summaries[row["chat_id"]].status_of(row["message_id"], row["sender_id"]))
+        for row in rows
+    ]
+
 @router.post("/create", response_model=ChatOut)
-async def create_chat(chat_data: ChatCreate, db: AsyncSession = Depends(get_db), current_user: User = Depends(get_current_user)):
+async def create_chat(chat_data: ChatCreate, db: AsyncSession = Depends(get_db), current_user: Principal = Depends(get_current_user)):
     new_chat = Chat(is_group=chat_data.is_group, name=chat_data.name, created_by=current_user.user_id)
     db.add(new_chat)
-    await db.commit()
-    await db.refresh(new_chat)
+    # Flush to get chat_id; chat and members are committed together
+    await db.flush()
     
     # Add creator
     creator_member = ChatMember(chat_id=new_chat.chat_id, user_id=current_user.user_id, role="admin")
@@ -36,136 +98,361 @@ async def create_chat(chat_data: ChatCreate, db: AsyncSession = Depends(get_db),
             member = ChatMember(chat_id=new_chat.chat_id, user_id=pid, role="member")
             db.add(member)
             
+    chat_id = new_chat.chat_id
     await db.commit()
-    return new_chat
+    chat_service.invalidate_chat_members(chat_id)
+    manager.join_chat(chat_id, {current_user.user_id, *chat_data.participant_ids})
+    invalidate_contacts([current_user.user_id, *chat_data.participant_ids])
+    return await chat_service.get_chat_with_members(db, chat_id)
+
+def with_receipt_status(message: Message, summary: receipt_service.ReceiptSummary) -> MessageOut:
+    out = MessageOut.model_validate(message)
+    out.status = summary.status_of(message.message_id, message.sender_id)
+    return out
 
 @router.get("/{chat_id}/messages", response_model=List[MessageOut])
-async def get_chat_messages(chat_id: int, db: AsyncSession = Depends(get_db), current_user: User = Depends(get_current_user)):
+async def get_chat_messages(
+    chat_id: int,
+    before: Optional[int] = None,
+    after: Optional[int] = None,
+    limit: int = Query(50, ge=1, le=200),
+    db: AsyncSession = Depends(get_db),
+    current_user: Principal = Depends(get_current_user)
+):
     # Verify membership
-    membership = await db.execute(select(ChatMember).where(ChatMember.chat_id == chat_id, ChatMember.user_id == current_user.user_id))
-    if not membership.scalars().first():
+    if current_user.user_id not in await chat_service.get_chat_members(db, chat_id):
         raise HTTPException(status_code=403, detail="Not a member of this chat")
-    
-    stmt = select(Message).where(Message.chat_id == chat_id).order_by(Message.created_at.asc())
+
+    # Keyset pagination on (chat_id, message_id). Pages are always returned oldest first;
+    # use the first message_id as `before` for older history, the last as `after` for newer.
+    stmt = select(Message).where(Message.chat_id == chat_id)
+    if after is not None:
+        stmt = stmt.where(Message.message_id > after).order_by(Message.message_id.asc()).limit(limit)
+        result = await db.execute(stmt)
+        messages = result.scalars().all()
+    else:
+        if before is not None:
+            stmt = stmt.where(Message.message_id < before)
+        stmt = stmt.order_by(Message.message_id.desc()).limit(limit)
+        result = await db.execute(stmt)
+        messages = list(reversed(result.scalars().all()))
+
+    summary = await receipt_service.get_receipt_summary(db, chat_id)
+    return [with_receipt_status(message, summary) for message in messages]
+
+@router.get("/{chat_id}/sync", response_model=MessageSyncOut)
+async def sync_chat(
+    chat_id: int,
+    since: int = 0,
+    limit: int = Query(200, ge=1, le=1000),
+    db: AsyncSession = Depends(get_db),
+    current_user: Principal = Depends(get_current_user)
+):
+    """Catch up after a reconnect: messages after `since` plus the current receipt state."""
+    if current_user.user_id not in await chat_service.get_chat_members(db, chat_id):
+        raise HTTPException(status_code=403, detail="Not a member of this chat")
+
+    stmt = (
+        select(Message)
+        .where(Message.chat_id == chat_id, Message.message_id > since)
+        .order_by(Message.message_id.asc())
+        .limit(limit + 1)
+    )
     result = await db.execute(stmt)
-    return result.scalars().all()
+    messages = result.scalars().all()
+    has_more = len(messages) > limit
+    messages = messages[:limit]
+
+    summary = await receipt_service.get_receipt_summary(db, chat_id)
+    return MessageSyncOut(
+        messages=[with_receipt_status(message, summary) for message in messages],
+        delivered_up_to=summary.delivered_up_to(current_user.user_id),
+        read_up_to=summary.read_up_to(current_user.user_id),
+        cursor=messages[-1].message_id if messages else since,
+        has_more=has_more,
+    )
 
 @router.delete("/{chat_id}")
-async def delete_chat(chat_id: int, db: AsyncSession = Depends(get_db), current_user: User = Depends(get_current_user)):
+async def delete_chat(chat_id: int, db: AsyncSession = Depends(get_db), current_user: Principal = Depends(get_current_user)):
     # Only creator can delete chat
     result = await db.execute(select(Chat).where(Chat.chat_id == chat_id, Chat.created_by == current_user.user_id))
     chat = result.scalars().first()
     if not chat:
         raise HTTPException(status_code=403, detail="Only the creator can delete this chat")
     
+    members = await chat_service.get_chat_members(db, chat_id)
     await db.delete(chat)
     await db.commit()
+    chat_service.invalidate_chat_members(chat_id)
+    manager.forget_chat(chat_id)
+    invalidate_contacts(members)
     return {"message": "Chat deleted"}
 
 @router.post("/{chat_id}/leave")
-async def leave_chat(chat_id: int, db: AsyncSession = Depends(get_db), current_user: User = Depends(get_current_user)):
+async def leave_chat(chat_id: int, db: AsyncSession = Depends(get_db), current_user: Principal = Depends(get_current_user)):
     result = await db.execute(select(ChatMember).where(ChatMember.chat_id == chat_id, ChatMember.user_id == current_user.user_id))
     membership = result.scalars().first()
     if not membership:
         raise HTTPException(status_code=404, detail="Not a member")
     
+    members = await chat_service.get_chat_members(db, chat_id)
     await db.delete(membership)
     await db.commit()
+    chat_service.invalidate_chat_members(chat_id)
+    manager.leave_chat(chat_id, [current_user.user_id])
+    invalidate_contacts(members)
     return {"message": "Left chat"}
 
-import json
-from app.services import chat_service
+import asyncio
+import logging
+from typing import Awaitable, Iterable
+from app.core import metrics
+from app.core.config import settings
+from app.services.message_writer import message_writer
+
+logger = logging.getLogger(__name__)
+
+_background_tasks: set = set()
+
+async def broadcast_message(saved: Awaitable[Message], members: Iterable[int], msg_type: str):
+    try:
+        new_msg = await saved
+    except Exception:
+        logger.exception("Message was not saved; nothing to broadcast")
+        return
+
+    # Encoded once per wire format, not per member
+    broadcast_data = Frame(chat_service.message_event(new_msg, msg_type))
+    for member_id in await manager.send_to_chat(new_msg.chat_id, broadcast_data, members, kind=msg_type):
+        pending_deliveries.record(member_id, broadcast_data)
+
+async def broadcast_batch(rows: List[dict], members: Dict[int, Iterable[int]]):
+    """Save the messages of one batch frame in a single transaction, then give
+    every member (``members`` maps each chat to them) all of the new messages
+    of each chat in one go."""
+    try:
+        async with SessionLocal() as db:
+            saved = await chat_service.save_messages(db, rows)
+    except Exception:
+        logger.exception("Batch of %d messages was not saved; nothing to broadcast", len(rows))
+        return
+
+    per_chat: Dict[int, List[Frame]] = {}
+    for new_msg in saved:
+        per_chat.setdefault(new_msg.chat_id, []).append(Frame(chat_service.message_event(new_msg)))
+    for chat_id, frames in per_chat.items():
+        for member_id in await manager.send_all_to_chat(chat_id, frames, members[chat_id]):
+            for frame in frames:
+                pending_deliveries.record(member_id, frame)
+
+async def _members(chat_id: int):
+    # Usually a membership cache hit, which never checks out a connection
+    async with SessionLocal() as db:
+        return await chat_service.get_chat_members(db, chat_id)
+
+async def _save_message(chat_id: int, sender_id: int, content: str, msg_type: str, media_url: Optional[str]) -> Message:
+    async with SessionLocal() as db:
+        return await chat_service.save_message(db, chat_id, sender_id, content, msg_type=msg_type, media_url=media_url)
 
 @router.websocket("/ws/{user_id}")
-async def websocket_endpoint(websocket: WebSocket, user_id: int, db: AsyncSession = Depends(get_db)):
-    await manager.connect(websocket, user_id)
-    
-    # Broadcast Online Status
-    await manager.broadcast(json.dumps({
-        "type": "status",
-        "user_id": user_id,
-        "status": "online"
-    }))
-    
+async def websocket_endpoint(websocket: WebSocket, user_id: int, token: Optional[str] = None, protocol: Optional[str] = None,
+                             acks: bool = False):
+    # Wire format: a "convo.<name>" subprotocol or ?protocol=<name> (see app.websocket.protocol)
+    codec, subprotocol = negotiate(websocket.scope, protocol)
+    if codec is None:
+        await websocket.close(code=status.WS_1003_UNSUPPORTED_DATA)
+        return
+
+    # Sockets live for hours, so each operation below borrows its own short
+    # session; an idle socket holds no pooled connection.
+    async with SessionLocal() as db:
+        # Authenticate once at the handshake (?token=<access token>); frames are not re-checked
+        principal = await resolve_principal(db, token) if token else None
+        if principal is None or principal.user_id != user_id:
+            await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+            return
+        snapshot = await presence.snapshot(db, user_id)
+        chat_ids = await chat_service.get_user_chat_ids(db, user_id)
+
+    # ?acks=1: numbered batch frames with cumulative acks (see Connection).
+    # Live events wait until what the user missed while offline is replayed.
+    connection = await manager.connect(websocket, user_id, codec, subprotocol, acks=acks, hold=True, chats=chat_ids)
+    receipts = receipt_service.ReceiptBuffer(user_id)
+    replaying = asyncio.create_task(pending_deliveries.replay(connection, receipts))
+
+    # Contacts hear about it in the next presence diff; this device gets theirs now
+    await presence.connected(user_id)
+    connection.enqueue(Frame({"type": "presence", "changes": snapshot}), kind="presence")
+
+    # Every frame costs a token from this connection's bucket; message types
+    # in ratelimit.WS_LIMITS also cost one from the user's bucket for them
+    frame_bucket = ratelimit.TokenBucket(ratelimit.WS_FRAMES)
+    refused = 0
+
+    def refuse(scope: str, wait: float):
+        # The frame is dropped and the client told when to retry; a client
+        # that keeps going regardless is disconnected
+        nonlocal refused
+        refused += 1
+        if refused >= settings.RATE_LIMIT_WS_MAX_REFUSED:
+            raise ratelimit.RateLimited(wait)
+        notice = Frame({"type": "rate_limited", "scope": scope, "retry_after": round(wait, 3)})
+        connection.enqueue(notice, kind="rate_limited", coalesce_key=("rate_limited", scope))
+
+    async def admit(msg_type: str, cost: int = 1) -> bool:
+        nonlocal refused
+        scope, limit = ratelimit.WS_LIMITS[msg_type]
+        wait = await ratelimit.acquire(scope, user_id, limit, cost)
+        if wait:
+            refuse(scope, wait)
+            return False
+        refused = 0
+        return True
+
+    async def handle(message_data: dict):
+        msg_type = message_data.get("type", "text")
+        metrics.frame_in(msg_type)
+        # The type is client JSON and may be unhashable (a list, say)
+        if isinstance(msg_type, str) and msg_type in ratelimit.WS_LIMITS and not await admit(msg_type):
+            return
+        chat_id = message_data.get("chat_id")
+        content = message_data.get("content")
+        recipient_id = message_data.get("recipient_id") # For direct signaling
+        
+        if msg_type in ["text", "media"]:
+            if chat_id and content:
+                # Find all members to broadcast to
+                members = await _members(chat_id)
+                if user_id not in members:
+                    return
+
+                # Save to DB
+                if settings.MESSAGE_BATCHING:
+                    saved = message_writer.submit(
+                        chat_id, user_id, content,
+                        msg_type=msg_type,
+                        media_url=message_data.get("media_url")
+                    )
+                else:
+                    saved = _save_message(chat_id, user_id, content, msg_type, message_data.get("media_url"))
+
+                if settings.MESSAGE_BATCHING and settings.MESSAGE_ACK_MODE == "enqueue":
+                    # Keep reading frames; members get the message once its batch commits
+                    task = asyncio.create_task(broadcast_message(saved, members, msg_type))
+                    _background_tasks.add(task)
+                    task.add_done_callback(_background_tasks.discard)
+                else:
+                    await broadcast_message(saved, members, msg_type)
+        
+        elif msg_type in ["read", "delivered"]:
+            if chat_id:
+                # Coalesced and written as a watermark upsert by the buffer
+                receipts.ack(chat_id, msg_type, message_data.get("message_id"))
+
+        elif msg_type == "typing":
+            if chat_id:
+                members = await _members(chat_id)
+                typing_payload = Frame({
+                    "type": "typing",
+                    "chat_id": chat_id,
+                    "user_id": user_id,
+                    "is_typing": message_data.get("is_typing", True)
+                })
+                # Not to self; a keystroke still waiting in a queue is replaced by the newer one
+                await manager.send_to_chat(chat_id, typing_payload, members, kind="typing", exclude=user_id,
+                                           coalesce_key=("typing", chat_id, user_id))
+
+        elif msg_type in ["call-offer", "call-answer", "ice-candidate", "call-reject"]:
+            # Signaling messages usually go to a specific recipient or chat members
+            if recipient_id:
+                signaling_payload = Frame({
+                    "type": msg_type,
+                    "sender_id": user_id,
+                    "data": message_data.get("data") # SDP or Candidate
+                })
+                await manager.send_personal_message(signaling_payload, recipient_id, kind=msg_type)
+
+        elif msg_type == "ack":
+            seq = message_data.get("seq")
+            if isinstance(seq, int):
+                connection.ack(seq)
+
+        elif msg_type == "batch":
+            frames = message_data.get("frames")
+            if isinstance(frames, list):
+                await handle_batch(frames[:settings.WS_BATCH_MAX_FRAMES])
+
+    async def handle_batch(frames: list):
+        # Messages are saved together and fanned out after the other events
+        rows = []
+        for entry in frames:
+            if not isinstance(entry, dict):
+                continue
+            entry_type = entry.get("type", "text")
+            if entry_type in ["text", "media"]:
+                metrics.frame_in(entry_type)
+                if isinstance(entry.get("chat_id"), int) and entry.get("content"):
+                    rows.append({
+                        "chat_id": entry["chat_id"],
+                        "sender_id": user_id,
+                        "content": entry["content"],
+                        "msg_type": entry_type,
+                        "media_url": entry.get("media_url"),
+                        "status": "sent",
+                    })
+            elif entry_type != "batch":
+                await handle(entry)
+        # Only into chats the sender belongs to, as for a single message
+        members: Dict[int, Iterable[int]] = {}
+        for row in rows:
+            if row["chat_id"] not in members:
+                members[row["chat_id"]] = await _members(row["chat_id"])
+        rows = [row for row in rows if user_id in members[row["chat_id"]]]
+        if rows and await admit("text", len(rows)):
+            await broadcast_batch(rows, members)
+
+    def delivered(events: list):
+        # An acknowledged batch confirms delivery of the messages it carried
+        for event in events:
+            if isinstance(event, Frame) and event.payload.get("type") in ["text", "media"] and event.payload.get("sender_id") != user_id:
+                receipts.ack(event.payload["chat_id"], "delivered", event.payload["message_id"])
+
+    connection.on_acked = delivered
+
     try:
         while True:
-            data = await websocket.receive_text()
+            received = await websocket.receive()
+            if received["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(received.get("code", 1000))
+            if settings.RATE_LIMIT_ENABLED:
+                # Checked before decoding, so a flood costs as little as possible
+                wait = frame_bucket.take(ratelimit.WS_FRAMES)
+                if wait:
+                    metrics.rate_limited("ws_frame")
+                    refuse("ws_frame", wait)
+                    continue
+            data = received.get("text")
+            if data is None:
+                data = received.get("bytes")
             try:
-                message_data = json.loads(data)
-                msg_type = message_data.get("type", "text")
-                chat_id = message_data.get("chat_id")
-                content = message_data.get("content")
-                recipient_id = message_data.get("recipient_id") # For direct signaling
-                
-                if msg_type in ["text", "media"]:
-                    if chat_id and content:
-                        # Save to DB
-                        new_msg = await chat_service.save_message(
-                            db, chat_id, user_id, content, 
-                            msg_type=msg_type, 
-                            media_url=message_data.get("media_url")
-                        )
-                        
-                        # Find all members to broadcast to
-                        members = await chat_service.get_chat_members(db, chat_id)
-                        
-                        # Prepare message for broadcast
-                        broadcast_data = json.dumps({
-                            "type": msg_type,
-                            "message_id": new_msg.message_id,
-                            "chat_id": chat_id,
-                            "sender_id": user_id,
-                            "content": content,
-                            "media_url": new_msg.media_url,
-                            "status": new_msg.status,
-                            "created_at": new_msg.created_at.isoformat()
-                        })
-                        
-                        for member_id in members:
-                            await manager.send_personal_message(broadcast_data, member_id)
-                
-                elif msg_type == "read":
-                    if chat_id:
-                        await chat_service.mark_chat_as_read(db, chat_id, user_id)
-                        members = await chat_service.get_chat_members(db, chat_id)
-                        read_payload = json.dumps({
-                            "type": "read",
-                            "chat_id": chat_id,
-                            "user_id": user_id
-                        })
-                        for member_id in members:
-                            await manager.send_personal_message(read_payload, member_id)
-
-                elif msg_type == "typing":
-                    if chat_id:
-                        members = await chat_service.get_chat_members(db, chat_id)
-                        typing_payload = json.dumps({
-                            "type": "typing",
-                            "chat_id": chat_id,
-                            "user_id": user_id,
-                            "is_typing": message_data.get("is_typing", True)
-                        })
-                        for member_id in members:
-                            if member_id != user_id: # Don't send to self
-                                await manager.send_personal_message(typing_payload, member_id)
-
-                elif msg_type in ["call-offer", "call-answer", "ice-candidate", "call-reject"]:
-                    # Signaling messages usually go to a specific recipient or chat members
-                    if recipient_id:
-                        signaling_payload = json.dumps({
-                            "type": msg_type,
-                            "sender_id": user_id,
-                            "data": message_data.get("data") # SDP or Candidate
-                        })
-                        await manager.send_personal_message(signaling_payload, recipient_id)
-            except json.JSONDecodeError:
+                message_data = codec.decode(data)
+            except FrameTooLarge:
+                await connection.close(code=status.WS_1009_MESSAGE_TOO_BIG)
+                break
+            except ProtocolError:
                 # Handle plain text for backward compatibility / testing
-                await manager.send_personal_message(f"Echo: {data}", user_id)
+                if isinstance(data, str):
+                    await manager.send_personal_message(f"Echo: {data}", user_id)
+                continue
+            await handle(message_data)
     except WebSocketDisconnect:
+        pass
+    except ratelimit.RateLimited as exc:
+        await connection.close(code=status.WS_1013_TRY_AGAIN_LATER,
+                               reason=f"rate limited, retry after {ratelimit.retry_after_seconds(exc.retry_after)}s")
+    finally:
         manager.disconnect(websocket, user_id)
-        # Broadcast Offline Status
-        await manager.broadcast(json.dumps({
-            "type": "status",
-            "user_id": user_id,
-            "status": "offline"
-        }))
+        await presence.disconnected(user_id)
+        replaying.cancel()
+        await asyncio.gather(replaying, return_exceptions=True)
+        await receipts.close()
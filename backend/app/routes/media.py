@@ -1,35 +1,104 @@
-from fastapi import APIRouter, Depends, HTTPException, UploadFile, File
-from sqlalchemy.ext.asyncio import AsyncSession
-from app.core.database import get_db
-from app.core.security import get_current_user
-from app.models.user import User
-import shutil
-import os
-import uuid
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, UploadFile, File
+from app.core import ratelimit
+from app.core.config import settings
+from app.core.security import Principal, get_current_user
+from app.schemas.media import UploadSessionCreate, UploadSessionOut
+from app.services import media_service
+from app.workers.queue import enqueue_derivatives
 
 router = APIRouter()
 
-UPLOAD_DIR = "backend/uploads"
-if not os.path.exists(UPLOAD_DIR):
-    os.makedirs(UPLOAD_DIR)
+def _too_large():
+    return HTTPException(status_code=413, detail=f"Uploads are limited to {settings.MAX_UPLOAD_BYTES} bytes")
+
+def _check_length(request: Request):
+    # Reject before reading anything when the client declares the size
+    content_length = request.headers.get("content-length")
+    if content_length and content_length.isdigit() and int(content_length) > settings.MAX_UPLOAD_BYTES:
+        raise _too_large()
+
+async def _read_upload(file: UploadFile):
+    while chunk := await file.read(settings.UPLOAD_CHUNK_SIZE):
+        yield chunk
+
+def _session_out(session: dict) -> UploadSessionOut:
+    return UploadSessionOut(chunk_size=settings.UPLOAD_CHUNK_SIZE, **session)
 
 @router.post("/upload")
 async def upload_file(
     file: UploadFile = File(...),
-    current_user: User = Depends(get_current_user),
-    db: AsyncSession = Depends(get_db)
+    current_user: Principal = Depends(get_current_user)
 ):
-    # Create unique filename
-    file_extension = os.path.splitext(file.filename)[1]
-    unique_filename = f"{uuid.uuid4()}{file_extension}"
-    file_path = os.path.join(UPLOAD_DIR, unique_filename)
-    
-    with open(file_path, "wb") as buffer:
-        shutil.copyfileobj(file.file, buffer)
-        
+    if file.size is not None and file.size > settings.MAX_UPLOAD_BYTES:
+        raise _too_large()
+    try:
+        name, size = await media_service.store_stream(ratelimit.metered(_read_upload(file), current_user.user_id), file.filename)
+    except media_service.UploadTooLarge:
+        raise _too_large()
+    await enqueue_derivatives(name)
     # Return local URL (In production, this would be an S3 URL)
-    return {
-        "url": f"/uploads/{unique_filename}",
-        "filename": file.filename,
-        "type": file.content_type
-    }
+    return media_service.stored_info(name, file.filename, file.content_type, size)
+
+@router.post("/upload/stream")
+async def upload_stream(
+    request: Request,
+    filename: str = Query(..., max_length=255),
+    current_user: Principal = Depends(get_current_user)
+):
+    """Raw request body upload: streamed to disk as it arrives, no multipart spooling."""
+    _check_length(request)
+    try:
+        name, size = await media_service.store_stream(ratelimit.metered(request.stream(), current_user.user_id), filename)
+    except media_service.UploadTooLarge:
+        raise _too_large()
+    await enqueue_derivatives(name)
+    return media_service.stored_info(name, filename, request.headers.get("content-type"), size)
+
+# Resumable uploads: create a session, PUT the body in pieces at the offset
+# the server reports, then complete. After an interruption, GET the session
+# and continue from its offset.
+
+@router.post("/uploads", response_model=UploadSessionOut)
+async def create_upload_session(body: UploadSessionCreate, current_user: Principal = Depends(get_current_user)):
+    try:
+        session = await media_service.create_session(current_user.user_id, body.filename, body.size, body.content_type)
+    except media_service.UploadTooLarge:
+        raise _too_large()
+    return _session_out(session)
+
+@router.get("/uploads/{upload_id}", response_model=UploadSessionOut)
+async def get_upload_session(upload_id: str, current_user: Principal = Depends(get_current_user)):
+    try:
+        session = await media_service.get_session(upload_id, current_user.user_id)
+    except media_service.UploadSessionNotFound:
+        raise HTTPException(status_code=404, detail="Upload not found")
+    return _session_out(session)
+
+@router.put("/uploads/{upload_id}", response_model=UploadSessionOut)
+async def upload_chunk(
+    upload_id: str,
+    request: Request,
+    offset: int = Query(..., ge=0),
+    current_user: Principal = Depends(get_current_user)
+):
+    try:
+        session = await media_service.append_chunk(upload_id, current_user.user_id, offset,
+                                                   ratelimit.metered(request.stream(), current_user.user_id))
+    except media_service.UploadSessionNotFound:
+        raise HTTPException(status_code=404, detail="Upload not found")
+    except media_service.UploadOffsetMismatch as exc:
+        raise HTTPException(status_code=409, detail={"message": "Offset mismatch", "offset": exc.offset})
+    except media_service.UploadTooLarge:
+        raise HTTPException(status_code=413, detail="Chunk goes past the declared size")
+    return _session_out(session)
+
+@router.post("/uploads/{upload_id}/complete")
+async def complete_upload_session(upload_id: str, current_user: Principal = Depends(get_current_user)):
+    try:
+        stored = await media_service.complete_session(upload_id, current_user.user_id)
+    except media_service.UploadSessionNotFound:
+        raise HTTPException(status_code=404, detail="Upload not found")
+    except media_service.UploadOffsetMismatch as exc:
+        raise HTTPException(status_code=409, detail={"message": "Upload is incomplete", "offset": exc.offset})
+    await enqueue_derivatives(stored["url"].rsplit("/", 1)[1])
+    return stored
@@ -1,20 +1,22 @@
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Query
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
-from sqlalchemy import or_
 from app.core.database import get_db
-from app.models.user import User, Friendship
-from app.schemas.user import UserOut
-from app.core.security import get_current_user
+from app.models.user import User
+from app.schemas.user import FriendSuggestionOut, UserOut
+from app.core import ratelimit
+from app.core.security import Principal, get_current_user
+from app.services import search_service, social_service, user_service
+from app.services.presence_service import invalidate_contacts
 from typing import List
 
 router = APIRouter()
 
 @router.post("/add")
-async def add_friend(friend_email: str, db: AsyncSession = Depends(get_db), current_user: User = Depends(get_current_user)):
+async def add_friend(friend_email: str, db: AsyncSession = Depends(get_db), current_user: Principal = Depends(get_current_user)):
     # Find friend by email
-    result = await db.execute(select(User).where(User.email == friend_email))
-    friend = result.scalars().first()
+    result = await db.execute(select(User.user_id, User.username).where(User.email == friend_email))
+    friend = result.first()
     
     if not friend:
         raise HTTPException(status_code=404, detail="User not found")
@@ -22,58 +24,34 @@ async def add_friend(friend_email: str, db: AsyncSession = Depends(get_db), curr
     if friend.user_id == current_user.user_id:
         raise HTTPException(status_code=400, detail="You cannot add yourself")
 
-    # Check if already friends
-    result = await db.execute(select(Friendship).where(
-        or_(
-            (Friendship.user_id == current_user.user_id) & (Friendship.friend_id == friend.user_id),
-            (Friendship.user_id == friend.user_id) & (Friendship.friend_id == current_user.user_id)
-        )
-    ))
-    if result.scalars().first():
+    # One indexed lookup of the (smaller id, larger id) pair, then the insert
+    if not await social_service.add_friendship(db, current_user.user_id, friend.user_id):
         return {"message": "Already connected"}
-
-    # Create friendship
-    new_friendship = Friendship(
-        user_id=current_user.user_id,
-        friend_id=friend.user_id,
-        status="accepted"
-    )
-    db.add(new_friendship)
-    await db.commit()
+    invalidate_contacts([current_user.user_id, friend.user_id])
     
     return {"message": f"Connected with {friend.username}"}
 
 @router.get("/list", response_model=List[UserOut])
-async def get_contacts(db: AsyncSession = Depends(get_db), current_user: User = Depends(get_current_user)):
-    # Find all users who are friends
-    result = await db.execute(select(Friendship).where(
-        or_(
-            Friendship.user_id == current_user.user_id,
-            Friendship.friend_id == current_user.user_id
-        )
-    ))
-    friendships = result.scalars().all()
-    
-    friend_ids = []
-    for f in friendships:
-        if f.user_id == current_user.user_id:
-            friend_ids.append(f.friend_id)
-        else:
-            friend_ids.append(f.user_id)
-            
-    if not friend_ids:
-        return []
-        
-    result = await db.execute(select(User).where(User.user_id.in_(friend_ids)))
-    return result.scalars().all()
+async def get_contacts(db: AsyncSession = Depends(get_db), current_user: Principal = Depends(get_current_user)):
+    # Friend ids come from the per-user cache; the users are primary key lookups
+    friend_ids = await social_service.get_friend_ids(db, current_user.user_id)
+    return user_service.users_response(await user_service.get_users_out(db, friend_ids))
+
+@router.get("/mutual/{user_id}", response_model=List[UserOut])
+async def get_mutual_friends(user_id: int, db: AsyncSession = Depends(get_db), current_user: Principal = Depends(get_current_user)):
+    mutual = await social_service.mutual_friends(db, current_user.user_id, user_id)
+    return user_service.users_response(await user_service.get_users_out(db, mutual))
+
+@router.get("/suggestions", response_model=List[FriendSuggestionOut])
+async def get_suggestions(limit: int = Query(20, ge=1, le=100), db: AsyncSession = Depends(get_db), current_user: Principal = Depends(get_current_user)):
+    # Friends of friends, ranked by how many friends they share with the caller
+    suggested = dict(await social_service.suggest_friends(db, current_user.user_id, limit))
+    users = await user_service.get_users_out(db, suggested)
+    out = [FriendSuggestionOut(**user, mutual_friends=suggested[user["user_id"]]) for user in users]
+    out.sort(key=lambda suggestion: (-suggestion.mutual_friends, suggestion.user_id))
+    return out
 
 @router.get("/search", response_model=List[UserOut])
-async def search_users(query: str, db: AsyncSession = Depends(get_db), current_user: User = Depends(get_current_user)):
-    result = await db.execute(select(User).where(
-        (User.user_id != current_user.user_id) &
-        (or_(
-            User.email.ilike(f"%{query}%"),
-            User.username.ilike(f"%{query}%")
-        ))
-    ))
-    return result.scalars().all()
+async def search_users(query: str, limit: int = Query(20, ge=1, le=100), db: AsyncSession = Depends(get_db), current_user: Principal = Depends(get_current_user)):
+    await ratelimit.check("search", current_user.user_id, ratelimit.SEARCH)
+    return user_service.users_response(await search_service.search_users(db, query, current_user.user_id, limit=limit))
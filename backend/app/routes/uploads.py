@@ -0,0 +1,121 @@
+import asyncio
+import os
+import re
+import stat
+from email.utils import formatdate, parsedate_to_datetime
+from typing import Optional, Tuple
+from fastapi import APIRouter, HTTPException, Request, Response
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.responses import FileResponse
+from app.core.config import settings
+
+router = APIRouter()
+
+# Uploads are never rewritten in place: hash-named files by definition, and
+# the older uuid-named ones get a fresh name per upload as well
+IMMUTABLE = "public, max-age=31536000, immutable"
+SAFE_NAME = re.compile(r"[A-Za-z0-9_-][A-Za-z0-9._-]{0,254}")
+CONTENT_ADDRESSED = re.compile(r"([0-9a-f]{64})(\.[a-z0-9]{1,10})?")
+SINGLE_RANGE = re.compile(r"bytes=(\d*)-(\d*)")
+
+class MediaFileResponse(FileResponse):
+    """FileResponse (Range, If-Range, pathsend) that also uses the ASGI
+    ``http.response.zerocopysend`` extension when the server offers it, so
+    whole files and single ranges go out via sendfile. Without it, falls
+    back to threaded reads in larger chunks than Starlette's default.
+
+    Only Starlette's public ``__call__`` is overridden: a GET for the whole
+    file or for one satisfiable ``bytes=`` range is answered here, and
+    everything else (HEAD, If-Range, several or invalid ranges) is left to
+    FileResponse."""
+
+    chunk_size = 256 * 1024
+
+    async def __call__(self, scope, receive, send):
+        zerocopy = scope["type"] == "http" and "http.response.zerocopysend" in scope.get("extensions", {})
+        request_headers = Headers(scope=scope)
+        span = self._zerocopy_span(request_headers) if zerocopy and scope["method"] == "GET" else None
+        if span is None:
+            return await super().__call__(scope, receive, send)
+        start, count = span
+        headers = MutableHeaders(raw=list(self.raw_headers))
+        status_code = self.status_code
+        if "range" in request_headers:
+            status_code = 206
+            headers["content-range"] = f"bytes {start}-{start + count - 1}/{self.stat_result.st_size}"
+            headers["content-length"] = str(count)
+        await send({"type": "http.response.start", "status": status_code, "headers": headers.raw})
+        await self._send_zerocopy(send, start, count)
+        if self.background is not None:
+            await self.background()
+
+    def _zerocopy_span(self, headers: Headers) -> Optional[Tuple[int, int]]:
+        """(offset, byte count) to send, or None to leave the request to FileResponse."""
+        if self.stat_result is None or self.status_code != 200:
+            return None
+        size = self.stat_result.st_size
+        http_range = headers.get("range")
+        if http_range is None:
+            return 0, size
+        match = SINGLE_RANGE.fullmatch(http_range.strip())
+        if "if-range" in headers or match is None:
+            return None
+        first, last = match.groups()
+        if not first:
+            # Suffix range: the last N bytes
+            if not last or int(last) == 0:
+                return None
+            start, end = max(0, size - int(last)), size
+        else:
+            start, end = int(first), min(size, int(last) + 1) if last else size
+        if start >= end:
+            # Unsatisfiable; FileResponse answers 416
+            return None
+        return start, end - start
+
+    async def _send_zerocopy(self, send, offset: int, count: int):
+        file = await asyncio.to_thread(open, self.path, "rb")
+        try:
+            await send({"type": "http.response.zerocopysend", "file": file, "offset": offset, "count": count, "more_body": False})
+        finally:
+            await asyncio.to_thread(file.close)
+
+def _etag(name: str, stat_result: os.stat_result) -> str:
+    match = CONTENT_ADDRESSED.fullmatch(name)
+    if match:
+        # The name is the sha256 of the bytes, which makes a strong validator
+        return f'"{match.group(1)}"'
+    return f'"{stat_result.st_mtime_ns:x}-{stat_result.st_size:x}"'
+
+def _not_modified(request: Request, etag: str, stat_result: os.stat_result) -> bool:
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        # Weak comparison, as RFC 9110 requires for If-None-Match
+        return if_none_match.strip() == "*" or any(
+            tag.strip().removeprefix("W/") == etag for tag in if_none_match.split(",")
+        )
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since:
+        try:
+            return int(stat_result.st_mtime) <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
+
+@router.api_route("/{name}", methods=["GET", "HEAD"])
+async def serve_upload(name: str, request: Request):
+    if not SAFE_NAME.fullmatch(name):
+        raise HTTPException(status_code=404, detail="Not Found")
+    path = os.path.join(settings.UPLOAD_DIR, name)
+    try:
+        stat_result = await asyncio.to_thread(os.stat, path)
+    except (FileNotFoundError, NotADirectoryError):
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not stat.S_ISREG(stat_result.st_mode):
+        raise HTTPException(status_code=404, detail="Not Found")
+
+    headers = {"etag": _etag(name, stat_result), "cache-control": IMMUTABLE}
+    if _not_modified(request, headers["etag"], stat_result):
+        headers["last-modified"] = formatdate(stat_result.st_mtime, usegmt=True)
+        return Response(status_code=304, headers=headers)
+    return MediaFileResponse(path, stat_result=stat_result, headers=headers)
@@ -1,35 +1,60 @@
-from fastapi import APIRouter, Depends
+from fastapi import APIRouter, Depends, HTTPException, Query
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy.future import select
 from app.core.database import get_db
 from app.models.user import User
-from app.schemas.user import UserOut, UserUpdate
-from app.core.security import get_current_user
-from typing import List
+from app.schemas.user import UserDirectoryOut, UserOut, UserUpdate
+from app.core.security import Principal, get_current_user, invalidate_principal
+from app.services import user_service
+from typing import List, Optional
 
 router = APIRouter()
 
 @router.get("/me", response_model=UserOut)
-async def get_me(current_user: User = Depends(get_current_user)):
+async def get_me(current_user: Principal = Depends(get_current_user)):
     return current_user
 
 @router.put("/me", response_model=UserOut)
-async def update_profile(user_update: UserUpdate, db: AsyncSession = Depends(get_db), current_user: User = Depends(get_current_user)):
+async def update_profile(user_update: UserUpdate, db: AsyncSession = Depends(get_db), current_user: Principal = Depends(get_current_user)):
+    # current_user is a cached snapshot; change the row itself
+    user = await db.get(User, current_user.user_id)
     if user_update.username is not None:
-        current_user.username = user_update.username
+        user.username = user_update.username
     if user_update.phone_number is not None:
-        current_user.phone_number = user_update.phone_number
+        user.phone_number = user_update.phone_number
     if user_update.status_message is not None:
-        current_user.status_message = user_update.status_message
+        user.status_message = user_update.status_message
     if user_update.avatar_url is not None:
-        current_user.avatar_url = user_update.avatar_url
+        user.avatar_url = user_update.avatar_url
     
-    db.add(current_user)
     await db.commit()
-    await db.refresh(current_user)
-    return current_user
+    await db.refresh(user)
+    invalidate_principal(user.user_id)
+    return user
+
+@router.get("/directory", response_model=UserDirectoryOut)
+async def get_directory(
+    cursor: Optional[str] = None,
+    prefix: Optional[str] = Query(None, max_length=100),
+    limit: int = Query(50, ge=1, le=200),
+    db: AsyncSession = Depends(get_db),
+    current_user: Principal = Depends(get_current_user)
+):
+    # Keyset pages of UserOut columns only; ?prefix= matches the start of the username (or the email, with "@")
+    try:
+        after = int(cursor) if cursor else None
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    rows = await user_service.get_directory(db, current_user.user_id, limit, after=after, prefix=prefix)
+    next_cursor = str(rows[-1]["user_id"]) if len(rows) == limit else None
+    return user_service.users_response(rows, next_cursor=next_cursor)
 
 @router.get("/", response_model=List[UserOut])
-async def get_users(db: AsyncSession = Depends(get_db), current_user: User = Depends(get_current_user)):
-    result = await db.execute(select(User).where(User.user_id != current_user.user_id))
-    return result.scalars().all()
+async def get_users(
+    after: Optional[int] = None,
+    limit: int = Query(50, ge=1, le=200),
+    db: AsyncSession = Depends(get_db),
+    current_user: Principal = Depends(get_current_user)
+):
+    # The first page of the directory as a bare list; pass the last user_id as `after` for more
+    rows = await user_service.get_directory(db, current_user.user_id, limit, after=after)
+    return user_service.users_response(rows)
@@ -1,6 +1,7 @@
-from pydantic import BaseModel
-from typing import Optional, List
+from pydantic import BaseModel, computed_field
+from typing import Dict, Optional, List
 from datetime import datetime
+from app.workers.media import derivative_urls
 
 class ChatCreate(BaseModel):
     is_group: bool = False
@@ -22,9 +23,28 @@ class MessageOut(BaseModel):
     status: str
     created_at: datetime
 
+    @computed_field
+    @property
+    def derivatives(self) -> Optional[Dict[str, str]]:
+        # Thumbnail / waveform URLs for media messages
+        return derivative_urls(self.media_url)
+
     class Config:
         from_attributes = True
 
+class MessageSearchOut(MessageOut):
+    # Relevance, higher is better; only comparable within one result set
+    rank: float
+
+class MessageSyncOut(BaseModel):
+    messages: List[MessageOut]
+    # Every other member has received / read the chat up to these message_ids
+    delivered_up_to: Optional[int] = None
+    read_up_to: Optional[int] = None
+    # Pass back as `since` on the next sync
+    cursor: int
+    has_more: bool
+
 class ChatMemberOut(BaseModel):
     user_id: int
     role: str
@@ -39,7 +59,16 @@ class ChatOut(BaseModel):
     name: Optional[str]
     created_by: int
     created_at: datetime
-    # members: List[ChatMemberOut] # We can add this later if we update routes to use selectinload
+    members: List[ChatMemberOut] = []
 
     class Config:
         from_attributes = True
+
+class InboxChatOut(ChatOut):
+    last_message: Optional[MessageOut] = None
+    unread_count: int = 0
+
+class InboxOut(BaseModel):
+    chats: List[InboxChatOut]
+    # Pass back as `cursor` to get the next page; None on the last page
+    next_cursor: Optional[str] = None
@@ -0,0 +1,15 @@
+from pydantic import BaseModel, Field
+from typing import Optional
+
+class UploadSessionCreate(BaseModel):
+    filename: str
+    size: int = Field(..., ge=0)  # total bytes that will be sent
+    content_type: Optional[str] = None
+
+class UploadSessionOut(BaseModel):
+    upload_id: str
+    filename: Optional[str] = None
+    size: int
+    # Bytes received so far; the next PUT must start here
+    offset: int
+    chunk_size: int
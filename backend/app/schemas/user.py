@@ -1,5 +1,5 @@
 from pydantic import BaseModel, EmailStr
-from typing import Optional
+from typing import List, Optional
 from datetime import datetime
 
 class UserBase(BaseModel):
@@ -30,3 +30,11 @@ class UserOut(UserBase):
 
     class Config:
         from_attributes = True
+
+class FriendSuggestionOut(UserOut):
+    mutual_friends: int
+
+class UserDirectoryOut(BaseModel):
+    users: List[UserOut]
+    # Pass back as `cursor` to get the next page; None on the last page
+    next_cursor: Optional[str] = None
@@ -1,6 +1,14 @@
+from typing import Dict, Iterable, List, Tuple
 from sqlalchemy.ext.asyncio import AsyncSession
-from app.models.chat import Message, ChatMember
+from app.models.chat import Chat, Message, ChatMember, ChatReadState
 from sqlalchemy.future import select
+from sqlalchemy.orm import aliased, selectinload
+from app.core.cache import TTLCache
+from app.core.config import settings
+from app.workers.media import derivative_urls
+
+# chat_id -> tuple of member user_ids
+membership_cache = TTLCache(maxsize=settings.MEMBERSHIP_CACHE_SIZE, ttl=settings.MEMBERSHIP_CACHE_TTL)
 
 async def save_message(db: AsyncSession, chat_id: int, sender_id: int, content: str, msg_type: str = "text", media_url: str = None):
     new_message = Message(chat_id=chat_id, sender_id=sender_id, content=content, msg_type=msg_type, media_url=media_url)
@@ -9,23 +17,122 @@ async def save_message(db: AsyncSession, chat_id: int, sender_id: int, content:
     await db.refresh(new_message)
     return new_message
 
+async def save_messages(db: AsyncSession, rows: List[dict]) -> List[Message]:
+    """Insert many messages in one transaction with a multi-row INSERT ... RETURNING.
+
+    Returns detached ``Message`` objects, in the order of ``rows``, carrying the
+    assigned message_id and created_at.
+    """
+    from sqlalchemy import insert
+    result = await db.execute(
+        insert(Message).returning(Message.message_id, Message.created_at, sort_by_parameter_order=True),
+        rows,
+    )
+    assigned = result.all()
+    await db.commit()
+    return [Message(message_id=message_id, created_at=created_at, **row) for row, (message_id, created_at) in zip(rows, assigned)]
+
+def message_event(message: Message, msg_type: str = None, status: str = "sent") -> dict:
+    """The WebSocket event announcing a new message.
+
+    ``status`` is the receipt status (see ReceiptSummary.status_of); the
+    messages.status column is not kept up to date.
+    """
+    return {
+        "type": msg_type or message.msg_type,
+        "message_id": message.message_id,
+        "chat_id": message.chat_id,
+        "sender_id": message.sender_id,
+        "content": message.content,
+        "media_url": message.media_url,
+        "derivatives": derivative_urls(message.media_url),
+        "status": status,
+        "created_at": message.created_at.isoformat()
+    }
+
 async def get_chat_members(db: AsyncSession, chat_id: int):
-    result = await db.execute(select(ChatMember.user_id).where(ChatMember.chat_id == chat_id))
+    members = membership_cache.get(chat_id)
+    if members is None:
+        result = await db.execute(select(ChatMember.user_id).where(ChatMember.chat_id == chat_id))
+        members = tuple(result.scalars().all())
+        membership_cache.set(chat_id, members)
+    return members
+
+async def get_members_of_chats(db: AsyncSession, chat_ids: Iterable[int]) -> Dict[int, Tuple[int, ...]]:
+    """chat_id -> member user_ids for several chats; cache misses are loaded in one query."""
+    members = {chat_id: membership_cache.get(chat_id) for chat_id in chat_ids}
+    missing = [chat_id for chat_id, cached in members.items() if cached is None]
+    if missing:
+        loaded: Dict[int, list] = {chat_id: [] for chat_id in missing}
+        result = await db.execute(select(ChatMember.chat_id, ChatMember.user_id).where(ChatMember.chat_id.in_(missing)))
+        for chat_id, user_id in result.all():
+            loaded[chat_id].append(user_id)
+        for chat_id, user_ids in loaded.items():
+            members[chat_id] = tuple(user_ids)
+            membership_cache.set(chat_id, members[chat_id])
+    return members
+
+async def get_user_chat_ids(db: AsyncSession, user_id: int) -> List[int]:
+    result = await db.execute(select(ChatMember.chat_id).where(ChatMember.user_id == user_id))
     return result.scalars().all()
 
-async def update_message_status(db: AsyncSession, message_id: int, status: str):
-    from sqlalchemy import update
-    await db.execute(update(Message).where(Message.message_id == message_id).values(status=status))
-    await db.commit()
+def invalidate_chat_members(chat_id: int):
+    membership_cache.invalidate(chat_id)
 
-async def mark_chat_as_read(db: AsyncSession, chat_id: int, user_id: int):
-    from sqlalchemy import update
-    # Mark all messages in this chat NOT from this user as 'read'
-    await db.execute(
-        update(Message)
-        .where(Message.chat_id == chat_id)
-        .where(Message.sender_id != user_id)
-        .where(Message.status != "read")
-        .values(status="read")
+async def get_chat_with_members(db: AsyncSession, chat_id: int):
+    result = await db.execute(
+        select(Chat).options(selectinload(Chat.members)).where(Chat.chat_id == chat_id)
     )
-    await db.commit()
+    return result.scalars().first()
+
+async def get_inbox(db: AsyncSession, user_id: int, limit: int = 30, cursor: tuple = None):
+    """The user's chats by last activity, each with its last message and unread count.
+
+    Chats, last messages and unread counts come back in one statement; members are
+    loaded by one extra selectin query for the whole page. Chats are ordered by their
+    last message_id (newest first), chats without messages last. ``cursor`` is the
+    (activity, chat_id) pair of the last chat on the previous page.
+    """
+    from sqlalchemy import func, or_, and_
+    last_message_id = (
+        select(func.max(Message.message_id))
+        .where(Message.chat_id == Chat.chat_id)
+        .correlate(Chat)
+        .scalar_subquery()
+    )
+    # Unread = messages above the user's read watermark, an index range on (chat_id, message_id)
+    last_read = (
+        select(ChatReadState.last_read_message_id)
+        .where(ChatReadState.chat_id == Chat.chat_id, ChatReadState.user_id == user_id)
+        .correlate(Chat)
+        .scalar_subquery()
+    )
+    unread_count = (
+        select(func.count())
+        .where(
+            Message.chat_id == Chat.chat_id,
+            Message.message_id > func.coalesce(last_read, 0),
+            Message.sender_id != user_id,
+        )
+        .correlate(Chat)
+        .scalar_subquery()
+    )
+    LastMessage = aliased(Message)
+    activity = func.coalesce(LastMessage.message_id, 0)
+
+    stmt = (
+        select(Chat, LastMessage, unread_count.label("unread_count"), activity.label("activity"))
+        .join(ChatMember, (ChatMember.chat_id == Chat.chat_id) & (ChatMember.user_id == user_id))
+        .outerjoin(LastMessage, LastMessage.message_id == last_message_id)
+        .options(selectinload(Chat.members))
+        .order_by(activity.desc(), Chat.chat_id.desc())
+        .limit(limit)
+    )
+    if cursor is not None:
+        last_activity, last_chat_id = cursor
+        stmt = stmt.where(or_(
+            activity < last_activity,
+            and_(activity == last_activity, Chat.chat_id < last_chat_id),
+        ))
+    result = await db.execute(stmt)
+    return result.all()
@@ -0,0 +1,331 @@
+import asyncio
+import bisect
+import logging
+import time
+from collections import deque
+from datetime import datetime, timedelta, timezone
+from typing import Deque, Dict, Iterable, List, Optional, Set, Tuple
+from sqlalchemy import and_, delete, func, or_, update
+from sqlalchemy.future import select
+from app.core import metrics
+from app.core.config import settings
+from app.core.database import SessionLocal, insert_for
+from app.models.chat import Message, PendingDelivery
+from app.services import chat_service, receipt_service
+from app.websocket.manager import Connection, Marker, manager
+from app.websocket.protocol import Frame
+
+logger = logging.getLogger(__name__)
+
+# (message_id, frame, size in bytes, recorded at)
+_Entry = Tuple[int, Frame, int, float]
+
+_memory_events = metrics.registry.register(metrics.Gauge("convo_pending_deliveries_memory_events", "Messages held in memory for offline users."))
+_memory_bytes = metrics.registry.register(metrics.Gauge("convo_pending_deliveries_memory_bytes", "JSON size of the messages held in memory for offline users."))
+_spilled = metrics.registry.register(metrics.Counter("convo_pending_deliveries_spilled_total", "Pending deliveries written to the database."))
+_replayed = metrics.registry.register(metrics.Counter("convo_pending_deliveries_replayed_total", "Missed messages replayed to reconnecting users, by source.", ["source"]))
+
+class PendingDeliveries:
+    """Messages that reached none of a member's sockets, replayed on reconnect.
+
+    A message is first kept in memory. A user's entries go to the
+    ``pending_deliveries`` table when they hold more than
+    OFFLINE_QUEUE_MAX_EVENTS of them, everyone's go when the process holds
+    more than OFFLINE_QUEUE_MAX_BYTES, and any entry older than
+    OFFLINE_QUEUE_SPILL_AFTER goes too. A row holds a run of a chat's
+    messages the user missed with none of the chat's messages in between,
+    so a spill writes one row per user, chat and run however many messages
+    it carries, and a message the user got live (on another worker, say)
+    is never replayed; the messages themselves are already in
+    ``messages``. Stored messages are always older than the entries still
+    in memory. Rows not extended for OFFLINE_RETENTION are purged.
+
+    When a device connects, ``replay`` sends the stored messages (at most
+    the newest OFFLINE_REPLAY_MAX_EVENTS) in chunks of OFFLINE_REPLAY_CHUNK,
+    then the ones in memory, before any live event. Once a chunk is
+    acknowledged (written to the socket, or acked on an ``?acks=1``
+    connection) the ranges are trimmed past it and the chats are marked
+    delivered up to the chunk's last message with one watermark upsert per
+    chat. The cost of a reconnect follows what was missed, not the
+    length of the history.
+
+    Memory is per process. Entries are spilled through
+    ``manager.send_missed`` first, so a user who has since connected to
+    another worker gets them then, ahead of live events; if the user's
+    replay is still pending here they are stored for it instead.
+    """
+
+    def __init__(self, session_factory=SessionLocal, max_events: int = settings.OFFLINE_QUEUE_MAX_EVENTS,
+                 max_bytes: int = settings.OFFLINE_QUEUE_MAX_BYTES, spill_after: float = settings.OFFLINE_QUEUE_SPILL_AFTER,
+                 chunk: int = settings.OFFLINE_REPLAY_CHUNK, max_replay: int = settings.OFFLINE_REPLAY_MAX_EVENTS,
+                 retention: float = settings.OFFLINE_RETENTION):
+        self.session_factory = session_factory
+        self.max_events = max_events
+        self.max_bytes = max_bytes
+        self.spill_after = spill_after
+        self.chunk = chunk
+        self.max_replay = max_replay
+        self.retention = retention
+        self._purged_at: Optional[float] = None
+        self.memory: Dict[int, Deque[_Entry]] = {}
+        self.bytes = 0
+        self.events = 0
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._spilling: Optional[asyncio.Task] = None
+        # user_id -> entries taken out of memory and not yet stored
+        self._spill_queue: Dict[int, List[_Entry]] = {}
+
+    def record(self, user_id: int, frame: Frame):
+        """Keep a message event for a user none of whose sockets got it."""
+        size = len(frame.json())
+        entries = self.memory.setdefault(user_id, deque())
+        entries.append((frame.payload["message_id"], frame, size, time.monotonic()))
+        self._count(1, size)
+        if len(entries) > self.max_events:
+            self._take(user_id)
+        if self.bytes > self.max_bytes:
+            for other_id in list(self.memory):
+                self._take(other_id)
+        self._schedule_spill()
+        self._arm_timer()
+
+    def _arm_timer(self):
+        if self._timer is None and self.memory:
+            self._timer = asyncio.get_running_loop().call_later(self.spill_after, self._spill_expired)
+
+    def _count(self, events: int, size: int):
+        self.events += events
+        self.bytes += size
+        _memory_events.set(self.events)
+        _memory_bytes.set(self.bytes)
+
+    def _take(self, user_id: int, entries: Iterable[_Entry] = None):
+        """Move a user's entries (all of them by default) from memory to the spill queue."""
+        if entries is None:
+            entries = self.memory.pop(user_id, ())
+        entries = list(entries)
+        if entries:
+            self._count(-len(entries), -sum(entry[2] for entry in entries))
+            self._spill_queue.setdefault(user_id, []).extend(entries)
+
+    def _spill_expired(self):
+        self._timer = None
+        cutoff = time.monotonic() - self.spill_after
+        for user_id in list(self.memory):
+            entries = self.memory[user_id]
+            expired = []
+            while entries and entries[0][3] <= cutoff:
+                expired.append(entries.popleft())
+            if not entries:
+                del self.memory[user_id]
+            self._take(user_id, expired)
+        self._schedule_spill()
+        if self.memory:
+            # Next run when the oldest remaining entry expires
+            oldest = min(entries[0][3] for entries in self.memory.values())
+            self._timer = asyncio.get_running_loop().call_later(max(0.0, oldest - cutoff), self._spill_expired)
+
+    def _schedule_spill(self):
+        if self._spill_queue and (self._spilling is None or self._spilling.done()):
+            self._spilling = asyncio.create_task(self._spill())
+
+    async def _spill(self):
+        while self._spill_queue:
+            queued, self._spill_queue = self._spill_queue, {}
+            missed: Dict[Tuple[int, int], Set[int]] = {}
+            stored = 0
+            for user_id, entries in queued.items():
+                # The user may have come back, possibly on another worker
+                if not await manager.send_missed([entry[1] for entry in entries], user_id):
+                    for message_id, frame, _, _ in entries:
+                        missed.setdefault((user_id, frame.payload["chat_id"]), set()).add(message_id)
+                    stored += len(entries)
+            if not missed:
+                continue
+            try:
+                async with self.session_factory() as db:
+                    rows = await _runs(db, missed)
+                    insert, greatest, least = insert_for(db)
+                    stmt = insert(PendingDelivery)
+                    await db.execute(stmt.on_conflict_do_update(
+                        index_elements=[PendingDelivery.user_id, PendingDelivery.chat_id, PendingDelivery.first_message_id],
+                        set_={
+                            "last_message_id": greatest(PendingDelivery.last_message_id, stmt.excluded.last_message_id),
+                            "updated_at": func.now(),
+                        },
+                    ), rows)
+                    await db.commit()
+                _spilled.inc(stored)
+            except Exception:
+                logger.exception("Failed to store %d pending deliveries", stored)
+        await self._purge()
+
+    async def _purge(self):
+        """Delete ranges not written to for longer than the retention, at
+        most once per OFFLINE_PURGE_INTERVAL."""
+        now = time.monotonic()
+        if self._purged_at is not None and now - self._purged_at < settings.OFFLINE_PURGE_INTERVAL:
+            return
+        self._purged_at = now
+        cutoff = datetime.now(timezone.utc) - timedelta(seconds=self.retention)
+        try:
+            async with self.session_factory() as db:
+                await db.execute(delete(PendingDelivery).where(PendingDelivery.updated_at < cutoff))
+                await db.commit()
+        except Exception:
+            logger.exception("Failed to purge expired pending deliveries")
+
+    async def replay(self, connection: Connection, receipts):
+        """Send a newly connected device what its user missed, then release
+        the live events held back meanwhile (see ``Connection``)."""
+        user_id = connection.user_id
+        entries = None
+        try:
+            if self._spilling is not None and not self._spilling.done():
+                # Let rows taken out of memory reach the table first
+                await asyncio.wait({self._spilling})
+            # Nothing of this user's is spilled from here on (they are
+            # reachable now), so these stay newer than the stored messages
+            entries = self.memory.pop(user_id, None)
+            if entries:
+                self._count(-len(entries), -sum(entry[2] for entry in entries))
+
+            last_id = None
+            while True:
+                async with self.session_factory() as db:
+                    if last_id is None:
+                        # Beyond the cap, only the newest stored messages are replayed
+                        oldest = await db.execute(
+                            _stored(user_id, Message.message_id).order_by(Message.message_id.desc()).offset(self.max_replay - 1).limit(1)
+                        )
+                        last_id = (oldest.scalar() or 1) - 1
+                    result = await db.execute(
+                        _stored(user_id, Message).where(Message.message_id > last_id).order_by(Message.message_id).limit(self.chunk)
+                    )
+                    messages = result.scalars().all()
+                    summaries = await receipt_service.get_receipt_summaries(db, {message.chat_id for message in messages})
+                if not messages:
+                    # Ranges left over, if any, hold only deleted messages; the purge takes them
+                    break
+                frames = [
+                    Frame(chat_service.message_event(message, status=summaries[message.chat_id].status_of(message.message_id, message.sender_id)))
+                    for message in messages
+                ]
+                await _sent(connection, frames)
+                last_id = messages[-1].message_id
+                done = len(messages) < self.chunk
+                async with self.session_factory() as db:
+                    if done:
+                        await db.execute(delete(PendingDelivery).where(PendingDelivery.user_id == user_id))
+                    else:
+                        await _trim(db, user_id, last_id)
+                    await db.commit()
+                _replayed.labels("database").inc(len(frames))
+                _mark_delivered(receipts, user_id, frames)
+                if done:
+                    break
+
+            if entries:
+                frames = [entry[1] for entry in entries if entry[0] > last_id]
+                await _sent(connection, frames)
+                entries = None
+                _replayed.labels("memory").inc(len(frames))
+                _mark_delivered(receipts, user_id, frames)
+        except asyncio.CancelledError:
+            # Gone again before the replay was acknowledged; keep them for next time
+            self._restore(user_id, entries)
+            raise
+        except Exception:
+            logger.exception("Failed to replay pending deliveries for user %s", user_id)
+            self._restore(user_id, entries)
+        finally:
+            connection.release()
+
+    def _restore(self, user_id: int, entries: Optional[Deque[_Entry]]):
+        """Put popped entries back in memory, ahead of any recorded since."""
+        if not entries:
+            return
+        entries.extend(self.memory.pop(user_id, ()))
+        self.memory[user_id] = entries
+        self._count(len(entries), sum(entry[2] for entry in entries))
+        self._arm_timer()
+
+    async def close(self):
+        """Store everything still in memory."""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        for user_id in list(self.memory):
+            self._take(user_id)
+        if self._spilling is not None:
+            await self._spilling
+        await self._spill()
+
+async def _runs(db, missed: Dict[Tuple[int, int], Set[int]]) -> List[dict]:
+    """pending_deliveries rows for the message ids each (user, chat) missed:
+    one per run with no other message of the chat in between.
+
+    The chats' messages within the missed span are read in one query, and
+    only for chats where someone missed more than one."""
+    missed = {key: sorted(message_ids) for key, message_ids in missed.items()}
+    spans: Dict[int, Tuple[int, int]] = {}
+    for (_, chat_id), message_ids in missed.items():
+        if len(message_ids) > 1:
+            first, last = spans.get(chat_id, (message_ids[0], message_ids[-1]))
+            spans[chat_id] = (min(first, message_ids[0]), max(last, message_ids[-1]))
+    chat_messages: Dict[int, List[int]] = {}
+    if spans:
+        result = await db.execute(
+            select(Message.chat_id, Message.message_id)
+            .where(or_(*(and_(Message.chat_id == chat_id, Message.message_id.between(first, last)) for chat_id, (first, last) in spans.items())))
+            .order_by(Message.message_id)
+        )
+        for chat_id, message_id in result:
+            chat_messages.setdefault(chat_id, []).append(message_id)
+    rows = []
+    for (user_id, chat_id), message_ids in missed.items():
+        existing = chat_messages.get(chat_id, [])
+        first = message_ids[0]
+        for previous, message_id in zip(message_ids, message_ids[1:]):
+            if bisect.bisect_right(existing, previous) != bisect.bisect_left(existing, message_id):
+                # The user got something in between
+                rows.append({"user_id": user_id, "chat_id": chat_id, "first_message_id": first, "last_message_id": previous})
+                first = message_id
+        rows.append({"user_id": user_id, "chat_id": chat_id, "first_message_id": first, "last_message_id": message_ids[-1]})
+    return rows
+
+def _stored(user_id: int, *columns):
+    """Select ``columns`` of the messages in the user's stored ranges."""
+    return select(*columns).select_from(Message).join(PendingDelivery, and_(
+        PendingDelivery.user_id == user_id,
+        PendingDelivery.chat_id == Message.chat_id,
+        Message.message_id.between(PendingDelivery.first_message_id, PendingDelivery.last_message_id),
+    ))
+
+async def _trim(db, user_id: int, last_id: int):
+    """Drop the user's stored messages up to ``last_id``."""
+    await db.execute(delete(PendingDelivery).where(PendingDelivery.user_id == user_id, PendingDelivery.last_message_id <= last_id))
+    await db.execute(
+        update(PendingDelivery)
+        .where(PendingDelivery.user_id == user_id, PendingDelivery.first_message_id <= last_id)
+        .values(first_message_id=last_id + 1)
+    )
+
+async def _sent(connection: Connection, frames: List[Frame]):
+    """Queue frames ahead of live events and wait until they are acknowledged."""
+    if not frames:
+        return
+    done = asyncio.get_running_loop().create_future()
+    connection.replay([*frames, Marker(lambda: done.done() or done.set_result(None))])
+    await done
+
+def _mark_delivered(receipts, user_id: int, frames: List[Frame]):
+    latest: Dict[int, int] = {}
+    for frame in frames:
+        payload = frame.payload
+        if payload["sender_id"] != user_id:
+            latest[payload["chat_id"]] = max(latest.get(payload["chat_id"], 0), payload["message_id"])
+    for chat_id, message_id in latest.items():
+        receipts.ack(chat_id, "delivered", message_id)
+
+pending_deliveries = PendingDeliveries()
@@ -0,0 +1,231 @@
+"""Content-addressed media storage.
+
+Uploads are streamed to a temporary file in UPLOAD_DIR/.tmp and hashed
+while they are written. Disk writes and sha256 both run in worker threads
+(hashlib releases the GIL for large buffers), so the event loop only moves
+chunks around. Once complete, the file is renamed to ``<sha256><ext>``. If
+that name already exists, the new copy is simply discarded, so a forwarded
+sticker or voice note is stored once however many times it is sent.
+
+Large files can also be uploaded in pieces through resumable upload
+sessions. A session is a ``.part`` file plus a JSON sidecar in
+UPLOAD_DIR/.sessions, so an upload survives restarts and can be resumed
+from whichever offset the server reports.
+"""
+import asyncio
+import hashlib
+import json
+import os
+import re
+import time
+import uuid
+import weakref
+from typing import AsyncIterator, Optional
+from app.core import metrics
+from app.core.config import settings
+from app.workers.media import derivative_urls
+
+class UploadTooLarge(Exception):
+    pass
+
+class UploadOffsetMismatch(Exception):
+    def __init__(self, offset: int):
+        super().__init__(f"Upload is at offset {offset}")
+        self.offset = offset
+
+class UploadSessionNotFound(Exception):
+    pass
+
+def _tmp_dir() -> str:
+    return os.path.join(settings.UPLOAD_DIR, ".tmp")
+
+def _sessions_dir() -> str:
+    return os.path.join(settings.UPLOAD_DIR, ".sessions")
+
+def safe_extension(filename: Optional[str]) -> str:
+    extension = os.path.splitext(filename or "")[1].lower()
+    return extension if re.fullmatch(r"\.[a-z0-9]{1,10}", extension) else ""
+
+def stored_info(name: str, filename: Optional[str], content_type: Optional[str], size: int) -> dict:
+    # "url", "filename" and "type" are what the frontend already reads
+    url = f"/uploads/{name}"
+    return {
+        "url": url,
+        "filename": filename,
+        "type": content_type,
+        "sha256": os.path.splitext(name)[0],
+        "size": size,
+        # Thumbnails / waveform, generated in the background (404 until ready)
+        "derivatives": derivative_urls(url),
+    }
+
+def _store(tmp_path: str, digest: str, extension: str) -> str:
+    name = f"{digest}{extension}"
+    final_path = os.path.join(settings.UPLOAD_DIR, name)
+    if os.path.exists(final_path):
+        # Same bytes are already stored
+        os.remove(tmp_path)
+    else:
+        os.replace(tmp_path, final_path)
+    return name
+
+async def rechunk(chunks: AsyncIterator[bytes], size: int = settings.UPLOAD_CHUNK_SIZE) -> AsyncIterator[bytes]:
+    """Coalesce small network reads so each thread hop moves about ``size`` bytes."""
+    buffer = bytearray()
+    async for chunk in chunks:
+        buffer += chunk
+        if len(buffer) >= size:
+            yield bytes(buffer)
+            buffer.clear()
+    if buffer:
+        yield bytes(buffer)
+
+class BlobWriter:
+    """Streams one upload to disk, hashing as it goes."""
+
+    def __init__(self, max_bytes: int = settings.MAX_UPLOAD_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hasher = hashlib.sha256()
+        self.path = os.path.join(_tmp_dir(), uuid.uuid4().hex)
+        self.file = None
+
+    async def open(self):
+        os.makedirs(_tmp_dir(), exist_ok=True)
+        self.file = await asyncio.to_thread(open, self.path, "wb")
+
+    def _write(self, chunk: bytes):
+        self.hasher.update(chunk)
+        self.file.write(chunk)
+
+    async def write(self, chunk: bytes):
+        self.size += len(chunk)
+        metrics.upload_bytes.inc(len(chunk))
+        if self.size > self.max_bytes:
+            raise UploadTooLarge()
+        await asyncio.to_thread(self._write, chunk)
+
+    async def commit(self, extension: str) -> str:
+        """Close the file and move it to its content address; returns the stored name."""
+        await asyncio.to_thread(self.file.close)
+        return await asyncio.to_thread(_store, self.path, self.hasher.hexdigest(), extension)
+
+    async def discard(self):
+        def _discard():
+            if self.file is not None:
+                self.file.close()
+            if os.path.exists(self.path):
+                os.remove(self.path)
+        await asyncio.to_thread(_discard)
+
+async def store_stream(chunks: AsyncIterator[bytes], filename: Optional[str], max_bytes: int = settings.MAX_UPLOAD_BYTES):
+    """Store an upload from an async chunk iterator. Returns (stored name, size)."""
+    writer = BlobWriter(max_bytes)
+    await writer.open()
+    try:
+        async for chunk in rechunk(chunks):
+            await writer.write(chunk)
+        return await writer.commit(safe_extension(filename)), writer.size
+    except BaseException:
+        await writer.discard()
+        raise
+
+# --- Resumable uploads ---
+
+# upload_id -> lock serializing its appends; an entry lives only while a
+# request holds or waits for it, so abandoned and purged sessions leave none
+_session_locks: "weakref.WeakValueDictionary[str, asyncio.Lock]" = weakref.WeakValueDictionary()
+
+def _session_paths(upload_id: str):
+    if not re.fullmatch(r"[0-9a-f]{32}", upload_id):
+        raise UploadSessionNotFound()
+    base = os.path.join(_sessions_dir(), upload_id)
+    return base + ".json", base + ".part"
+
+def _load_session(upload_id: str, user_id: int) -> dict:
+    meta_path, part_path = _session_paths(upload_id)
+    try:
+        with open(meta_path) as f:
+            session = json.load(f)
+    except FileNotFoundError:
+        raise UploadSessionNotFound()
+    if session["user_id"] != user_id:
+        raise UploadSessionNotFound()
+    session["offset"] = os.path.getsize(part_path)
+    return session
+
+def _purge_expired_sessions():
+    directory = _sessions_dir()
+    cutoff = time.time() - settings.UPLOAD_SESSION_TTL
+    for entry in os.scandir(directory):
+        # The .part file's mtime is the last time a chunk arrived
+        if entry.name.endswith(".part") and entry.stat().st_mtime < cutoff:
+            for path in (entry.path, entry.path[:-5] + ".json"):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+async def create_session(user_id: int, filename: Optional[str], size: int, content_type: Optional[str]) -> dict:
+    if size > settings.MAX_UPLOAD_BYTES:
+        raise UploadTooLarge()
+    upload_id = uuid.uuid4().hex
+    session = {"upload_id": upload_id, "user_id": user_id, "filename": filename, "size": size, "type": content_type}
+
+    def _create():
+        os.makedirs(_sessions_dir(), exist_ok=True)
+        _purge_expired_sessions()
+        meta_path, part_path = _session_paths(upload_id)
+        open(part_path, "wb").close()
+        with open(meta_path, "w") as f:
+            json.dump(session, f)
+
+    await asyncio.to_thread(_create)
+    return {**session, "offset": 0}
+
+async def get_session(upload_id: str, user_id: int) -> dict:
+    return await asyncio.to_thread(_load_session, upload_id, user_id)
+
+async def append_chunk(upload_id: str, user_id: int, offset: int, chunks: AsyncIterator[bytes]) -> dict:
+    """Append a streamed chunk at ``offset``, which must equal the bytes received so far."""
+    await get_session(upload_id, user_id)
+    lock = _session_locks.setdefault(upload_id, asyncio.Lock())
+    async with lock:
+        session = await get_session(upload_id, user_id)
+        if offset != session["offset"]:
+            raise UploadOffsetMismatch(session["offset"])
+        _, part_path = _session_paths(upload_id)
+        file = await asyncio.to_thread(open, part_path, "ab")
+        try:
+            async for chunk in rechunk(chunks):
+                if session["offset"] + len(chunk) > session["size"]:
+                    raise UploadTooLarge()
+                await asyncio.to_thread(file.write, chunk)
+                session["offset"] += len(chunk)
+                metrics.upload_bytes.inc(len(chunk))
+        finally:
+            # An interrupted chunk keeps what was written; the client resumes from the new offset
+            await asyncio.to_thread(file.close)
+        return session
+
+async def complete_session(upload_id: str, user_id: int) -> dict:
+    """Hash the assembled file and move it into content-addressed storage."""
+    await get_session(upload_id, user_id)
+    lock = _session_locks.setdefault(upload_id, asyncio.Lock())
+    async with lock:
+        session = await get_session(upload_id, user_id)
+        if session["offset"] != session["size"]:
+            raise UploadOffsetMismatch(session["offset"])
+        meta_path, part_path = _session_paths(upload_id)
+
+        def _finish():
+            hasher = hashlib.sha256()
+            with open(part_path, "rb") as f:
+                for block in iter(lambda: f.read(settings.UPLOAD_CHUNK_SIZE), b""):
+                    hasher.update(block)
+            name = _store(part_path, hasher.hexdigest(), safe_extension(session["filename"]))
+            os.remove(meta_path)
+            return name
+
+        name = await asyncio.to_thread(_finish)
+    return stored_info(name, session["filename"], session["type"], session["size"])
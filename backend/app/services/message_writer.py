@@ -0,0 +1,77 @@
+import asyncio
+import logging
+from typing import List, Optional, Tuple
+from app.core.config import settings
+from app.core.database import SessionLocal
+from app.services import chat_service
+
+logger = logging.getLogger(__name__)
+
+class MessageBatchWriter:
+    """Write-behind persistence for chat messages.
+
+    ``submit`` queues a row and returns a future. Rows are flushed with one
+    multi-row ``INSERT ... RETURNING`` once ``max_batch`` rows are waiting or
+    ``max_delay`` seconds after the first one arrived, and each future then
+    resolves to a detached ``Message`` carrying the assigned message_id and
+    created_at. If the batch insert fails its rows are written one by one,
+    so only the futures of the rows that fail on their own are rejected.
+    """
+
+    def __init__(self, session_factory=SessionLocal, max_batch: int = settings.MESSAGE_BATCH_SIZE,
+                 max_delay: float = settings.MESSAGE_BATCH_WINDOW_MS / 1000):
+        self.session_factory = session_factory
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.pending: List[Tuple[dict, asyncio.Future]] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._flushes: set = set()
+
+    def submit(self, chat_id: int, sender_id: int, content: str, msg_type: str = "text", media_url: str = None) -> asyncio.Future:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        row = {"chat_id": chat_id, "sender_id": sender_id, "content": content, "msg_type": msg_type, "media_url": media_url, "status": "sent"}
+        self.pending.append((row, future))
+        if len(self.pending) >= self.max_batch:
+            self._start_flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.max_delay, self._start_flush)
+        return future
+
+    def _start_flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self.pending:
+            return
+        batch, self.pending = self.pending, []
+        task = asyncio.create_task(self._flush(batch))
+        self._flushes.add(task)
+        task.add_done_callback(self._flushes.discard)
+
+    async def _flush(self, batch: List[Tuple[dict, asyncio.Future]]):
+        try:
+            async with self.session_factory() as db:
+                saved = await chat_service.save_messages(db, [row for row, _ in batch])
+        except Exception as exc:
+            if len(batch) > 1:
+                logger.warning("Failed to persist a batch of %d messages; writing them one by one", len(batch), exc_info=True)
+                for entry in batch:
+                    await self._flush([entry])
+                return
+            logger.exception("Failed to persist a message for chat %s", batch[0][0]["chat_id"])
+            future = batch[0][1]
+            if not future.done():
+                future.set_exception(exc)
+            return
+        for (_, future), message in zip(batch, saved):
+            if not future.done():
+                future.set_result(message)
+
+    async def close(self):
+        """Flush whatever is still queued and wait for in-flight batches."""
+        self._start_flush()
+        if self._flushes:
+            await asyncio.gather(*self._flushes, return_exceptions=True)
+
+message_writer = MessageBatchWriter()
@@ -0,0 +1,190 @@
+import asyncio
+import logging
+from datetime import datetime, timezone
+from typing import Dict, FrozenSet, Iterable, List, Optional, Set, Tuple, Union
+from sqlalchemy import update
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+from app.core.cache import TTLCache
+from app.core.config import settings
+from app.core.database import SessionLocal
+from app.core.security import invalidate_principal
+from app.models.chat import ChatMember
+from app.models.user import User
+from app.services.social_service import get_friend_ids
+from app.websocket.manager import manager
+from app.websocket.protocol import Frame
+
+logger = logging.getLogger(__name__)
+
+# user_id -> frozenset of users who may see that user's presence
+contacts_cache = TTLCache(maxsize=settings.PRESENCE_CONTACTS_CACHE_SIZE, ttl=settings.PRESENCE_CONTACTS_CACHE_TTL)
+
+async def get_contacts(db: AsyncSession, user_id: int) -> FrozenSet[int]:
+    """Users who share a chat or a friendship with ``user_id``."""
+    contacts = contacts_cache.get(user_id)
+    if contacts is None:
+        my_chats = select(ChatMember.chat_id).where(ChatMember.user_id == user_id)
+        result = await db.execute(select(ChatMember.user_id).where(ChatMember.chat_id.in_(my_chats)).distinct())
+        contacts = (frozenset(result.scalars().all()) | await get_friend_ids(db, user_id)) - {user_id}
+        contacts_cache.set(user_id, contacts)
+    return contacts
+
+def invalidate_contacts(user_ids: Iterable[int]):
+    for user_id in user_ids:
+        contacts_cache.invalidate(user_id)
+
+def _entry(user_id: int, online: bool, last_seen: Optional[datetime]) -> dict:
+    return {
+        "user_id": user_id,
+        "status": "online" if online else "offline",
+        "last_seen": last_seen.isoformat() if last_seen else None,
+    }
+
+class PresenceTracker:
+    """Online state of the users connected to this process.
+
+    A user is online while at least one of their devices is connected.
+    The last device disconnecting only starts a grace period
+    (PRESENCE_OFFLINE_GRACE); reconnecting within it is not a change at all.
+    Changes are collected and every PRESENCE_BROADCAST_INTERVAL_MS they are
+    written to ``users`` with one bulk UPDATE and sent as one "presence"
+    frame per interested user (those sharing a chat or a friendship).
+
+    Devices are also counted on the backplane, across workers and nodes:
+    when the grace period ends the user only goes offline if no other node
+    holds a socket for them either. Otherwise this node just forgets them;
+    the node holding their last device announces it.
+    """
+
+    def __init__(self, session_factory=SessionLocal, interval: float = settings.PRESENCE_BROADCAST_INTERVAL_MS / 1000,
+                 grace: float = settings.PRESENCE_OFFLINE_GRACE):
+        self.session_factory = session_factory
+        self.interval = interval
+        self.grace = grace
+        self.devices: Dict[int, int] = {}
+        self.online: Set[int] = set()
+        # A grace timer, then the task asking the backplane about other nodes
+        self._offline_timers: Dict[int, Union[asyncio.TimerHandle, asyncio.Task]] = {}
+        # user_id -> (online, when); only the latest change per interval is kept
+        self.changes: Dict[int, Tuple[bool, datetime]] = {}
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._flushing: Optional[asyncio.Task] = None
+
+    async def connected(self, user_id: int):
+        self.devices[user_id] = self.devices.get(user_id, 0) + 1
+        timer = self._offline_timers.pop(user_id, None)
+        if timer is not None:
+            # Came back within the grace period
+            timer.cancel()
+        if user_id not in self.online:
+            self.online.add(user_id)
+            self._record(user_id, True)
+        await self._count_devices(user_id, 1)
+
+    async def disconnected(self, user_id: int):
+        count = self.devices.get(user_id, 0) - 1
+        if count > 0:
+            self.devices[user_id] = count
+        else:
+            self.devices.pop(user_id, None)
+            if user_id in self.online and user_id not in self._offline_timers:
+                self._offline_timers[user_id] = asyncio.get_running_loop().call_later(self.grace, self._went_offline, user_id)
+        await self._count_devices(user_id, -1)
+
+    def _went_offline(self, user_id: int):
+        self._offline_timers[user_id] = asyncio.create_task(self._confirm_offline(user_id))
+
+    async def _confirm_offline(self, user_id: int):
+        # Cancelled by connected() if a device comes back meanwhile
+        elsewhere = await self._count_devices(user_id, 0)
+        self._offline_timers.pop(user_id, None)
+        if self.devices.get(user_id):
+            return
+        self.online.discard(user_id)
+        if not elsewhere:
+            self._record(user_id, False)
+
+    async def _count_devices(self, user_id: int, delta: int) -> int:
+        """Apply ``delta`` to the backplane's count of the user's sockets and
+        return their sockets on all nodes. Falls back to this node's count
+        without a backplane, or if it cannot be reached."""
+        if manager.backplane is not None:
+            try:
+                return await manager.backplane.add_devices(user_id, delta)
+            except Exception as exc:
+                logger.warning("Failed to count devices of user %s: %s", user_id, exc)
+        return self.devices.get(user_id, 0)
+
+    def _record(self, user_id: int, online: bool):
+        self.changes[user_id] = (online, datetime.now(timezone.utc))
+        if self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.interval, self._schedule_flush)
+
+    def _schedule_flush(self):
+        self._timer = None
+        if self._flushing is None or self._flushing.done():
+            self._flushing = asyncio.create_task(self.flush())
+        else:
+            # A flush is still running; try again after another interval
+            self._timer = asyncio.get_running_loop().call_later(self.interval, self._schedule_flush)
+
+    async def flush(self):
+        if not self.changes:
+            return
+        changes, self.changes = self.changes, {}
+        try:
+            async with self.session_factory() as db:
+                await db.execute(update(User), [
+                    {"user_id": user_id, "is_online": online, "last_seen": at}
+                    for user_id, (online, at) in changes.items()
+                ])
+                await db.commit()
+                frames: Dict[int, List[dict]] = {}
+                for user_id, (online, at) in changes.items():
+                    invalidate_principal(user_id)
+                    entry = _entry(user_id, online, at)
+                    for contact_id in await get_contacts(db, user_id):
+                        frames.setdefault(contact_id, []).append(entry)
+        except Exception:
+            logger.exception("Failed to flush %d presence changes", len(changes))
+            return
+        for contact_id, entries in frames.items():
+            await manager.send_personal_message(Frame({"type": "presence", "changes": entries}), contact_id, kind="presence")
+
+    async def snapshot(self, db: AsyncSession, user_id: int) -> List[dict]:
+        """Presence of the user's contacts, for a newly connected device."""
+        contacts = await get_contacts(db, user_id)
+        if not contacts:
+            return []
+        result = await db.execute(
+            select(User.user_id, User.is_online, User.last_seen).where(User.user_id.in_(contacts))
+        )
+        entries = []
+        for contact_id, is_online, last_seen in result.all():
+            # Local state is fresher than the last flush
+            if contact_id in self.changes:
+                is_online, last_seen = self.changes[contact_id]
+            entries.append(_entry(contact_id, is_online, last_seen))
+        return entries
+
+    async def close(self):
+        """Mark everyone connected here, and nowhere else, offline and write
+        the last changes."""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        for timer in self._offline_timers.values():
+            timer.cancel()
+        self._offline_timers.clear()
+        devices, self.devices = self.devices, {}
+        now = datetime.now(timezone.utc)
+        for user_id in self.online:
+            if not await self._count_devices(user_id, -devices.get(user_id, 0)):
+                self.changes[user_id] = (False, now)
+        self.online.clear()
+        if self._flushing is not None:
+            await self._flushing
+        await self.flush()
+
+presence = PresenceTracker()
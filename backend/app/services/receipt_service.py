@@ -0,0 +1,198 @@
+import asyncio
+import logging
+from typing import Dict, Iterable, List, Optional, Tuple
+from sqlalchemy import func
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+from app.core.config import settings
+from app.core.database import SessionLocal, insert_for
+from app.models.chat import ChatReadState, Message
+from app.services import chat_service
+from app.websocket.manager import manager
+from app.websocket.protocol import Frame
+
+logger = logging.getLogger(__name__)
+
+async def advance_watermarks(db: AsyncSession, user_id: int, marks: Dict[int, Tuple[Optional[int], Optional[int]]]) -> List[tuple]:
+    """Move the user's (delivered, read) watermarks forward, never back.
+
+    ``marks`` maps chat_id to (delivered_id, read_id); None means "latest message in
+    the chat" and 0 leaves that watermark alone. Ids past the chat's latest message
+    are clamped to it. Each chat is one upsert. Returns the stored
+    (chat_id, last_delivered_message_id, last_read_message_id) rows.
+    """
+    insert, greatest, least = insert_for(db)
+    stored = []
+    for chat_id, (delivered, read) in marks.items():
+        latest = (
+            select(func.coalesce(func.max(Message.message_id), 0))
+            .where(Message.chat_id == chat_id)
+            .scalar_subquery()
+        )
+        read_value = latest if read is None else least(read, latest)
+        delivered_value = latest if delivered is None else least(delivered, latest)
+        # Reading implies delivery
+        delivered_value = greatest(delivered_value, read_value)
+
+        stmt = insert(ChatReadState).values(
+            chat_id=chat_id,
+            user_id=user_id,
+            last_read_message_id=read_value,
+            last_delivered_message_id=delivered_value,
+        )
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[ChatReadState.chat_id, ChatReadState.user_id],
+            set_={
+                "last_read_message_id": greatest(ChatReadState.last_read_message_id, stmt.excluded.last_read_message_id),
+                "last_delivered_message_id": greatest(ChatReadState.last_delivered_message_id, stmt.excluded.last_delivered_message_id),
+                "updated_at": func.now(),
+            },
+        ).returning(ChatReadState.chat_id, ChatReadState.last_delivered_message_id, ChatReadState.last_read_message_id)
+        result = await db.execute(stmt)
+        stored.append(tuple(result.one()))
+    await db.commit()
+    return stored
+
+async def get_read_states(db: AsyncSession, chat_id: int) -> Dict[int, Tuple[int, int]]:
+    """user_id -> (last_delivered_message_id, last_read_message_id) for the chat."""
+    result = await db.execute(
+        select(ChatReadState.user_id, ChatReadState.last_delivered_message_id, ChatReadState.last_read_message_id)
+        .where(ChatReadState.chat_id == chat_id)
+    )
+    return {user_id: (delivered, read) for user_id, delivered, read in result.all()}
+
+class ReceiptSummary:
+    """Answers "has everyone except the sender got / read message N?" for one chat.
+
+    Keeps only the two lowest watermarks of each kind, so excluding the sender is O(1).
+    Members without a state row count as 0.
+    """
+
+    def __init__(self, members: Iterable[int], states: Dict[int, Tuple[int, int]]):
+        delivered = sorted((states.get(uid, (0, 0))[0], uid) for uid in members)
+        read = sorted((states.get(uid, (0, 0))[1], uid) for uid in members)
+        self.delivered = delivered[:2]
+        self.read = read[:2]
+
+    @staticmethod
+    def _min_excluding(lowest, user_id) -> Optional[int]:
+        for value, uid in lowest:
+            if uid != user_id:
+                return value
+        return None
+
+    def delivered_up_to(self, exclude_user: int = None) -> Optional[int]:
+        return self._min_excluding(self.delivered, exclude_user)
+
+    def read_up_to(self, exclude_user: int = None) -> Optional[int]:
+        return self._min_excluding(self.read, exclude_user)
+
+    def status_of(self, message_id: int, sender_id: int) -> str:
+        read = self.read_up_to(sender_id)
+        if read is not None and message_id <= read:
+            return "read"
+        delivered = self.delivered_up_to(sender_id)
+        if delivered is not None and message_id <= delivered:
+            return "delivered"
+        return "sent"
+
+async def get_receipt_summary(db: AsyncSession, chat_id: int) -> ReceiptSummary:
+    members = await chat_service.get_chat_members(db, chat_id)
+    states = await get_read_states(db, chat_id)
+    return ReceiptSummary(members, states)
+
+async def get_receipt_summaries(db: AsyncSession, chat_ids: Iterable[int],
+                                members: Optional[Dict[int, Iterable[int]]] = None) -> Dict[int, ReceiptSummary]:
+    """chat_id -> ReceiptSummary, with the read states of all chats in one query.
+
+    ``members`` (chat_id -> user_ids) may be passed when the caller already
+    has them; the members of the other chats are loaded in one query.
+    """
+    states: Dict[int, Dict[int, Tuple[int, int]]] = {chat_id: {} for chat_id in chat_ids}
+    if not states:
+        return {}
+    result = await db.execute(
+        select(ChatReadState.chat_id, ChatReadState.user_id, ChatReadState.last_delivered_message_id, ChatReadState.last_read_message_id)
+        .where(ChatReadState.chat_id.in_(list(states)))
+    )
+    for chat_id, user_id, delivered, read in result.all():
+        states[chat_id][user_id] = (delivered, read)
+    members = dict(members or {})
+    members.update(await chat_service.get_members_of_chats(db, [chat_id for chat_id in states if chat_id not in members]))
+    return {chat_id: ReceiptSummary(members[chat_id], chat_states) for chat_id, chat_states in states.items()}
+
+def _is_id(value) -> bool:
+    # bool is an int subclass
+    return type(value) is int and value > 0
+
+class ReceiptBuffer:
+    """Coalesces one connection's read/delivered acks.
+
+    Acks only update an in-memory watermark per chat; every
+    RECEIPT_FLUSH_INTERVAL_MS the highest ones are written with one upsert
+    per chat and announced to the chat members.
+    """
+
+    def __init__(self, user_id: int, interval: float = settings.RECEIPT_FLUSH_INTERVAL_MS / 1000):
+        self.user_id = user_id
+        self.interval = interval
+        # chat_id -> [delivered, read]; None = latest message, 0 = no ack of that kind
+        self.pending: Dict[int, list] = {}
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._flushing: Optional[asyncio.Task] = None
+
+    def ack(self, chat_id: int, kind: str, message_id: Optional[int] = None):
+        if not _is_id(chat_id) or not (message_id is None or _is_id(message_id)):
+            # Malformed client ack; ignored
+            return
+        index = 1 if kind == "read" else 0
+        entry = self.pending.setdefault(chat_id, [0, 0])
+        if message_id is None or entry[index] is None:
+            entry[index] = None
+        else:
+            entry[index] = max(entry[index], message_id)
+        if self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.interval, self._schedule_flush)
+
+    def _schedule_flush(self):
+        self._timer = None
+        if self._flushing is None or self._flushing.done():
+            self._flushing = asyncio.create_task(self.flush())
+        else:
+            # A flush is still running; try again after another interval
+            self._timer = asyncio.get_running_loop().call_later(self.interval, self._schedule_flush)
+
+    async def flush(self):
+        if not self.pending:
+            return
+        pending, self.pending = self.pending, {}
+        try:
+            async with SessionLocal() as db:
+                marks, members = {}, {}
+                for chat_id, (delivered, read) in pending.items():
+                    members[chat_id] = await chat_service.get_chat_members(db, chat_id)
+                    if self.user_id in members[chat_id]:
+                        marks[chat_id] = (delivered, read)
+                stored = await advance_watermarks(db, self.user_id, marks)
+                for chat_id, delivered_id, read_id in stored:
+                    acked_delivered, acked_read = pending[chat_id]
+                    for kind, acked, message_id in (("delivered", acked_delivered, delivered_id), ("read", acked_read, read_id)):
+                        if acked == 0:
+                            continue
+                        payload = Frame({
+                            "type": kind,
+                            "chat_id": chat_id,
+                            "user_id": self.user_id,
+                            "message_id": message_id,
+                        })
+                        await manager.send_to_chat(chat_id, payload, members[chat_id], kind=kind)
+        except Exception:
+            logger.exception("Failed to flush receipts for user %s", self.user_id)
+
+    async def close(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._flushing is not None:
+            await self._flushing
+        await self.flush()
@@ -0,0 +1,215 @@
+"""Full-text search over messages and users.
+
+SQLite (aiosqlite) uses FTS5 tables with external content (messages_fts,
+users_fts). Postgres (asyncpg) uses a generated tsvector column with a GIN
+index on messages and trigram indexes on users. Both kinds of index are
+updated by the database itself as part of the same INSERT/UPDATE. That
+covers save_message, the batch writer and profile edits, so nothing has to
+remember to index.
+
+Bulk rebuild, e.g. after importing data behind the app's back:
+
+    python -m app.services.search_service reindex
+"""
+import re
+from typing import List, Optional
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.core.config import settings
+from app.models.user import User
+from app.services.user_service import USER_OUT_COLUMNS, USER_OUT_SQL, select_users_out
+
+SQLITE_SCHEMA = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+        content, content='messages', content_rowid='message_id', tokenize='unicode61 remove_diacritics 2'
+    )""",
+    """CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN
+        INSERT INTO messages_fts(rowid, content) VALUES (new.message_id, new.content);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages BEGIN
+        INSERT INTO messages_fts(messages_fts, rowid, content) VALUES ('delete', old.message_id, old.content);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS messages_fts_update AFTER UPDATE OF content ON messages BEGIN
+        INSERT INTO messages_fts(messages_fts, rowid, content) VALUES ('delete', old.message_id, old.content);
+        INSERT INTO messages_fts(rowid, content) VALUES (new.message_id, new.content);
+    END""",
+    """CREATE VIRTUAL TABLE IF NOT EXISTS users_fts USING fts5(
+        username, email, content='users', content_rowid='user_id', tokenize='unicode61 remove_diacritics 2'
+    )""",
+    """CREATE TRIGGER IF NOT EXISTS users_fts_insert AFTER INSERT ON users BEGIN
+        INSERT INTO users_fts(rowid, username, email) VALUES (new.user_id, new.username, new.email);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS users_fts_delete AFTER DELETE ON users BEGIN
+        INSERT INTO users_fts(users_fts, rowid, username, email) VALUES ('delete', old.user_id, old.username, old.email);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS users_fts_update AFTER UPDATE OF username, email ON users BEGIN
+        INSERT INTO users_fts(users_fts, rowid, username, email) VALUES ('delete', old.user_id, old.username, old.email);
+        INSERT INTO users_fts(rowid, username, email) VALUES (new.user_id, new.username, new.email);
+    END""",
+]
+
+POSTGRES_SCHEMA = [
+    """ALTER TABLE messages ADD COLUMN IF NOT EXISTS search_vector tsvector
+        GENERATED ALWAYS AS (to_tsvector('simple', coalesce(content, ''))) STORED""",
+    "CREATE INDEX IF NOT EXISTS ix_messages_search_vector ON messages USING GIN (search_vector)",
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    "CREATE INDEX IF NOT EXISTS ix_users_username_trgm ON users USING GIN (lower(username) gin_trgm_ops)",
+    "CREATE INDEX IF NOT EXISTS ix_users_email_trgm ON users USING GIN (lower(email) gin_trgm_ops)",
+]
+
+# Tables, columns and indexes above live outside the SQLAlchemy models
+SEARCH_OBJECTS = {
+    "messages_fts", "users_fts", "search_vector",
+    "ix_messages_search_vector", "ix_users_username_trgm", "ix_users_email_trgm",
+}
+
+def schema_statements(dialect: str) -> List[str]:
+    if dialect == "sqlite":
+        return SQLITE_SCHEMA
+    if dialect == "postgresql":
+        return POSTGRES_SCHEMA
+    return []
+
+def ensure_search_schema(connection):
+    """Create the search tables/indexes if missing. Sync; use with ``run_sync``."""
+    for statement in schema_statements(connection.dialect.name):
+        connection.exec_driver_sql(statement)
+
+def _terms(query: str) -> List[str]:
+    return re.findall(r"\w+", query.lower())
+
+def _fts5_query(terms: List[str]) -> str:
+    # Every term must match, the last one as a prefix (search-as-you-type)
+    quoted = ['"%s"' % term.replace('"', '""') for term in terms]
+    quoted[-1] += "*"
+    return " ".join(quoted)
+
+def _tsquery(terms: List[str]) -> str:
+    return " & ".join(terms[:-1] + [terms[-1] + ":*"])
+
+async def search_messages(db: AsyncSession, user_id: int, query: str, limit: int = 20, offset: int = 0, chat_id: Optional[int] = None):
+    """Messages matching ``query`` in chats the user belongs to, best match first.
+
+    Returns row mappings with the message columns except status (see
+    ReceiptSummary.status_of) plus ``rank`` (higher is better).
+    Only the newest ``SEARCH_RANK_WINDOW`` matches are ranked.
+    """
+    terms = _terms(query)
+    if not terms:
+        return []
+    params = {"user_id": user_id, "limit": limit, "offset": offset, "chat_id": chat_id, "window": settings.SEARCH_RANK_WINDOW}
+    chat_filter = "AND m.chat_id = :chat_id" if chat_id is not None else ""
+    columns = "m.message_id, m.chat_id, m.sender_id, m.content, m.media_url, m.msg_type, m.created_at"
+    dialect = db.bind.dialect.name
+
+    if dialect == "sqlite":
+        params["q"] = _fts5_query(terms)
+        sql = f"""
+            WITH hits AS (
+                SELECT messages_fts.rowid AS message_id, bm25(messages_fts) AS score
+                FROM messages_fts
+                JOIN messages m ON m.message_id = messages_fts.rowid
+                JOIN chat_members cm ON cm.chat_id = m.chat_id AND cm.user_id = :user_id
+                WHERE messages_fts MATCH :q {chat_filter}
+                ORDER BY messages_fts.rowid DESC
+                LIMIT :window
+            )
+            SELECT {columns}, -hits.score AS rank
+            FROM hits JOIN messages m ON m.message_id = hits.message_id
+            ORDER BY hits.score, m.message_id DESC
+            LIMIT :limit OFFSET :offset
+        """
+    elif dialect == "postgresql":
+        params["q"] = _tsquery(terms)
+        sql = f"""
+            WITH hits AS (
+                SELECT m.message_id FROM messages m
+                JOIN chat_members cm ON cm.chat_id = m.chat_id AND cm.user_id = :user_id
+                WHERE m.search_vector @@ to_tsquery('simple', :q) {chat_filter}
+                ORDER BY m.message_id DESC
+                LIMIT :window
+            )
+            SELECT {columns}, ts_rank_cd(m.search_vector, to_tsquery('simple', :q)) AS rank
+            FROM hits JOIN messages m ON m.message_id = hits.message_id
+            ORDER BY rank DESC, m.message_id DESC
+            LIMIT :limit OFFSET :offset
+        """
+    else:
+        params["q"] = f"%{query}%"
+        sql = f"""
+            SELECT {columns}, 0.0 AS rank
+            FROM messages m
+            JOIN chat_members cm ON cm.chat_id = m.chat_id AND cm.user_id = :user_id
+            WHERE m.content LIKE :q {chat_filter}
+            ORDER BY m.message_id DESC
+            LIMIT :limit OFFSET :offset
+        """
+    result = await db.execute(text(sql), params)
+    return result.mappings().all()
+
+async def search_users(db: AsyncSession, query: str, exclude_user_id: int, limit: int = 20):
+    """Users whose username or email matches ``query``, best match first."""
+    terms = _terms(query)
+    if not terms:
+        return []
+    dialect = db.bind.dialect.name
+
+    # The raw statements are typed with USER_OUT_COLUMNS, so rows come back
+    # like select_users_out() rows (bools and datetimes, not 0 and strings)
+    if dialect == "sqlite":
+        stmt = text(f"""
+            SELECT {USER_OUT_SQL} FROM users_fts
+            JOIN users ON users.user_id = users_fts.rowid
+            WHERE users_fts MATCH :q AND users.user_id != :user_id
+            ORDER BY bm25(users_fts)
+            LIMIT :limit
+        """).bindparams(q=_fts5_query(terms), user_id=exclude_user_id, limit=limit).columns(*USER_OUT_COLUMNS)
+    elif dialect == "postgresql":
+        # LIKE '%q%' on lower(...) is served by the trigram GIN indexes
+        stmt = text(f"""
+            SELECT {USER_OUT_SQL} FROM users
+            WHERE users.user_id != :user_id
+              AND (lower(users.username) LIKE :pattern OR lower(users.email) LIKE :pattern)
+            ORDER BY greatest(similarity(lower(users.username), :q), similarity(lower(users.email), :q)) DESC
+            LIMIT :limit
+        """).bindparams(q=query.lower(), pattern=f"%{query.lower()}%", user_id=exclude_user_id, limit=limit).columns(*USER_OUT_COLUMNS)
+    else:
+        result = await db.execute(
+            select_users_out()
+            .where(User.user_id != exclude_user_id)
+            .where(User.email.ilike(f"%{query}%") | User.username.ilike(f"%{query}%"))
+            .limit(limit)
+        )
+        return result.mappings().all()
+
+    result = await db.execute(stmt)
+    return result.mappings().all()
+
+async def reindex(connection):
+    """Rebuild the search indexes from the base tables."""
+    dialect = connection.dialect.name
+    await connection.run_sync(ensure_search_schema)
+    if dialect == "sqlite":
+        await connection.exec_driver_sql("INSERT INTO messages_fts(messages_fts) VALUES ('rebuild')")
+        await connection.exec_driver_sql("INSERT INTO users_fts(users_fts) VALUES ('rebuild')")
+    elif dialect == "postgresql":
+        # search_vector is generated, so only the indexes need rebuilding
+        for index in ("ix_messages_search_vector", "ix_users_username_trgm", "ix_users_email_trgm"):
+            await connection.exec_driver_sql(f"REINDEX INDEX {index}")
+
+async def _main(argv):
+    import argparse
+    from app.core.database import engine
+
+    parser = argparse.ArgumentParser(prog="python -m app.services.search_service")
+    parser.add_argument("command", choices=["reindex"])
+    parser.parse_args(argv)
+    async with engine.begin() as connection:
+        await reindex(connection)
+    await engine.dispose()
+    print("Search indexes rebuilt")
+
+if __name__ == "__main__":
+    import asyncio
+    import sys
+    asyncio.run(_main(sys.argv[1:]))
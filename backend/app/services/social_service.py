@@ -0,0 +1,76 @@
+from collections import Counter
+from typing import Dict, FrozenSet, Iterable, List, Tuple
+from sqlalchemy import union_all
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+from app.core.cache import TTLCache
+from app.core.config import settings
+from app.models.user import Friendship
+
+# user_id -> frozenset of the user's friends
+friends_cache = TTLCache(maxsize=settings.FRIENDS_CACHE_SIZE, ttl=settings.FRIENDS_CACHE_TTL)
+
+def _pair(user_id: int, other_id: int) -> Tuple[int, int]:
+    # Friendships are stored once, smaller id first
+    return (user_id, other_id) if user_id < other_id else (other_id, user_id)
+
+async def get_friend_sets(db: AsyncSession, user_ids: Iterable[int]) -> Dict[int, FrozenSet[int]]:
+    """user_id -> friends, loading everything missing from the cache in one query."""
+    sets, missing = {}, []
+    for user_id in user_ids:
+        friends = friends_cache.get(user_id)
+        if friends is None:
+            missing.append(user_id)
+        else:
+            sets[user_id] = friends
+    if missing:
+        # Each side of the pair has its own index
+        result = await db.execute(union_all(
+            select(Friendship.user_id, Friendship.friend_id).where(Friendship.user_id.in_(missing)),
+            select(Friendship.friend_id, Friendship.user_id).where(Friendship.friend_id.in_(missing)),
+        ))
+        loaded: Dict[int, set] = {user_id: set() for user_id in missing}
+        for user_id, friend_id in result.all():
+            loaded[user_id].add(friend_id)
+        for user_id, friends in loaded.items():
+            sets[user_id] = frozenset(friends)
+            friends_cache.set(user_id, sets[user_id])
+    return sets
+
+async def get_friend_ids(db: AsyncSession, user_id: int) -> FrozenSet[int]:
+    return (await get_friend_sets(db, [user_id]))[user_id]
+
+async def add_friendship(db: AsyncSession, user_id: int, friend_id: int) -> bool:
+    """Connect two users; False if they already were."""
+    low, high = _pair(user_id, friend_id)
+    result = await db.execute(select(Friendship.id).where(Friendship.user_id == low, Friendship.friend_id == high))
+    if result.first() is not None:
+        return False
+    db.add(Friendship(user_id=low, friend_id=high, status="accepted"))
+    try:
+        await db.commit()
+    except IntegrityError:
+        # Added concurrently by the other side
+        await db.rollback()
+        return False
+    # Update cached sets in place rather than reloading them
+    for one, other in ((user_id, friend_id), (friend_id, user_id)):
+        friends = friends_cache.get(one)
+        if friends is not None:
+            friends_cache.set(one, friends | {other})
+    return True
+
+async def mutual_friends(db: AsyncSession, user_id: int, other_id: int) -> FrozenSet[int]:
+    sets = await get_friend_sets(db, [user_id, other_id])
+    return sets[user_id] & sets[other_id]
+
+async def suggest_friends(db: AsyncSession, user_id: int, limit: int) -> List[Tuple[int, int]]:
+    """Friends of friends who are not friends yet, as (user_id, mutual friend
+    count), most mutual friends first."""
+    friends = await get_friend_ids(db, user_id)
+    counts: Counter = Counter()
+    for their_friends in (await get_friend_sets(db, friends)).values():
+        counts.update(their_friends - friends)
+    counts.pop(user_id, None)
+    return sorted(counts.items(), key=lambda item: (-item[1], item[0]))[:limit]
@@ -0,0 +1,99 @@
+import string
+from datetime import datetime
+from typing import Iterable, List, Optional, Sequence
+from fastapi import Response
+from sqlalchemy import and_, func, or_
+from sqlalchemy.engine import RowMapping
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+from app.models.user import User
+from app.websocket.protocol import dumps
+
+# The columns of UserOut. Listings select only these: no password_hash and
+# no ORM objects, just row mappings.
+USER_OUT_COLUMNS = (
+    User.user_id,
+    User.phone_number,
+    User.email,
+    User.username,
+    User.status_message,
+    User.avatar_url,
+    User.is_online,
+    User.last_seen,
+    User.created_at,
+)
+USER_OUT_SQL = ", ".join(f"users.{column.key}" for column in USER_OUT_COLUMNS)
+
+_ASCII_LOWER = str.maketrans(string.ascii_uppercase, string.ascii_lowercase)
+
+def _fold(db: AsyncSession, text: str) -> str:
+    """``text`` as the database's lower() would fold it: SQLite's lower()
+    only folds ASCII letters, PostgreSQL's folds the others too."""
+    if db.bind.dialect.name == "sqlite":
+        return text.translate(_ASCII_LOWER)
+    return text.lower()
+
+def _above_prefix(prefix: str) -> Optional[str]:
+    """The smallest string greater than every string starting with
+    ``prefix``, or None if there is none (it ends in U+10FFFF only)."""
+    prefix = prefix.rstrip(chr(0x10FFFF))
+    if not prefix:
+        return None
+    following = ord(prefix[-1]) + 1
+    if 0xD800 <= following <= 0xDFFF:
+        # Surrogates cannot be encoded; the next character is U+E000
+        following = 0xE000
+    return prefix[:-1] + chr(following)
+
+def select_users_out():
+    return select(*USER_OUT_COLUMNS)
+
+async def get_users_out(db: AsyncSession, user_ids: Iterable[int]) -> List[RowMapping]:
+    user_ids = list(user_ids)
+    if not user_ids:
+        return []
+    result = await db.execute(select_users_out().where(User.user_id.in_(user_ids)).order_by(User.username, User.user_id))
+    return result.mappings().all()
+
+async def get_directory(db: AsyncSession, exclude_user_id: int, limit: int, after: Optional[int] = None,
+                        prefix: Optional[str] = None) -> List[RowMapping]:
+    """One page of the user directory.
+
+    Without ``prefix`` users come in user_id order. With one they are
+    matched and ordered on lower(username), or on lower(email) if the
+    prefix contains "@". The match is a range scan of the
+    (lower(column), user_id) index. ``after`` is the user_id of the last
+    user on the previous page.
+    """
+    stmt = select_users_out().where(User.user_id != exclude_user_id)
+    if not prefix:
+        if after is not None:
+            stmt = stmt.where(User.user_id > after)
+        stmt = stmt.order_by(User.user_id)
+    else:
+        prefix = _fold(db, prefix)
+        key = func.lower(User.email if "@" in prefix else User.username)
+        # key LIKE 'prefix%' as a range the index can serve
+        stmt = stmt.where(key >= prefix)
+        upper = _above_prefix(prefix)
+        if upper is not None:
+            stmt = stmt.where(key < upper)
+        if after is not None:
+            last_key = select(key).where(User.user_id == after).scalar_subquery()
+            stmt = stmt.where(or_(key > last_key, and_(key == last_key, User.user_id > after)))
+        stmt = stmt.order_by(key, User.user_id)
+    result = await db.execute(stmt.limit(limit))
+    return result.mappings().all()
+
+def _jsonable(row: RowMapping) -> dict:
+    return {key: value.isoformat() if isinstance(value, datetime) else value for key, value in row.items()}
+
+def users_response(rows: Sequence[RowMapping], **extra) -> Response:
+    """Serialize user rows as they are, without building a model per row.
+
+    With ``extra`` (e.g. next_cursor) the body is {"users": [...], **extra},
+    otherwise a bare list.
+    """
+    users = [_jsonable(row) for row in rows]
+    body = {"users": users, **extra} if extra else users
+    return Response(dumps(body), media_type="application/json")
@@ -0,0 +1,277 @@
+import asyncio
+import logging
+from typing import Awaitable, Callable, Dict, List, Optional, Set, Tuple
+from app.core.config import settings
+
+MessageHandler = Callable[[str, str], Awaitable[None]]
+
+logger = logging.getLogger(__name__)
+
+class Backplane:
+    """Carries WebSocket events between processes (uvicorn workers or nodes).
+
+    Every process subscribes to the channels of the users it currently
+    holds sockets for; ``publish`` reaches every other subscribed process
+    and returns how many received it. Whether the publisher gets its own
+    message back depends on the backplane (Redis does), so receivers must
+    skip their own.
+
+    It also counts each user's sockets across processes, so presence can
+    tell a user's last device apart from the last one on this node.
+    """
+
+    async def start(self, on_message: MessageHandler, node_id: str):
+        raise NotImplementedError
+
+    async def stop(self):
+        raise NotImplementedError
+
+    async def subscribe(self, channel: str):
+        raise NotImplementedError
+
+    async def unsubscribe(self, channel: str):
+        raise NotImplementedError
+
+    async def publish(self, channel: str, data: str) -> int:
+        raise NotImplementedError
+
+    async def publish_many(self, messages: List[Tuple[str, str]]) -> List[int]:
+        """``publish`` each (channel, data); backplanes with a network hop
+        send them in one round trip."""
+        return [await self.publish(channel, data) for channel, data in messages]
+
+    async def add_devices(self, user_id: int, delta: int) -> int:
+        """Add ``delta`` to this process's socket count for ``user_id`` and
+        return the user's sockets across all processes."""
+        raise NotImplementedError
+
+class InProcessBroker:
+    """Channel registry shared by the InProcessBackplanes of one process."""
+
+    def __init__(self):
+        self.subscribers: Dict[str, Set["InProcessBackplane"]] = {}
+        # user_id -> backplane -> sockets it holds
+        self.devices: Dict[int, Dict["InProcessBackplane", int]] = {}
+
+    async def publish(self, channel: str, data: str, sender: Optional["InProcessBackplane"] = None) -> int:
+        subscribers = self.subscribers.get(channel)
+        if not subscribers:
+            return 0
+        receivers = [backplane for backplane in subscribers if backplane is not sender]
+        for backplane in receivers:
+            await backplane.on_message(channel, data)
+        return len(receivers)
+
+class InProcessBackplane(Backplane):
+    """Single-process backplane. Several instances sharing one broker behave
+    like separate nodes, which is handy for exercising routing in tests.
+    A publisher never receives its own messages, so with a single instance
+    (the memory:// default) publishing costs next to nothing."""
+
+    def __init__(self, broker: Optional[InProcessBroker] = None):
+        self.broker = broker or InProcessBroker()
+        self.channels: Set[str] = set()
+        self.on_message: Optional[MessageHandler] = None
+
+    async def start(self, on_message: MessageHandler, node_id: str):
+        self.on_message = on_message
+
+    async def stop(self):
+        for channel in list(self.channels):
+            await self.unsubscribe(channel)
+        for user_id in list(self.broker.devices):
+            await self.add_devices(user_id, -self.broker.devices[user_id].get(self, 0))
+
+    async def subscribe(self, channel: str):
+        self.channels.add(channel)
+        self.broker.subscribers.setdefault(channel, set()).add(self)
+
+    async def unsubscribe(self, channel: str):
+        self.channels.discard(channel)
+        subscribers = self.broker.subscribers.get(channel)
+        if subscribers is not None:
+            subscribers.discard(self)
+            if not subscribers:
+                del self.broker.subscribers[channel]
+
+    async def publish(self, channel: str, data: str) -> int:
+        return await self.broker.publish(channel, data, sender=self)
+
+    async def publish_many(self, messages: List[Tuple[str, str]]) -> List[int]:
+        subscribers = self.broker.subscribers
+        # Most channels have no subscriber on a single node; skip those
+        # without awaiting anything
+        return [
+            await self.broker.publish(channel, data, sender=self) if channel in subscribers else 0
+            for channel, data in messages
+        ]
+
+    async def add_devices(self, user_id: int, delta: int) -> int:
+        counts = self.broker.devices.setdefault(user_id, {})
+        own = counts.get(self, 0) + delta
+        if own > 0:
+            counts[self] = own
+        else:
+            counts.pop(self, None)
+        if not counts:
+            del self.broker.devices[user_id]
+        return sum(counts.values())
+
+# KEYS[1] = the user's hash of node id -> sockets, KEYS[2] = live nodes
+# (score = when their heartbeat runs out); ARGV = node id, delta. Fields of
+# nodes whose heartbeat ran out are dropped, not counted.
+_ADD_DEVICES_SCRIPT = """
+local own = redis.call('HINCRBY', KEYS[1], ARGV[1], ARGV[2])
+if own <= 0 then
+    redis.call('HDEL', KEYS[1], ARGV[1])
+    own = 0
+end
+local now = tonumber(redis.call('TIME')[1])
+local total = own
+local counts = redis.call('HGETALL', KEYS[1])
+for i = 1, #counts, 2 do
+    if counts[i] ~= ARGV[1] then
+        local expires = tonumber(redis.call('ZSCORE', KEYS[2], counts[i]))
+        if expires and expires > now then
+            total = total + tonumber(counts[i + 1])
+        else
+            redis.call('HDEL', KEYS[1], counts[i])
+        end
+    end
+end
+return total
+"""
+
+class RedisBackplane(Backplane):
+    """Redis pub/sub backplane. Pass ``client`` to use an existing
+    ``redis.asyncio`` client (or a fakeredis one in tests).
+
+    If reading from the subscription fails the listener backs off
+    (``retry_delay``, doubling up to ``max_retry_delay``) and subscribes
+    to its channels again on a fresh connection; messages published
+    meanwhile are lost, as with any pub/sub gap."""
+
+    def __init__(self, url: str = "redis://localhost:6379/0", client=None, prefix: str = "convo:",
+                 node_ttl: float = settings.PRESENCE_NODE_TTL, retry_delay: float = 0.5, max_retry_delay: float = 30.0):
+        if client is None:
+            import redis.asyncio as redis
+            client = redis.from_url(url)
+        self.redis = client
+        self.prefix = prefix
+        self.node_ttl = node_ttl
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.node_id = ""
+        self.pubsub = None
+        # Channels to subscribe to again after a reconnect
+        self.channels: Set[str] = set()
+        self.listener: Optional[asyncio.Task] = None
+        self.heartbeat: Optional[asyncio.Task] = None
+        self.on_message: Optional[MessageHandler] = None
+        self.add_devices_script = client.register_script(_ADD_DEVICES_SCRIPT)
+
+    async def start(self, on_message: MessageHandler, node_id: str):
+        self.on_message = on_message
+        self.node_id = node_id
+        self.pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+        self.listener = asyncio.create_task(self._listen())
+        self.heartbeat = asyncio.create_task(self._beat())
+
+    async def stop(self):
+        for task in (self.listener, self.heartbeat):
+            if task:
+                task.cancel()
+        if self.pubsub is not None:
+            await self.pubsub.aclose()
+        try:
+            # Whatever devices this node still counts stop keeping users online
+            await self.redis.zrem(self.prefix + "nodes", self.node_id)
+        except Exception as exc:
+            logger.warning("Failed to deregister node %s: %s", self.node_id, exc)
+        await self.redis.aclose()
+
+    async def subscribe(self, channel: str):
+        self.channels.add(self.prefix + channel)
+        await self.pubsub.subscribe(self.prefix + channel)
+
+    async def unsubscribe(self, channel: str):
+        self.channels.discard(self.prefix + channel)
+        await self.pubsub.unsubscribe(self.prefix + channel)
+
+    async def publish(self, channel: str, data: str) -> int:
+        return await self.redis.publish(self.prefix + channel, data)
+
+    async def publish_many(self, messages: List[Tuple[str, str]]) -> List[int]:
+        if not messages:
+            return []
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for channel, data in messages:
+                pipe.publish(self.prefix + channel, data)
+            return await pipe.execute()
+
+    async def add_devices(self, user_id: int, delta: int) -> int:
+        return await self.add_devices_script(
+            keys=[f"{self.prefix}devices:{user_id}", self.prefix + "nodes"], args=[self.node_id, delta]
+        )
+
+    async def _beat(self):
+        nodes = self.prefix + "nodes"
+        while True:
+            try:
+                now = (await self.redis.time())[0]
+                async with self.redis.pipeline(transaction=False) as pipe:
+                    pipe.zadd(nodes, {self.node_id: now + self.node_ttl})
+                    pipe.zremrangebyscore(nodes, "-inf", now)
+                    await pipe.execute()
+            except Exception as exc:
+                logger.warning("Backplane heartbeat failed: %s", exc)
+            await asyncio.sleep(self.node_ttl / 3)
+
+    async def _listen(self):
+        while True:
+            if not self.pubsub.subscribed:
+                # listen()/get_message() need at least one subscription
+                await asyncio.sleep(0.1)
+                continue
+            try:
+                message = await self.pubsub.get_message(timeout=1.0)
+            except Exception as exc:
+                logger.warning("Backplane subscription failed: %s", exc)
+                await self._resubscribe()
+                continue
+            if message is None or message["type"] != "message":
+                continue
+            channel = message["channel"]
+            data = message["data"]
+            if isinstance(channel, bytes):
+                channel = channel.decode()
+            if isinstance(data, bytes):
+                data = data.decode()
+            try:
+                await self.on_message(channel[len(self.prefix):], data)
+            except Exception:
+                logger.exception("Failed to deliver backplane message on %s", channel)
+
+    async def _resubscribe(self):
+        """Replace the subscription connection, keeping the channels, until
+        subscribing succeeds."""
+        delay = self.retry_delay
+        while True:
+            await asyncio.sleep(delay)
+            broken, self.pubsub = self.pubsub, self.redis.pubsub(ignore_subscribe_messages=True)
+            try:
+                await broken.aclose()
+            except Exception:
+                pass
+            try:
+                if self.channels:
+                    await self.pubsub.subscribe(*self.channels)
+                return
+            except Exception as exc:
+                delay = min(delay * 2, self.max_retry_delay)
+                logger.warning("Backplane resubscribe failed, retrying in %.1fs: %s", delay, exc)
+
+def create_backplane(url: str) -> Backplane:
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        return RedisBackplane(url)
+    return InProcessBackplane()
@@ -1,31 +1,521 @@
+import asyncio
+import time
+import uuid
+from collections import OrderedDict, deque
 from fastapi import WebSocket
-from typing import List, Dict
+from typing import Callable, Iterable, List, Dict, Optional, Hashable, Set, Union
+from app.core import metrics
+from app.core.config import settings
+from app.websocket.backplane import Backplane
+from app.websocket.protocol import DEFAULT_CODEC, Codec, Frame, dumps, loads
+
+# A Frame is encoded in each connection's wire format; a str is sent as-is
+Outgoing = Union[Frame, str]
+
+# Pre-bound; observed on every fan-out
+_fanout_seconds = metrics.ws_fanout_seconds.labels()
+_chat_fanout_seconds = {size: metrics.ws_chat_fanout_seconds.labels(size) for size in metrics.CHAT_SIZE_CLASSES}
+
+class Connection:
+    """A single WebSocket with its own bounded outbound queue and writer task.
+
+    Fan-out only appends to the queue, so a slow client never holds up
+    delivery to anybody else. What happens when the queue is full depends
+    on the kind of event being sent (see ``enqueue``). Frames are encoded
+    by the writer in this connection's ``codec``.
+
+    With an ``ack_window`` the writer sends whatever is queued as one
+    numbered batch frame and keeps it until the client acknowledges that
+    seq (or a later one). At most ``ack_window`` batches are in flight; while
+    the window is full, new events wait in the queue. Batches still
+    unacknowledged WS_ACK_TIMEOUT after the last progress are sent again,
+    up to WS_ACK_RETRIES times, before the connection is dropped.
+    ``on_acked`` is called with the events of every acknowledged batch.
+
+    A connection created with ``hold`` sends nothing from its queue until
+    ``release()``. Events passed to ``replay()`` are sent first, so missed
+    events reach a reconnecting client before live ones. A ``Marker`` in
+    the stream runs its callback once everything before it has been sent,
+    or acknowledged with an ack window.
+    """
+
+    def __init__(self, websocket: WebSocket, user_id: int, owner: "ConnectionManager", max_queue: int = settings.WS_SEND_QUEUE_SIZE,
+                 codec: Codec = DEFAULT_CODEC, ack_window: Optional[int] = None, hold: bool = False):
+        self.websocket = websocket
+        self.user_id = user_id
+        self.owner = owner
+        self.codec = codec
+        self.max_queue = max_queue
+        self.queue: deque = deque()
+        # Replayed events; sent before the queue and not bounded by max_queue
+        self.backlog: deque = deque()
+        self.holding = hold
+        # Coalesced events: key -> latest payload. The queue only holds the key.
+        self.pending: Dict[Hashable, Outgoing] = {}
+        self.wakeup = asyncio.Event()
+        self.closed = False
+        self.writer: Optional[asyncio.Task] = None
+        self.ack_window = ack_window
+        self.on_acked: Optional[Callable[[List[Outgoing]], None]] = None
+        self.seq = 0
+        # (seq, encoded batch, events) in seq order
+        self.unacked: deque = deque()
+        self.ack_deadline = 0.0
+        self.retransmits = 0
+        # Chats this connection is registered for in ConnectionManager.chat_subscribers
+        self.chats: Set[int] = set()
+
+    def start(self):
+        self.writer = asyncio.create_task(self._write_loop())
+
+    def enqueue(self, message: Outgoing, kind: str = "message", coalesce_key: Hashable = None) -> bool:
+        """Queue a message without blocking. Returns False if the connection should be dropped."""
+        if self.closed:
+            return True
+        if coalesce_key is not None and coalesce_key in self.pending:
+            # Newer status replaces the one still waiting to be written
+            self.pending[coalesce_key] = message
+            return True
+        if len(self.queue) >= self.max_queue:
+            if kind == "typing":
+                return True
+            if settings.WS_SLOW_CONSUMER_POLICY == "drop":
+                return True
+            return False
+        if coalesce_key is not None:
+            self.pending[coalesce_key] = message
+            self.queue.append(_Coalesced(coalesce_key))
+        else:
+            self.queue.append(message)
+        metrics.frame_out(kind)
+        self.wakeup.set()
+        return True
+
+    def replay(self, events: List[Union[Outgoing, "Marker"]]):
+        for event in events:
+            if isinstance(event, Frame):
+                metrics.frame_out(event.payload.get("type"))
+        self.backlog.extend(events)
+        self.wakeup.set()
+
+    def release(self):
+        """Start sending live events (see ``hold``)."""
+        self.holding = False
+        self.wakeup.set()
+
+    def ack(self, seq: int):
+        """The client has processed every batch up to and including ``seq``."""
+        acked = []
+        while self.unacked and self.unacked[0][0] <= seq:
+            acked.extend(self.unacked.popleft()[2])
+        if not acked:
+            return
+        self.retransmits = 0
+        self.ack_deadline = asyncio.get_running_loop().time() + settings.WS_ACK_TIMEOUT
+        self.wakeup.set()
+        events = []
+        for event in acked:
+            if isinstance(event, Marker):
+                event.callback()
+            else:
+                events.append(event)
+        if self.on_acked is not None and events:
+            self.on_acked(events)
+
+    def _has_next(self) -> bool:
+        return bool(self.backlog) or (bool(self.queue) and not self.holding)
+
+    def _pop(self) -> Union[Outgoing, "Marker"]:
+        if self.backlog:
+            return self.backlog.popleft()
+        item = self.queue.popleft()
+        if isinstance(item, _Coalesced):
+            item = self.pending.pop(item.key)
+        return item
+
+    async def _send(self, data: Union[str, bytes]):
+        async with asyncio.timeout(settings.WS_SEND_TIMEOUT):
+            if isinstance(data, bytes):
+                await self.websocket.send_bytes(data)
+            else:
+                await self.websocket.send_text(data)
+
+    async def _write_loop(self):
+        try:
+            if self.ack_window:
+                await self._write_batches()
+            else:
+                await self._write_each()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            # Timed out, never acknowledged, or the socket is gone
+            self.owner.drop(self)
+
+    async def _write_each(self):
+        while True:
+            while not self._has_next():
+                self.wakeup.clear()
+                await self.wakeup.wait()
+            item = self._pop()
+            if isinstance(item, Marker):
+                item.callback()
+                continue
+            await self._send(item.encode(self.codec) if isinstance(item, Frame) else item)
+
+    async def _write_batches(self):
+        loop = asyncio.get_running_loop()
+        plain = self.codec.plain
+        while True:
+            if self._has_next() and len(self.unacked) < self.ack_window:
+                events, items = [], []
+                while self._has_next() and len(items) < settings.WS_BATCH_MAX_FRAMES:
+                    event = self._pop()
+                    events.append(event)
+                    if not isinstance(event, Marker):
+                        items.append(event.encode(plain) if isinstance(event, Frame) else plain.literal(event))
+                if not items:
+                    # Only markers: they complete with the last batch in flight, or now
+                    if self.unacked:
+                        self.unacked[-1][2].extend(events)
+                    else:
+                        for marker in events:
+                            marker.callback()
+                    continue
+                self.seq += 1
+                data = self.codec.batch(self.seq, items)
+                if not self.unacked:
+                    self.ack_deadline = loop.time() + settings.WS_ACK_TIMEOUT
+                self.unacked.append((self.seq, data, events))
+                await self._send(data)
+                continue
+            self.wakeup.clear()
+            if not self.unacked:
+                await self.wakeup.wait()
+                continue
+            try:
+                async with asyncio.timeout_at(self.ack_deadline):
+                    await self.wakeup.wait()
+            except TimeoutError:
+                if self.retransmits >= settings.WS_ACK_RETRIES:
+                    raise
+                self.retransmits += 1
+                self.ack_deadline = loop.time() + settings.WS_ACK_TIMEOUT
+                for _, data, _ in list(self.unacked):
+                    metrics.ws_retransmits.inc()
+                    await self._send(data)
+
+    async def close(self, code: int = 1000, reason: Optional[str] = None):
+        self.closed = True
+        self.queue.clear()
+        self.backlog.clear()
+        self.pending.clear()
+        self.unacked.clear()
+        if self.writer and self.writer is not asyncio.current_task():
+            self.writer.cancel()
+        try:
+            await self.websocket.close(code=code, reason=reason)
+        except Exception:
+            pass
+
+class Marker:
+    """A callback placed in a connection's outgoing stream (see ``Connection``)."""
+
+    __slots__ = ("callback",)
+
+    def __init__(self, callback: Callable[[], None]):
+        self.callback = callback
+
+class _Coalesced:
+    __slots__ = ("key",)
+
+    def __init__(self, key: Hashable):
+        self.key = key
+
+class FanoutStats:
+    """Fan-out cost of the most recently active chats (an LRU of ``maxsize``)."""
+
+    def __init__(self, maxsize: int = settings.WS_FANOUT_STATS_SIZE):
+        self.maxsize = maxsize
+        # chat_id -> [fan-outs, connections reached, seconds]
+        self.chats: "OrderedDict[int, list]" = OrderedDict()
+
+    def record(self, chat_id: int, connections: int, seconds: float):
+        entry = self.chats.get(chat_id)
+        if entry is None:
+            entry = self.chats[chat_id] = [0, 0, 0.0]
+            if len(self.chats) > self.maxsize:
+                self.chats.popitem(last=False)
+        else:
+            self.chats.move_to_end(chat_id)
+        entry[0] += 1
+        entry[1] += connections
+        entry[2] += seconds
+
+    def top(self, n: int = 10) -> List[dict]:
+        """The chats that cost the most fan-out time."""
+        ranked = sorted(self.chats.items(), key=lambda item: item[1][2], reverse=True)[:n]
+        return [
+            {"chat_id": chat_id, "fanouts": fanouts, "connections": connections, "seconds": round(seconds, 6),
+             "ms_per_fanout": round(seconds / fanouts * 1000, 3)}
+            for chat_id, (fanouts, connections, seconds) in ranked
+        ]
 
 class ConnectionManager:
     def __init__(self):
-        # Map user_id to a list of WebSockets (multi-device support)
-        self.active_connections: Dict[int, List[WebSocket]] = {}
+        # Map user_id to a list of Connections (multi-device support)
+        self.active_connections: Dict[int, List[Connection]] = {}
+        # chat_id -> local connections of its members (see send_to_chat)
+        self.chat_subscribers: Dict[int, Set[Connection]] = {}
+        self.fanout_stats = FanoutStats()
+        self._closing: set = set()
+        # Without a backplane only sockets held by this process are reachable
+        self.backplane: Optional[Backplane] = None
+        self.node_id = uuid.uuid4().hex
 
-    async def connect(self, websocket: WebSocket, user_id: int):
-        await websocket.accept()
+    async def start(self, backplane: Backplane):
+        self.backplane = backplane
+        await backplane.start(self._on_backplane_message, self.node_id)
+        await backplane.subscribe("broadcast")
+        for user_id in self.active_connections:
+            await backplane.subscribe(f"user:{user_id}")
+
+    async def stop(self):
+        if self.backplane:
+            backplane, self.backplane = self.backplane, None
+            await backplane.stop()
+
+    async def connect(self, websocket: WebSocket, user_id: int, codec: Codec = DEFAULT_CODEC, subprotocol: Optional[str] = None,
+                      acks: bool = False, hold: bool = False, chats: Iterable[int] = ()) -> Connection:
+        await websocket.accept(subprotocol=subprotocol)
+        connection = Connection(websocket, user_id, self, codec=codec, ack_window=settings.WS_ACK_WINDOW if acks else None, hold=hold)
+        connection.start()
+        for chat_id in chats:
+            self._subscribe(connection, chat_id)
         if user_id not in self.active_connections:
             self.active_connections[user_id] = []
-        self.active_connections[user_id].append(websocket)
+            if self.backplane:
+                await self.backplane.subscribe(f"user:{user_id}")
+        self.active_connections[user_id].append(connection)
+        return connection
 
     def disconnect(self, websocket: WebSocket, user_id: int):
-        if user_id in self.active_connections:
-            self.active_connections[user_id].remove(websocket)
-            if not self.active_connections[user_id]:
-                del self.active_connections[user_id]
-
-    async def send_personal_message(self, message: str, user_id: int):
         if user_id in self.active_connections:
             for connection in self.active_connections[user_id]:
-                await connection.send_text(message)
+                if connection.websocket is websocket:
+                    self._remove(connection)
+                    connection.closed = True
+                    if connection.writer:
+                        connection.writer.cancel()
+                    break
 
-    async def broadcast(self, message: str):
-        for user_id in self.active_connections:
-            for connection in self.active_connections[user_id]:
-                await connection.send_text(message)
+    def drop(self, connection: Connection):
+        """Disconnect a slow or broken consumer."""
+        if connection.closed:
+            return
+        connection.closed = True
+        self._remove(connection)
+        metrics.ws_dropped_connections.inc()
+        # 1013: try again later
+        self._spawn(connection.close(code=1013))
+
+    def _spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self._closing.add(task)
+        task.add_done_callback(self._closing.discard)
+
+    def _subscribe(self, connection: Connection, chat_id: int):
+        self.chat_subscribers.setdefault(chat_id, set()).add(connection)
+        connection.chats.add(chat_id)
+
+    def _unsubscribe(self, connection: Connection, chat_id: int):
+        subscribers = self.chat_subscribers.get(chat_id)
+        if subscribers is not None:
+            subscribers.discard(connection)
+            if not subscribers:
+                del self.chat_subscribers[chat_id]
+        connection.chats.discard(chat_id)
+
+    def join_chat(self, chat_id: int, user_ids: Iterable[int]):
+        """Register the local connections of users who became members."""
+        for user_id in user_ids:
+            for connection in self.active_connections.get(user_id, ()):
+                self._subscribe(connection, chat_id)
+
+    def leave_chat(self, chat_id: int, user_ids: Iterable[int]):
+        for user_id in user_ids:
+            for connection in self.active_connections.get(user_id, ()):
+                self._unsubscribe(connection, chat_id)
+
+    def forget_chat(self, chat_id: int):
+        for connection in self.chat_subscribers.pop(chat_id, ()):
+            connection.chats.discard(chat_id)
+
+    def _remove(self, connection: Connection):
+        for chat_id in list(connection.chats):
+            self._unsubscribe(connection, chat_id)
+        connections = self.active_connections.get(connection.user_id)
+        if connections and connection in connections:
+            connections.remove(connection)
+            if not connections:
+                del self.active_connections[connection.user_id]
+                if self.backplane:
+                    self._spawn(self.backplane.unsubscribe(f"user:{connection.user_id}"))
+
+    async def send_personal_message(self, message: Outgoing, user_id: int, kind: str = "message", coalesce_key: Hashable = None) -> bool:
+        """Returns False if no socket of the user, here or on another node, was reached."""
+        start = time.perf_counter()
+        reached = self._deliver([message], user_id, kind, coalesce_key) > 0
+        if self.backplane:
+            reached = await self.backplane.publish(f"user:{user_id}", self._envelope(message, kind, coalesce_key)) > 0 or reached
+        _fanout_seconds.observe(time.perf_counter() - start)
+        return reached
+
+    async def send_personal_messages(self, messages: List[Outgoing], user_id: int, kind: str = "message") -> bool:
+        """Queue several events for one user back to back, so connections with
+        an ack window send them as one batch frame."""
+        start = time.perf_counter()
+        reached = self._deliver(messages, user_id, kind, None) > 0
+        if self.backplane:
+            counts = await self.backplane.publish_many([(f"user:{user_id}", self._envelope(message, kind, None)) for message in messages])
+            reached = any(counts) or reached
+        _fanout_seconds.observe(time.perf_counter() - start)
+        return reached
+
+    async def send_missed(self, messages: List[Frame], user_id: int) -> bool:
+        """Deliver events the user missed ahead of live events already queued
+        (see ``Connection.replay``), here and on other nodes. Returns False if
+        no socket was reached, or if one here still waits for its replay:
+        that replay reads stored events, so the caller should store these."""
+        connections = self.active_connections.get(user_id, [])
+        replaying = any(connection.holding for connection in connections)
+        reached = False
+        if not replaying:
+            for connection in connections:
+                if not connection.closed:
+                    connection.replay(messages)
+                    reached = True
+        if self.backplane:
+            counts = await self.backplane.publish_many([(f"user:{user_id}", self._envelope(message, "message", None)) for message in messages])
+            reached = any(counts) or reached
+        return reached and not replaying
+
+    async def send_to_chat(self, chat_id: int, message: Outgoing, members: Iterable[int], kind: str = "message",
+                           exclude: Optional[int] = None, coalesce_key: Hashable = None) -> List[int]:
+        """Deliver one event to the members of a chat; returns the members no
+        socket of which, here or on another node, was reached.
+
+        Local sockets come from ``chat_subscribers``, WS_FANOUT_CHUNK at a
+        time with a yield to the event loop in between, so a huge group
+        does not hold up everybody else. ``members`` (usually the
+        membership cache) decides who may receive it, so a registry that
+        missed a change made on another node never leaks an event; members
+        the registry did not cover are looked up by user. With a backplane
+        every member's channel is published to in one ``publish_many``,
+        with the envelope serialized once.
+        """
+        return await self.send_all_to_chat(chat_id, [message], members, kind, exclude, coalesce_key)
+
+    async def send_all_to_chat(self, chat_id: int, messages: List[Outgoing], members: Iterable[int], kind: str = "message",
+                               exclude: Optional[int] = None, coalesce_key: Hashable = None) -> List[int]:
+        """``send_to_chat`` for several events, queued back to back on each
+        socket so connections with an ack window send them as one batch frame."""
+        start = time.perf_counter()
+        members = set(members)
+        members.discard(exclude)
+        chunk = settings.WS_FANOUT_CHUNK
+        reached: Set[int] = set()
+        delivered = 0
+        subscribers = list(self.chat_subscribers.get(chat_id, ()))
+        for offset in range(0, len(subscribers), chunk):
+            if offset:
+                await asyncio.sleep(0)
+            for connection in subscribers[offset:offset + chunk]:
+                if connection.user_id in members and self._enqueue(connection, messages, kind, coalesce_key):
+                    reached.add(connection.user_id)
+                    delivered += 1
+        for count, user_id in enumerate(members, 1):
+            if user_id not in reached:
+                local = self._deliver(messages, user_id, kind, coalesce_key)
+                if local:
+                    # Joined on another node; register them for next time
+                    self.join_chat(chat_id, [user_id])
+                    reached.add(user_id)
+                delivered += local
+            if count % chunk == 0:
+                await asyncio.sleep(0)
+        if self.backplane:
+            envelopes = [self._envelope(message, kind, coalesce_key) for message in messages]
+            targets = list(members)
+            counts = await self.backplane.publish_many(
+                [(f"user:{user_id}", envelope) for user_id in targets for envelope in envelopes]
+            )
+            for index, published in enumerate(counts):
+                if published:
+                    reached.add(targets[index // len(envelopes)])
+        unreached = [user_id for user_id in members if user_id not in reached]
+        seconds = time.perf_counter() - start
+        _chat_fanout_seconds[metrics.chat_size_class(len(members))].observe(seconds)
+        self.fanout_stats.record(chat_id, delivered, seconds)
+        return unreached
+
+    async def broadcast(self, message: Outgoing, kind: str = "message", coalesce_key: Hashable = None):
+        self._deliver_all(message, kind, coalesce_key)
+        if self.backplane:
+            await self.backplane.publish("broadcast", self._envelope(message, kind, coalesce_key))
+
+    def _deliver(self, messages: List[Outgoing], user_id: int, kind: str, coalesce_key: Hashable) -> int:
+        """Queue ``messages`` on every socket of the user. Returns how many took all of them."""
+        return sum(self._enqueue(connection, messages, kind, coalesce_key)
+                   for connection in list(self.active_connections.get(user_id, ())))
+
+    def _enqueue(self, connection: Connection, messages: List[Outgoing], kind: str, coalesce_key: Hashable) -> bool:
+        """Queue ``messages`` on one socket. A socket that is closed, or is
+        dropped part way as a slow consumer, does not count as reached."""
+        if connection.closed:
+            return False
+        for message in messages:
+            if not connection.enqueue(message, kind, coalesce_key):
+                self.drop(connection)
+                return False
+        return True
+
+    def _deliver_all(self, message: Outgoing, kind: str, coalesce_key: Hashable):
+        for connections in list(self.active_connections.values()):
+            for connection in list(connections):
+                if not connection.enqueue(message, kind, coalesce_key):
+                    self.drop(connection)
+
+    def _envelope(self, message: Outgoing, kind: str, coalesce_key: Hashable) -> str:
+        # Prefixed with the node id, so a node can skip its own messages
+        # without decoding them
+        envelope = {"kind": kind, "key": coalesce_key}
+        if isinstance(message, Frame):
+            # The JSON text is cached on the frame, so a fan-out serializes it once
+            envelope["frame"] = message.json()
+        else:
+            envelope["message"] = message
+        return self.node_id + dumps(envelope)
+
+    async def _on_backplane_message(self, channel: str, data: str):
+        if data.startswith(self.node_id):
+            # Already delivered locally before publishing
+            return
+        # Node ids are all uuid4 hex strings of the same length
+        envelope = loads(data[len(self.node_id):])
+        key = envelope["key"]
+        if isinstance(key, list):
+            key = tuple(key)
+        message = Frame.from_json(envelope["frame"]) if "frame" in envelope else envelope["message"]
+        if channel == "broadcast":
+            self._deliver_all(message, envelope["kind"], key)
+        elif channel.startswith("user:"):
+            self._deliver([message], int(channel[5:]), envelope["kind"], key)
+
+    def connection_count(self) -> int:
+        return sum(len(connections) for connections in self.active_connections.values())
 
 manager = ConnectionManager()
+
+metrics.registry.register(metrics.Gauge("convo_ws_connections", "Open WebSocket connections in this process.", function=manager.connection_count))
+metrics.registry.register(metrics.Gauge("convo_ws_users", "Users with at least one WebSocket in this process.", function=lambda: len(manager.active_connections)))
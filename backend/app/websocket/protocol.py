@@ -0,0 +1,226 @@
+"""Wire formats of the chat WebSocket, chosen per connection at the handshake.
+
+A client offers one or more ``convo.<name>`` subprotocols (or passes
+``?protocol=<name>``); without either it gets "json", the original format.
+
+- "json": JSON text frames with the full key names.
+- "compact": JSON text frames with the short keys in ``KEYS``.
+- "msgpack": binary MessagePack frames with the short keys (only offered
+  when the msgpack package is installed).
+
+Each of these also has a "-deflate" variant. Frames of at least
+WS_COMPRESS_MIN_BYTES are zlib-compressed by the server once per fan-out
+and sent as binary frames starting with 0x78. Smaller frames are sent as
+usual. Compressing per fan-out is far cheaper in large groups than
+permessage-deflate, which compresses the same frame again for every
+recipient.
+
+Outgoing events are ``Frame`` objects. A frame encodes itself at most once
+per format, so every recipient using the same format shares the same
+str or bytes.
+
+Clients may send {"type": "batch", "frames": [...]} to deliver many events
+in one frame. A connection opened with ``?acks=1`` receives every event
+inside a batch frame, {"type": "batch", "seq": n, "frames": [...]}, with
+seq counting up from 1 on that connection, and answers with
+{"type": "ack", "seq": n} to confirm everything up to n (see
+``Connection``).
+"""
+import json
+import zlib
+from typing import Dict, List, Optional, Tuple, Union
+from app.core.config import settings
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - optional speedup
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover - optional format
+    msgpack = None
+
+SUBPROTOCOL_PREFIX = "convo."
+
+# Full key -> short key used by the compact formats
+KEYS = {
+    "type": "t",
+    "chat_id": "c",
+    "message_id": "m",
+    "sender_id": "s",
+    "user_id": "u",
+    "recipient_id": "r",
+    "content": "b",
+    "media_url": "mu",
+    "derivatives": "dv",
+    "status": "st",
+    "created_at": "ts",
+    "is_typing": "it",
+    "data": "d",
+    "changes": "ch",
+    "last_seen": "ls",
+    "frames": "f",
+    "seq": "q",
+}
+_LONG_KEYS = {short: key for key, short in KEYS.items()}
+# Lists of objects whose keys are renamed too, under either name; anything
+# else (signaling "data", derivative names) is passed through untouched
+_NESTED = {"changes", "frames"}
+_NESTED |= {KEYS[key] for key in _NESTED}
+
+class ProtocolError(ValueError):
+    """A frame that could not be decoded into an object."""
+
+class FrameTooLarge(ProtocolError):
+    """A compressed frame that inflates past WS_MAX_MESSAGE_BYTES."""
+
+def dumps(obj) -> str:
+    if orjson is not None:
+        return orjson.dumps(obj).decode()
+    return json.dumps(obj, separators=(",", ":"))
+
+def loads(data: Union[str, bytes]):
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+def _rename(payload: dict, table: Dict[str, str]) -> dict:
+    renamed = {}
+    for key, value in payload.items():
+        if key in _NESTED and isinstance(value, list):
+            value = [_rename(item, table) if isinstance(item, dict) else item for item in value]
+        renamed[table.get(key, key)] = value
+    return renamed
+
+class Codec:
+    def __init__(self, name: str, short_keys: bool = False, compress: bool = False):
+        self.name = name
+        self.short_keys = short_keys
+        self.compress = compress
+        # Encodes the events inside a batch frame, which is compressed as a whole
+        self.plain = type(self)(name.replace("-deflate", ""), short_keys) if compress else self
+
+    def _key(self, key: str) -> str:
+        return KEYS[key] if self.short_keys else key
+
+    def _serialize(self, payload: dict) -> Union[str, bytes]:
+        return dumps(payload)
+
+    def _join(self, seq: int, items: List[Union[str, bytes]]) -> Union[str, bytes]:
+        return f'{{"{self._key("type")}":"batch","{self._key("seq")}":{seq},"{self._key("frames")}":[{",".join(items)}]}}'
+
+    def literal(self, text: str) -> Union[str, bytes]:
+        """A plain string (e.g. an echo) as an element of a batch."""
+        return dumps(text)
+
+    def _parse(self, data: Union[str, bytes]):
+        return loads(data)
+
+    def _compressed(self, data: Union[str, bytes]) -> Union[str, bytes]:
+        if self.compress and len(data) >= settings.WS_COMPRESS_MIN_BYTES:
+            raw = data.encode() if isinstance(data, str) else data
+            return zlib.compress(raw, settings.WS_COMPRESS_LEVEL)
+        return data
+
+    def encode(self, payload: dict) -> Union[str, bytes]:
+        if self.short_keys:
+            payload = _rename(payload, KEYS)
+        return self._compressed(self._serialize(payload))
+
+    def batch(self, seq: int, items: List[Union[str, bytes]]) -> Union[str, bytes]:
+        """A {"type": "batch", "seq": ..., "frames": [...]} frame around events
+        already encoded with ``self.plain``, spliced in without re-encoding."""
+        return self._compressed(self._join(seq, items))
+
+    def decode(self, data: Union[str, bytes]) -> dict:
+        try:
+            if self.compress and isinstance(data, bytes) and data[:1] == b"\x78":
+                # Bounded, so a small frame cannot inflate into gigabytes
+                inflater = zlib.decompressobj()
+                data = inflater.decompress(data, settings.WS_MAX_MESSAGE_BYTES)
+                if inflater.unconsumed_tail:
+                    raise FrameTooLarge(f"Frame inflates past {settings.WS_MAX_MESSAGE_BYTES} bytes")
+            payload = self._parse(data)
+        except FrameTooLarge:
+            raise
+        except (ValueError, TypeError, zlib.error) as exc:
+            raise ProtocolError(str(exc)) from exc
+        if not isinstance(payload, dict):
+            raise ProtocolError("Frame is not an object")
+        if self.short_keys:
+            payload = _rename(payload, _LONG_KEYS)
+        return payload
+
+class MsgpackCodec(Codec):
+    def _serialize(self, payload: dict) -> bytes:
+        return msgpack.packb(payload)
+
+    def _parse(self, data: Union[str, bytes]):
+        if isinstance(data, str):
+            raise ProtocolError("Expected a binary frame")
+        return msgpack.unpackb(data)
+
+    def _join(self, seq: int, items: List[Union[str, bytes]]) -> bytes:
+        packer = msgpack.Packer()
+        head = packer.pack_map_header(3) + packer.pack(self._key("type")) + packer.pack("batch")
+        head += packer.pack(self._key("seq")) + packer.pack(seq) + packer.pack(self._key("frames"))
+        return head + packer.pack_array_header(len(items)) + b"".join(items)
+
+    def literal(self, text: str) -> bytes:
+        return msgpack.packb(text)
+
+CODECS: Dict[str, Codec] = {}
+for _codec in (
+    Codec("json"),
+    Codec("json-deflate", compress=True),
+    Codec("compact", short_keys=True),
+    Codec("compact-deflate", short_keys=True, compress=True),
+):
+    CODECS[_codec.name] = _codec
+if msgpack is not None:
+    CODECS["msgpack"] = MsgpackCodec("msgpack", short_keys=True)
+    CODECS["msgpack-deflate"] = MsgpackCodec("msgpack-deflate", short_keys=True, compress=True)
+
+DEFAULT_CODEC = CODECS["json"]
+
+def negotiate(scope: dict, requested: Optional[str] = None) -> Tuple[Optional[Codec], Optional[str]]:
+    """Pick the codec for a new connection.
+
+    Returns ``(codec, subprotocol)``; the subprotocol, if any, must be echoed
+    in the handshake response. The codec is None when ``?protocol=`` names
+    a format this server does not support.
+    """
+    for offered in scope.get("subprotocols") or ():
+        if offered.startswith(SUBPROTOCOL_PREFIX):
+            codec = CODECS.get(offered[len(SUBPROTOCOL_PREFIX):])
+            if codec is not None:
+                return codec, offered
+    if requested:
+        return CODECS.get(requested), None
+    return DEFAULT_CODEC, None
+
+class Frame:
+    """An outgoing event, encoded lazily and at most once per format."""
+
+    __slots__ = ("payload", "_encoded")
+
+    def __init__(self, payload: dict):
+        self.payload = payload
+        self._encoded: Dict[str, Union[str, bytes]] = {}
+
+    @classmethod
+    def from_json(cls, text: str) -> "Frame":
+        """A frame received as JSON (e.g. over the backplane); the text is reused for "json" clients."""
+        frame = cls(loads(text))
+        frame._encoded[DEFAULT_CODEC.name] = text
+        return frame
+
+    def encode(self, codec: Codec) -> Union[str, bytes]:
+        data = self._encoded.get(codec.name)
+        if data is None:
+            data = self._encoded[codec.name] = codec.encode(self.payload)
+        return data
+
+    def json(self) -> str:
+        return self.encode(DEFAULT_CODEC)
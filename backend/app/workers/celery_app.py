@@ -0,0 +1,17 @@
+"""Celery app for media derivation jobs (MEDIA_JOB_BACKEND=celery).
+
+Run a worker from the backend directory, on a host that sees UPLOAD_DIR:
+
+    celery -A app.workers.celery_app worker --loglevel=info
+"""
+from celery import Celery
+from app.core.config import settings
+from app.workers import media
+
+celery_app = Celery("convo", broker=settings.CELERY_BROKER_URL)
+celery_app.conf.task_ignore_result = True
+celery_app.conf.task_acks_late = True
+
+# Task names match what CeleryQueue sends: "<module>.<function>"
+for job in (media.make_thumbnails, media.make_waveform):
+    celery_app.task(name=f"{job.__module__}.{job.__name__}")(job)
@@ -0,0 +1,136 @@
+"""Derived media: image thumbnails and voice-note waveforms.
+
+The job functions here run in worker processes (the local process pool or
+Celery), never on the API event loop. Derivatives are written next to the
+original, with names computed from the original's name. That means the
+upload response and message payloads can list their URLs before the job
+has finished. A URL returns 404 until its file exists.
+
+Optional tools: Pillow for thumbnails, ffmpeg for audio other than 16-bit
+WAV. If one is missing, that job logs a warning and produces nothing.
+"""
+import array
+import json
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import wave
+from typing import Dict, List, Optional
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".gif", ".webp", ".bmp"}
+AUDIO_EXTENSIONS = {".wav", ".ogg", ".oga", ".opus", ".mp3", ".m4a", ".aac", ".webm"}
+WAVEFORM_SAMPLE_RATE = 8000
+
+def thumbnail_name(name: str, size: int) -> str:
+    return f"{os.path.splitext(name)[0]}.t{size}.jpg"
+
+def waveform_name(name: str) -> str:
+    return f"{os.path.splitext(name)[0]}.waveform.json"
+
+def derivative_names(name: str) -> Dict[str, str]:
+    """Derivatives an upload will get, keyed by kind ("thumb_320", "waveform", ...)."""
+    extension = os.path.splitext(name)[1].lower()
+    if extension in IMAGE_EXTENSIONS:
+        return {f"thumb_{size}": thumbnail_name(name, size) for size in settings.THUMBNAIL_SIZES}
+    if extension in AUDIO_EXTENSIONS:
+        return {"waveform": waveform_name(name)}
+    return {}
+
+def derivative_urls(media_url: Optional[str]) -> Optional[Dict[str, str]]:
+    if not media_url or not media_url.startswith("/uploads/"):
+        return None
+    name = media_url[len("/uploads/"):]
+    names = derivative_names(name)
+    return {kind: f"/uploads/{derived}" for kind, derived in names.items()} or None
+
+def _replace_atomically(path: str, write):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    write(tmp_path)
+    os.replace(tmp_path, path)
+
+def make_thumbnails(name: str, sizes: List[int]):
+    source = os.path.join(settings.UPLOAD_DIR, name)
+    targets = {size: os.path.join(settings.UPLOAD_DIR, thumbnail_name(name, size)) for size in sizes}
+    targets = {size: path for size, path in targets.items() if not os.path.exists(path)}
+    if not targets:
+        # Same bytes were uploaded before
+        return
+    try:
+        from PIL import Image, ImageOps
+    except ImportError:
+        logger.warning("Pillow is not installed; skipping thumbnails for %s", name)
+        return
+
+    with Image.open(source) as image:
+        image = ImageOps.exif_transpose(image)
+        if image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+        for size, path in sorted(targets.items(), reverse=True):
+            # Largest first, each smaller size is derived from the previous one
+            image.thumbnail((size, size))
+            _replace_atomically(path, lambda tmp: image.save(tmp, "JPEG", quality=80, optimize=True))
+
+def _pcm_from_wav(path: str) -> Optional[tuple]:
+    try:
+        with wave.open(path, "rb") as wav:
+            if wav.getsampwidth() != 2:
+                return None
+            samples = array.array("h", wav.readframes(wav.getnframes()))
+            channels, rate = wav.getnchannels(), wav.getframerate()
+    except (wave.Error, EOFError):
+        return None
+    if sys.byteorder == "big":
+        samples.byteswap()
+    return samples[::channels], rate
+
+def _pcm_from_ffmpeg(path: str) -> Optional[tuple]:
+    ffmpeg = shutil.which("ffmpeg")
+    if ffmpeg is None:
+        return None
+    result = subprocess.run(
+        [ffmpeg, "-v", "error", "-i", path, "-ac", "1", "-ar", str(WAVEFORM_SAMPLE_RATE), "-f", "s16le", "-"],
+        capture_output=True, timeout=120, check=True,
+    )
+    samples = array.array("h", result.stdout)
+    if sys.byteorder == "big":
+        samples.byteswap()
+    return samples, WAVEFORM_SAMPLE_RATE
+
+def make_waveform(name: str, buckets: int):
+    source = os.path.join(settings.UPLOAD_DIR, name)
+    target = os.path.join(settings.UPLOAD_DIR, waveform_name(name))
+    if os.path.exists(target):
+        return
+    decoded = _pcm_from_wav(source) if name.lower().endswith(".wav") else None
+    if decoded is None:
+        decoded = _pcm_from_ffmpeg(source)
+    if decoded is None:
+        logger.warning("Cannot decode %s (ffmpeg not found); skipping waveform", name)
+        return
+
+    samples, rate = decoded
+    step = max(1, -(-len(samples) // buckets))
+    peaks = [
+        max(abs(min(chunk)), max(chunk)) * 255 // 32768 if chunk else 0
+        for chunk in (samples[i:i + step] for i in range(0, step * buckets, step))
+    ]
+    waveform = {"duration": round(len(samples) / rate, 2), "peaks": peaks}
+    _replace_atomically(target, lambda tmp: _write_json(tmp, waveform))
+
+def _write_json(path: str, data: dict):
+    with open(path, "w") as f:
+        json.dump(data, f, separators=(",", ":"))
+
+def jobs_for(name: str) -> List[tuple]:
+    """(function, args) pairs to run for a freshly stored upload."""
+    extension = os.path.splitext(name)[1].lower()
+    if extension in IMAGE_EXTENSIONS:
+        return [(make_thumbnails, (name, list(settings.THUMBNAIL_SIZES)))]
+    if extension in AUDIO_EXTENSIONS:
+        return [(make_waveform, (name, settings.WAVEFORM_BUCKETS))]
+    return []
@@ -0,0 +1,78 @@
+"""Where media derivation jobs run.
+
+MEDIA_JOB_BACKEND picks the backend:
+- "process" (default): a local spawn-context process pool in the API process.
+- "celery": jobs are sent to a Celery worker (see app/workers/celery_app.py).
+  The worker must see the same UPLOAD_DIR.
+- "off": no derivatives are generated.
+
+``enqueue_derivatives`` only hands the work off. It never waits for a job
+and never runs one on the event loop.
+"""
+import asyncio
+import logging
+import multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Optional
+from app.core.config import settings
+from app.core.passwords import lower_priority
+from app.workers import media
+
+logger = logging.getLogger(__name__)
+
+class JobQueue:
+    async def submit(self, func, *args):
+        raise NotImplementedError
+
+    def shutdown(self):
+        pass
+
+class ProcessPoolQueue(JobQueue):
+    def __init__(self, workers: int = settings.MEDIA_JOB_WORKERS):
+        self.workers = workers
+        self.executor: Optional[ProcessPoolExecutor] = None
+
+    async def submit(self, func, *args):
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(
+                self.workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=lower_priority,
+            )
+        future = self.executor.submit(func, *args)
+        future.add_done_callback(lambda done: _log_failure(done, func, args))
+
+    def shutdown(self):
+        if self.executor is not None:
+            # Let queued derivations finish; they are cheap compared to losing them
+            self.executor.shutdown(wait=False)
+            self.executor = None
+
+class CeleryQueue(JobQueue):
+    async def submit(self, func, *args):
+        from app.workers.celery_app import celery_app
+        # Publishing talks to the broker synchronously
+        await asyncio.to_thread(celery_app.send_task, f"{func.__module__}.{func.__name__}", args=list(args))
+
+def _log_failure(future: Future, func, args):
+    if not future.cancelled() and future.exception() is not None:
+        logger.error("Media job %s%r failed", func.__name__, args, exc_info=future.exception())
+
+def create_queue(backend: str) -> Optional[JobQueue]:
+    if backend == "celery":
+        return CeleryQueue()
+    if backend == "process":
+        return ProcessPoolQueue()
+    return None
+
+job_queue = create_queue(settings.MEDIA_JOB_BACKEND)
+
+async def enqueue_derivatives(name: str):
+    if job_queue is None:
+        return
+    for func, args in media.jobs_for(name):
+        try:
+            await job_queue.submit(func, *args)
+        except Exception:
+            # The upload itself succeeded; clients fall back to the original
+            logger.exception("Could not enqueue %s for %s", func.__name__, name)
@@ -0,0 +1,104 @@
+"""REST latency with and without the cached principal lookup.
+
+Run from the backend directory:
+
+    python -m benchmarks.bench_auth
+    python -m benchmarks.bench_auth --requests 5000 --concurrency 20
+
+Drives the app in-process (httpx + ASGI transport, no network) against a
+throwaway SQLite file and reports p50/p95/p99 latency and SQL statements
+per request for GET /users/me and GET /chat/, first with the principal
+cache disabled (one user lookup per request, as before) and then enabled.
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import tempfile
+import time
+
+os.environ["DATABASE_URL"] = f"sqlite+aiosqlite:///{os.path.join(tempfile.mkdtemp(), 'bench.db')}"
+
+import httpx
+from fastapi import FastAPI
+from sqlalchemy import event
+from app.core.config import settings
+from app.core.database import Base, engine
+from app.core.security import principal_cache
+from app.routes import auth, chat, user
+from app.services.search_service import ensure_search_schema
+
+# Just the routers under test; app.main also mounts the uploads directory
+app = FastAPI()
+app.include_router(auth.router, prefix=f"{settings.API_V1_STR}/auth")
+app.include_router(chat.router, prefix=f"{settings.API_V1_STR}/chat")
+app.include_router(user.router, prefix=f"{settings.API_V1_STR}/users")
+
+def percentiles(samples):
+    samples = sorted(samples)
+    pick = lambda q: round(samples[min(len(samples) - 1, int(len(samples) * q))], 3)
+    return {"p50_ms": round(statistics.median(samples), 3), "p95_ms": pick(0.95), "p99_ms": pick(0.99)}
+
+async def run(client, tokens, path: str, requests: int, concurrency: int, statements: list):
+    latencies = []
+    queue = asyncio.Queue()
+    for i in range(requests):
+        queue.put_nowait(tokens[i % len(tokens)])
+
+    async def worker():
+        while not queue.empty():
+            token = queue.get_nowait()
+            start = time.perf_counter()
+            response = await client.get(path, headers={"Authorization": f"Bearer {token}"})
+            latencies.append((time.perf_counter() - start) * 1000)
+            response.raise_for_status()
+
+    statements[0] = 0
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return {**percentiles(latencies), "sql_per_request": round(statements[0] / requests, 2)}
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=10)
+    args = parser.parse_args()
+
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+        await conn.run_sync(ensure_search_schema)
+
+    statements = [0]
+
+    @event.listens_for(engine.sync_engine, "before_cursor_execute")
+    def count(*_):
+        statements[0] += 1
+
+    results = {}
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        tokens = []
+        for i in range(args.users):
+            response = await client.post(f"{settings.API_V1_STR}/auth/login", json={"email": f"user{i}@example.com", "password": "pw"})
+            tokens.append(response.json()["access_token"])
+
+        for mode, ttl in (("uncached", 0.0), ("cached", settings.PRINCIPAL_CACHE_TTL)):
+            principal_cache.ttl = ttl
+            principal_cache.clear()
+            results[mode] = {
+                path: await run(client, tokens, settings.API_V1_STR + path, args.requests, args.concurrency, statements)
+                for path in ("/users/me", "/chat/")
+            }
+    await engine.dispose()
+
+    print(json.dumps({
+        "benchmark": "auth",
+        "database": engine.dialect.name,
+        "requests": args.requests,
+        "concurrency": args.concurrency,
+        **results,
+    }, indent=2))
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,119 @@
+"""Bot throughput with one text frame per message versus batch frames.
+
+Run from the backend directory:
+
+    python -m benchmarks.bench_batch
+    python -m benchmarks.bench_batch --messages 2000 --batch-size 100 --members 50
+
+Seeds one group of --members users in a throwaway SQLite file and starts
+one uvicorn worker. Every member except the bot (user 1) connects and
+listens. The bot then pushes --messages messages, first as one text frame
+each and then in batch frames of --batch-size. Both are run once with
+default framing and once with the listeners on ?acks=1, acknowledging
+every batch they receive (which also sends "delivered" receipts). A run
+ends when every listener has every message. It reports messages per
+second and the WebSocket frames each listener received.
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+import httpx
+import websockets
+from app.core.security import create_user_token
+from benchmarks.bench_load import group_chat, seed
+from benchmarks.bench_login_storm import BACKEND_DIR, free_port, wait_ready
+
+class Listener:
+    def __init__(self, ws, acks: bool, expected: int):
+        self.ws = ws
+        self.acks = acks
+        self.expected = expected
+        self.received = 0
+        self.frames = 0
+        self.done = asyncio.get_running_loop().create_future()
+        self.task = asyncio.create_task(self.run())
+
+    async def run(self):
+        try:
+            async for data in self.ws:
+                frame = json.loads(data)
+                self.frames += 1
+                events = frame["frames"] if frame.get("type") == "batch" else [frame]
+                if self.acks:
+                    await self.ws.send(json.dumps({"type": "ack", "seq": frame["seq"]}))
+                self.received += sum(1 for event in events if event.get("type") == "text")
+                if self.received >= self.expected and not self.done.done():
+                    self.done.set_result(None)
+        except websockets.ConnectionClosed:
+            pass
+
+async def run(port: int, args, batch_size: int, acks: bool) -> dict:
+    chat_id = group_chat(1, args.members, args.members)
+    listener_query = "&acks=1" if acks else ""
+
+    def url(uid: int, query: str = "") -> str:
+        return f"ws://127.0.0.1:{port}/api/v1/chat/ws/{uid}?token={create_user_token(uid, f'load{uid}@example.com')}{query}"
+
+    # The bot is a member too, so it hears its own messages. It keeps the
+    # default framing: its acks would queue behind its own burst.
+    listeners = [Listener(await websockets.connect(url(1), max_queue=None), False, args.messages)]
+    listeners += [Listener(await websockets.connect(url(uid, listener_query), max_queue=None), acks, args.messages) for uid in range(2, args.members + 1)]
+    bot = listeners[0].ws
+    # Skip counting what arrived before the run (presence snapshots)
+    await asyncio.sleep(0.5)
+    for listener in listeners:
+        listener.frames = 0
+
+    start = time.perf_counter()
+    for offset in range(0, args.messages, batch_size):
+        lines = [{"type": "text", "chat_id": chat_id, "content": f"bot line {n}"} for n in range(offset, min(offset + batch_size, args.messages))]
+        await bot.send(json.dumps({"type": "batch", "frames": lines} if batch_size > 1 else lines[0]))
+    await asyncio.wait_for(asyncio.gather(*(listener.done for listener in listeners)), args.timeout)
+    seconds = time.perf_counter() - start
+
+    for listener in listeners:
+        await listener.ws.close()
+        await listener.task
+    return {
+        "mode": f"batch of {batch_size}" if batch_size > 1 else "single",
+        "acks": acks,
+        "seconds": round(seconds, 2),
+        "messages_per_second": round(args.messages / seconds, 1),
+        "frames_per_listener": round(sum(listener.frames for listener in listeners[1:]) / (len(listeners) - 1), 1),
+    }
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--members", type=int, default=20)
+    parser.add_argument("--messages", type=int, default=1000)
+    parser.add_argument("--batch-size", type=int, default=50)
+    parser.add_argument("--timeout", type=float, default=300.0)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    url = f"sqlite+aiosqlite:///{os.path.join(workdir, 'bench.db')}"
+    await seed(url, args.members, args.members, 0)
+    port = free_port()
+    server = await asyncio.create_subprocess_exec(
+        sys.executable, "-m", "uvicorn", "app.main:app", "--port", str(port), "--log-level", "warning",
+        cwd=workdir, env=dict(os.environ, DATABASE_URL=url, RATE_LIMIT_ENABLED="false", PYTHONPATH=BACKEND_DIR),
+        stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL,
+    )
+    results = []
+    try:
+        async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}") as client:
+            await wait_ready(client)
+        for acks in (False, True):
+            for batch_size in (1, args.batch_size):
+                results.append(await run(port, args, batch_size, acks))
+    finally:
+        server.terminate()
+        await server.wait()
+    print(json.dumps({"benchmark": "batch", "members": args.members, "messages": args.messages, "results": results}, indent=2))
+
+if __name__ == "__main__":
+    asyncio.run(main())
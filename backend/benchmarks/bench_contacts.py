@@ -0,0 +1,102 @@
+"""Contact list, mutual friends and suggestions latency as the users table grows.
+
+Run from the backend directory:
+
+    python -m benchmarks.bench_contacts
+    python -m benchmarks.bench_contacts --users 1000 100000 --friends 20
+
+For every --users size, seeds that many users with --friends random
+friends each, in a throwaway SQLite file, and starts one uvicorn worker.
+--requests sampled users then call GET /social/list, then
+GET /social/mutual/{id} for one of their friends, then
+GET /social/suggestions. Each endpoint is measured twice: "cold" is the
+first pass, where the friend sets still have to be loaded, and "warm" is
+a second pass over the same users, served from the friends cache.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import httpx
+from sqlalchemy import insert
+from sqlalchemy.ext.asyncio import create_async_engine
+from app.core.database import Base
+from app.core.security import create_user_token
+from app.models.user import Friendship, User
+from benchmarks.bench_load import percentiles
+from benchmarks.bench_login_storm import BACKEND_DIR, free_port, wait_ready
+
+API = "/api/v1/social"
+
+async def seed(url: str, users: int, friends: int, rng: random.Random):
+    engine = create_async_engine(url)
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+        await conn.execute(insert(User), [
+            {"user_id": uid, "email": f"load{uid}@example.com", "username": f"user{uid}", "password_hash": "x", "phone_number": f"555{uid:07d}"}
+            for uid in range(1, users + 1)
+        ])
+        # Each user befriends friends / 2 others, so on average everyone has --friends
+        pairs = set()
+        for uid in range(1, users + 1):
+            for other in rng.sample(range(1, users + 1), friends // 2):
+                if other != uid:
+                    pairs.add((min(uid, other), max(uid, other)))
+        rows = [{"user_id": low, "friend_id": high, "status": "accepted"} for low, high in pairs]
+        for start in range(0, len(rows), 5000):
+            await conn.execute(insert(Friendship), rows[start:start + 5000])
+    await engine.dispose()
+
+async def timed(client: httpx.AsyncClient, path: str, uid: int, latencies: list):
+    headers = {"Authorization": f"Bearer {create_user_token(uid, f'load{uid}@example.com')}"}
+    start = time.perf_counter()
+    response = await client.get(path, headers=headers)
+    latencies.append((time.perf_counter() - start) * 1000)
+    response.raise_for_status()
+    return response.json()
+
+async def run(users: int, args) -> dict:
+    rng = random.Random(11)
+    workdir = tempfile.mkdtemp()
+    url = f"sqlite+aiosqlite:///{os.path.join(workdir, 'bench.db')}"
+    await seed(url, users, args.friends, rng)
+    port = free_port()
+    server = await asyncio.create_subprocess_exec(
+        sys.executable, "-m", "uvicorn", "app.main:app", "--port", str(port), "--log-level", "warning",
+        cwd=workdir, env=dict(os.environ, DATABASE_URL=url, PYTHONPATH=BACKEND_DIR),
+        stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL,
+    )
+    sample = rng.sample(range(1, users + 1), min(args.requests, users))
+    result = {"users": users}
+    try:
+        async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}") as client:
+            await wait_ready(client)
+            for phase in ("cold", "warm"):
+                latencies = {"list": [], "mutual": [], "suggestions": []}
+                for uid in sample:
+                    contacts = await timed(client, f"{API}/list", uid, latencies["list"])
+                    other = rng.choice(contacts)["user_id"] if contacts else uid
+                    await timed(client, f"{API}/mutual/{other}", uid, latencies["mutual"])
+                    await timed(client, f"{API}/suggestions", uid, latencies["suggestions"])
+                result[phase] = {endpoint: percentiles(values) for endpoint, values in latencies.items()}
+    finally:
+        server.terminate()
+        await server.wait()
+    return result
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--friends", type=int, default=20)
+    parser.add_argument("--requests", type=int, default=300)
+    args = parser.parse_args()
+
+    results = [await run(users, args) for users in args.users]
+    print(json.dumps({"benchmark": "contacts", "friends": args.friends, "results": results}, indent=2))
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,112 @@
+"""User directory latency as the users table grows.
+
+Run from the backend directory:
+
+    python -m benchmarks.bench_directory
+    python -m benchmarks.bench_directory --users 10000 200000
+
+For every --users size, seeds that many users in a throwaway SQLite file
+and starts one uvicorn worker. Then it times --requests calls of each:
+
+- "first_page": GET /users/directory, 50 users.
+- "deep_page": the same from a cursor halfway through the table.
+- "prefix": GET /users/directory?prefix=<3 letters>.
+- "search": GET /social/search.
+
+"legacy_full_dump" is what GET /users/ did before it was paginated:
+load every user as an ORM object and validate each into UserOut. It is
+measured in the benchmark process against the same file, once per size.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from typing import List
+import httpx
+from sqlalchemy import insert
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.future import select
+from sqlalchemy.orm import sessionmaker
+from app.core.database import Base
+from app.core.security import create_user_token
+from app.models.user import User
+from app.schemas.user import UserOut
+from app.services.search_service import ensure_search_schema
+from benchmarks.bench_load import WORDS, percentiles
+from benchmarks.bench_login_storm import BACKEND_DIR, free_port, wait_ready
+
+async def seed(url: str, users: int, rng: random.Random):
+    engine = create_async_engine(url)
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+        await conn.run_sync(ensure_search_schema)
+        rows = [
+            {"user_id": uid, "email": f"load{uid}@example.com", "username": f"{rng.choice(WORDS)}{uid}", "password_hash": "x" * 60,
+             "phone_number": f"555{uid:07d}", "status_message": "available"}
+            for uid in range(1, users + 1)
+        ]
+        for start in range(0, len(rows), 5000):
+            await conn.execute(insert(User), rows[start:start + 5000])
+    await engine.dispose()
+
+async def legacy_full_dump(url: str) -> float:
+    engine = create_async_engine(url)
+    Session = sessionmaker(bind=engine, class_=AsyncSession)
+    start = time.perf_counter()
+    async with Session() as db:
+        result = await db.execute(select(User).where(User.user_id != 1))
+        [UserOut.model_validate(user).model_dump_json() for user in result.scalars().all()]
+    seconds = time.perf_counter() - start
+    await engine.dispose()
+    return seconds
+
+async def timed(client: httpx.AsyncClient, path: str, params: dict, latencies: List[float]) -> dict:
+    headers = {"Authorization": f"Bearer {create_user_token(1, 'load1@example.com')}"}
+    start = time.perf_counter()
+    response = await client.get(path, params=params, headers=headers)
+    latencies.append((time.perf_counter() - start) * 1000)
+    response.raise_for_status()
+    return response.json()
+
+async def run(users: int, args) -> dict:
+    rng = random.Random(5)
+    workdir = tempfile.mkdtemp()
+    url = f"sqlite+aiosqlite:///{os.path.join(workdir, 'bench.db')}"
+    await seed(url, users, rng)
+    result = {"users": users, "legacy_full_dump_ms": round(await legacy_full_dump(url) * 1000, 1)}
+    port = free_port()
+    server = await asyncio.create_subprocess_exec(
+        sys.executable, "-m", "uvicorn", "app.main:app", "--port", str(port), "--log-level", "warning",
+        cwd=workdir, env=dict(os.environ, DATABASE_URL=url, RATE_LIMIT_ENABLED="false", PYTHONPATH=BACKEND_DIR),
+        stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL,
+    )
+    latencies = {"first_page": [], "deep_page": [], "prefix": [], "search": []}
+    try:
+        async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}") as client:
+            await wait_ready(client)
+            for _ in range(args.requests):
+                await timed(client, "/api/v1/users/directory", {}, latencies["first_page"])
+                await timed(client, "/api/v1/users/directory", {"cursor": str(users // 2)}, latencies["deep_page"])
+                await timed(client, "/api/v1/users/directory", {"prefix": rng.choice(WORDS)[:3]}, latencies["prefix"])
+                await timed(client, "/api/v1/social/search", {"query": rng.choice(WORDS)}, latencies["search"])
+    finally:
+        server.terminate()
+        await server.wait()
+    result.update({name: percentiles(values) for name, values in latencies.items()})
+    return result
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, nargs="+", default=[10000, 100000])
+    parser.add_argument("--requests", type=int, default=200)
+    args = parser.parse_args()
+
+    results = [await run(users, args) for users in args.users]
+    print(json.dumps({"benchmark": "directory", "results": results}, indent=2))
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,113 @@
+"""Large-group fan-out cost and what it does to small chats on the same loop.
+
+Run from the backend directory:
+
+    python -m benchmarks.bench_fanout
+    python -m benchmarks.bench_fanout --group-size 1000 5000 --messages 50
+
+Builds one ConnectionManager with a group of --group-size local
+connections plus --small-chats chats of five members each, all on
+counting sockets (see bench_wire). Then --messages events go to the big
+group while a small chat gets a typing event every millisecond. "legacy" is
+the path before per-chat subscriber sets: an awaited send_personal_message
+per member. "registry" is send_to_chat. Each runs without a backplane and
+with the in-process one. Reported per mode:
+
+- ms_per_message: wall time of one big-group fan-out until every socket
+  has written it (writers run during the yields of a chunked fan-out, so
+  the fan-out call alone is not comparable).
+- small_chat_ms: how long a small-chat event waited to be delivered while
+  big fan-outs were running (p50/p99/max).
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+from benchmarks.bench_load import percentiles
+from benchmarks.bench_wire import CountingSocket, drain, message_payload
+from app.websocket.backplane import InProcessBackplane
+from app.websocket.manager import ConnectionManager
+from app.websocket.protocol import Frame
+
+BIG_CHAT = 1
+SMALL_CHAT_SIZE = 5
+
+async def run(mode: str, backplane: bool, group_size: int, small_chats: int, messages: int) -> dict:
+    manager = ConnectionManager()
+    if backplane:
+        await manager.start(InProcessBackplane())
+    big_members = list(range(1, group_size + 1))
+    small = {}
+    for n in range(small_chats):
+        first = group_size + 1 + n * SMALL_CHAT_SIZE
+        small[BIG_CHAT + 1 + n] = list(range(first, first + SMALL_CHAT_SIZE))
+    for user_id in big_members:
+        await manager.connect(CountingSocket(False), user_id, chats=[BIG_CHAT])
+    for chat_id, members in small.items():
+        for user_id in members:
+            await manager.connect(CountingSocket(False), user_id, chats=[chat_id])
+
+    async def fan_out(chat_id: int, frame: Frame, members, kind: str):
+        if mode == "legacy":
+            for user_id in members:
+                await manager.send_personal_message(frame, user_id, kind=kind)
+        else:
+            await manager.send_to_chat(chat_id, frame, members, kind=kind)
+
+    waits = []
+    stop = asyncio.Event()
+
+    async def small_chat_ticker():
+        loop = asyncio.get_running_loop()
+        chat_ids = list(small)
+        n = 0
+        while not stop.is_set():
+            chat_id = chat_ids[n % len(chat_ids)]
+            n += 1
+            scheduled = loop.time() + 0.001
+            await asyncio.sleep(0.001)
+            await fan_out(chat_id, Frame({"type": "typing", "chat_id": chat_id, "user_id": small[chat_id][0], "is_typing": True}), small[chat_id], "typing")
+            waits.append((loop.time() - scheduled) * 1000)
+
+    rng = random.Random(3)
+    ticker = asyncio.create_task(small_chat_ticker())
+    await asyncio.sleep(0.01)
+    seconds = 0.0
+    for message_id in range(1, messages + 1):
+        frame = Frame(message_payload(message_id, 120, rng))
+        start = time.perf_counter()
+        await fan_out(BIG_CHAT, frame, big_members, "text")
+        await drain(manager)
+        seconds += time.perf_counter() - start
+    stop.set()
+    await ticker
+
+    for connections in list(manager.active_connections.values()):
+        for connection in connections:
+            connection.writer.cancel()
+    await manager.stop()
+    return {
+        "mode": mode,
+        "backplane": "memory" if backplane else None,
+        "group_size": group_size,
+        "ms_per_message": round(seconds / messages * 1000, 2),
+        "small_chat_ms": percentiles(waits),
+    }
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--group-size", type=int, nargs="+", default=[1000, 5000])
+    parser.add_argument("--small-chats", type=int, default=20)
+    parser.add_argument("--messages", type=int, default=30)
+    args = parser.parse_args()
+
+    results = []
+    for group_size in args.group_size:
+        for backplane in (False, True):
+            for mode in ("legacy", "registry"):
+                results.append(await run(mode, backplane, group_size, args.small_chats, args.messages))
+    print(json.dumps({"benchmark": "fanout", "results": results}, indent=2))
+
+if __name__ == "__main__":
+    asyncio.run(main())
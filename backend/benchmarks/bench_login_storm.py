@@ -0,0 +1,142 @@
+"""WebSocket message latency while a burst of logins hits the same process.
+
+Run from the backend directory:
+
+    python -m benchmarks.bench_login_storm
+    python -m benchmarks.bench_login_storm --executors inline process --logins 40
+
+For each PASSWORD_HASH_EXECUTOR setting, starts a single uvicorn worker on a
+throwaway SQLite file and connects two users to one chat. One user sends a
+message every --interval-ms and the other records how long delivery took.
+This runs first on an idle server and then while --logins concurrent
+logins are in flight. "inline" is the old behaviour: the hash runs on the
+event loop.
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import httpx
+import websockets
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def start_server(executor: str, port: int, workdir: str) -> subprocess.Popen:
+    env = dict(
+        os.environ,
+        DATABASE_URL=f"sqlite+aiosqlite:///{os.path.join(workdir, f'{executor}.db')}",
+        PASSWORD_HASH_EXECUTOR=executor,
+        # Fresh database file; let the worker create the schema
+        DB_CREATE_SCHEMA="true",
+        # Every login comes from 127.0.0.1
+        RATE_LIMIT_ENABLED="false",
+        PYTHONPATH=BACKEND_DIR,
+    )
+    return subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app.main:app", "--port", str(port), "--log-level", "warning"],
+        cwd=workdir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+
+async def wait_ready(client: httpx.AsyncClient):
+    for _ in range(200):
+        try:
+            await client.get("/")
+            return
+        except httpx.TransportError:
+            await asyncio.sleep(0.05)
+    raise RuntimeError("server did not start")
+
+async def login(client: httpx.AsyncClient, email: str) -> dict:
+    response = await client.post("/api/v1/auth/login", json={"email": email, "password": "pw"}, timeout=120)
+    response.raise_for_status()
+    return response.json()
+
+async def measure(sender, receiver, chat_id: int, count: int, interval: float):
+    sent = {}
+    latencies = []
+
+    async def receive():
+        while len(latencies) < count:
+            frame = json.loads(await receiver.recv())
+            if frame.get("type") == "text" and frame["content"] in sent:
+                latencies.append((time.perf_counter() - sent.pop(frame["content"])) * 1000)
+
+    receiver_task = asyncio.create_task(receive())
+    for i in range(count):
+        content = f"ping {i} {time.perf_counter()}"
+        sent[content] = time.perf_counter()
+        await sender.send(json.dumps({"type": "text", "chat_id": chat_id, "content": content}))
+        await asyncio.sleep(interval)
+    await asyncio.wait_for(receiver_task, 120)
+    latencies.sort()
+    return {
+        "p50_ms": round(statistics.median(latencies), 2),
+        "p95_ms": round(latencies[int(len(latencies) * 0.95) - 1], 2),
+        "max_ms": round(latencies[-1], 2),
+    }
+
+async def run(executor: str, args, workdir: str) -> dict:
+    port = free_port()
+    server = start_server(executor, port, workdir)
+    base = f"http://127.0.0.1:{port}"
+    try:
+        async with httpx.AsyncClient(base_url=base) as client:
+            await wait_ready(client)
+            a = await login(client, "storm-a@example.com")
+            b = await login(client, "storm-b@example.com")
+            chat = await client.post(
+                "/api/v1/chat/create", json={"participant_ids": [b["user_id"]], "is_group": False},
+                headers={"Authorization": f"Bearer {a['access_token']}"},
+            )
+            chat_id = chat.json()["chat_id"]
+            # Existing accounts: the storm measures verification, not first-time hashing
+            emails = [f"storm{i}@example.com" for i in range(args.logins)]
+            await asyncio.gather(*(login(client, email) for email in emails))
+
+            ws = f"ws://127.0.0.1:{port}/api/v1/chat/ws"
+            async with websockets.connect(f"{ws}/{a['user_id']}?token={a['access_token']}") as sender, \
+                       websockets.connect(f"{ws}/{b['user_id']}?token={b['access_token']}") as receiver:
+                interval = args.interval_ms / 1000
+                idle = await measure(sender, receiver, chat_id, args.pings, interval)
+
+                start = time.perf_counter()
+                storm = asyncio.gather(*(login(client, email) for email in emails))
+                during = await measure(sender, receiver, chat_id, args.pings, interval)
+                await storm
+                storm_seconds = time.perf_counter() - start
+    finally:
+        server.terminate()
+        server.wait()
+    return {"idle": idle, "during_storm": during, "storm_logins_per_sec": round(args.logins / storm_seconds, 1)}
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--executors", nargs="+", default=["inline", "process"])
+    parser.add_argument("--logins", type=int, default=20)
+    parser.add_argument("--pings", type=int, default=100)
+    parser.add_argument("--interval-ms", type=float, default=20.0)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    results = {executor: await run(executor, args, workdir) for executor in args.executors}
+    print(json.dumps({
+        "benchmark": "login_storm",
+        "logins": args.logins,
+        "pings": args.pings,
+        "interval_ms": args.interval_ms,
+        **results,
+    }, indent=2))
+
+if __name__ == "__main__":
+    asyncio.run(main())
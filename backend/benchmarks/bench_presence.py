@@ -0,0 +1,134 @@
+"""Presence traffic during a reconnect storm: broadcast-to-everyone vs. PresenceTracker.
+
+Run from the backend directory:
+
+    python -m benchmarks.bench_presence
+    python -m benchmarks.bench_presence --users 5000 --group-size 50
+
+Users are split into group chats of --group-size members. All of them
+connect, then every user drops and reconnects within the grace period (a
+network blip or a deploy), then --leave percent disconnect for good.
+Sockets are in-memory objects counting frames, so the numbers are the
+fan-out work done by the server, not network time.
+- legacy: one online/offline frame to every connected user per connect and
+  disconnect (the previous websocket_endpoint behaviour)
+- presence: PresenceTracker with its debounce and batched diffs; its
+  elapsed time includes waiting out the grace period (--grace)
+"""
+import argparse
+import asyncio
+import json
+import os
+import tempfile
+import time
+
+# Count every frame instead of dropping slow consumers
+os.environ["WS_SEND_QUEUE_SIZE"] = str(10 ** 9)
+
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+from app.core.database import Base
+from app.models.chat import Chat, ChatMember
+from app.models.user import User
+from app.services.presence_service import PresenceTracker, contacts_cache
+from app.websocket.manager import manager
+
+class CountingSocket:
+    frames = 0
+
+    async def accept(self, subprotocol=None):
+        pass
+
+    async def send_text(self, data: str):
+        CountingSocket.frames += 1
+
+    async def close(self, code: int = 1000, reason: str = None):
+        pass
+
+async def setup(url: str, users: int, group_size: int):
+    engine = create_async_engine(url)
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    Session = sessionmaker(bind=engine, class_=AsyncSession, expire_on_commit=False)
+    async with Session() as db:
+        db.add_all(User(user_id=i, email=f"u{i}@example.com", username=f"u{i}", password_hash="x", phone_number=str(i)) for i in range(1, users + 1))
+        await db.flush()
+        for chat_id, start in enumerate(range(1, users + 1, group_size), 1):
+            db.add(Chat(chat_id=chat_id, is_group=True, name=f"group {chat_id}", created_by=start))
+            db.add_all(ChatMember(chat_id=chat_id, user_id=uid) for uid in range(start, min(start + group_size, users + 1)))
+        await db.commit()
+    return engine, Session
+
+async def settle(tracker: PresenceTracker):
+    # Wait out grace periods and pending diffs, then let every writer task empty its queue
+    while tracker.changes or tracker._offline_timers or (tracker._flushing and not tracker._flushing.done()):
+        await asyncio.sleep(0.01)
+    while any(c.queue for conns in manager.active_connections.values() for c in conns):
+        await asyncio.sleep(0.01)
+
+async def run(mode: str, Session, users: int, leave: float, interval: float, grace: float) -> dict:
+    tracker = PresenceTracker(Session, interval=interval, grace=grace)
+    contacts_cache.clear()
+    sockets = {}
+
+    async def connect(uid: int):
+        sockets[uid] = CountingSocket()
+        await manager.connect(sockets[uid], uid)
+        if mode == "legacy":
+            await manager.broadcast(json.dumps({"type": "status", "user_id": uid, "status": "online"}), kind="status", coalesce_key=("status", uid))
+        else:
+            await tracker.connected(uid)
+
+    async def disconnect(uid: int):
+        manager.disconnect(sockets.pop(uid), uid)
+        if mode == "legacy":
+            await manager.broadcast(json.dumps({"type": "status", "user_id": uid, "status": "offline"}), kind="status", coalesce_key=("status", uid))
+        else:
+            await tracker.disconnected(uid)
+
+    ids = range(1, users + 1)
+    for uid in ids:
+        await connect(uid)
+    await settle(tracker)
+
+    CountingSocket.frames = 0
+    start = time.perf_counter()
+    for uid in ids:
+        await disconnect(uid)
+        await connect(uid)
+    # Spread over all groups so every leaver still has contacts online
+    for uid in ids[::max(1, round(1 / leave))] if leave else ():
+        await disconnect(uid)
+    await settle(tracker)
+    elapsed = time.perf_counter() - start
+
+    for uid in list(sockets):
+        await disconnect(uid)
+    await tracker.close()
+    return {"frames_sent": CountingSocket.frames, "elapsed_s": round(elapsed, 2)}
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--group-size", type=int, default=20)
+    parser.add_argument("--leave", type=float, default=0.1, help="fraction that stays offline")
+    parser.add_argument("--interval-ms", type=float, default=200.0)
+    parser.add_argument("--grace", type=float, default=0.5)
+    args = parser.parse_args()
+
+    engine, Session = await setup(f"sqlite+aiosqlite:///{os.path.join(tempfile.mkdtemp(), 'bench.db')}", args.users, args.group_size)
+    results = {}
+    for mode in ("legacy", "presence"):
+        results[mode] = await run(mode, Session, args.users, args.leave, args.interval_ms / 1000, args.grace)
+    await engine.dispose()
+
+    print(json.dumps({
+        "benchmark": "presence",
+        "users": args.users,
+        "group_size": args.group_size,
+        "leave": args.leave,
+        **results,
+    }, indent=2))
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,118 @@
+"""One flooding client against everyone else, with and without rate limits.
+
+Run from the backend directory:
+
+    python -m benchmarks.bench_ratelimit
+    python -m benchmarks.bench_ratelimit --seconds 10 --logins 50
+
+Starts one uvicorn worker on a throwaway SQLite file, with
+RATE_LIMIT_ENABLED on and then off. In each run, user 1 sends text frames
+to a direct chat as fast as it can for --seconds. Meanwhile users 3 and 4
+exchange a message every --interval-ms (under the text limit) on another
+chat, and their delivery latency is recorded (see bench_login_storm.measure).
+Afterwards one client sends --logins logins back to back.
+
+Reported per run:
+
+- victim: delivery latency of the well-behaved pair while the flood runs.
+- flood: frames sent, messages stored, "rate_limited" notices received,
+  and the close code and reason if the server hung up.
+- logins: status codes of the login burst, and the Retry-After of the
+  first 429.
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+from collections import Counter
+import httpx
+import websockets
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import create_async_engine
+from app.core.security import create_user_token
+from app.models.chat import Message
+from benchmarks.bench_load import direct_chat, seed
+from benchmarks.bench_login_storm import BACKEND_DIR, free_port, measure, wait_ready
+
+def ws_url(port: int, uid: int) -> str:
+    return f"ws://127.0.0.1:{port}/api/v1/chat/ws/{uid}?token={create_user_token(uid, f'load{uid}@example.com')}"
+
+async def flood(port: int, seconds: float) -> dict:
+    stats = {"frames_sent": 0, "rate_limited_notices": 0, "close_code": None, "close_reason": None}
+    async with websockets.connect(ws_url(port, 1), max_queue=None) as ws:
+        async def receive():
+            async for data in ws:
+                if json.loads(data).get("type") == "rate_limited":
+                    stats["rate_limited_notices"] += 1
+
+        receiver = asyncio.create_task(receive())
+        deadline = time.perf_counter() + seconds
+        try:
+            while time.perf_counter() < deadline:
+                await ws.send(json.dumps({"type": "text", "chat_id": direct_chat(1), "content": f"flood {stats['frames_sent']}"}))
+                stats["frames_sent"] += 1
+                if stats["frames_sent"] % 50 == 0:
+                    await asyncio.sleep(0)
+        except websockets.ConnectionClosed:
+            pass
+        receiver.cancel()
+        await asyncio.gather(receiver, return_exceptions=True)
+        if ws.close_code is not None:
+            stats["close_code"] = ws.close_code
+            stats["close_reason"] = ws.close_reason
+    return stats
+
+async def login_burst(client: httpx.AsyncClient, logins: int) -> dict:
+    statuses, retry_after = Counter(), None
+    for i in range(logins):
+        response = await client.post("/api/v1/auth/login", json={"email": f"burst{i}@example.com", "password": "pw"}, timeout=120)
+        statuses[response.status_code] += 1
+        if response.status_code == 429 and retry_after is None:
+            retry_after = response.headers.get("retry-after")
+    return {"statuses": dict(statuses), "first_retry_after": retry_after}
+
+async def run(enabled: bool, args) -> dict:
+    workdir = tempfile.mkdtemp()
+    url = f"sqlite+aiosqlite:///{os.path.join(workdir, 'bench.db')}"
+    await seed(url, 4, 4, 0)
+    port = free_port()
+    server = await asyncio.create_subprocess_exec(
+        sys.executable, "-m", "uvicorn", "app.main:app", "--port", str(port), "--log-level", "warning",
+        cwd=workdir, env=dict(os.environ, DATABASE_URL=url, PYTHONPATH=BACKEND_DIR, RATE_LIMIT_ENABLED=str(enabled).lower(),
+                              PASSWORD_HASH_EXECUTOR="inline"),
+        stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL,
+    )
+    try:
+        async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}") as client:
+            await wait_ready(client)
+            async with websockets.connect(ws_url(port, 3)) as sender, websockets.connect(ws_url(port, 4)) as receiver:
+                pings = int(args.seconds * 1000 / args.interval_ms)
+                flooding = asyncio.create_task(flood(port, args.seconds))
+                victim = await measure(sender, receiver, direct_chat(3), pings, args.interval_ms / 1000)
+                flooded = await flooding
+            logins = await login_burst(client, args.logins)
+    finally:
+        server.terminate()
+        await server.wait()
+
+    engine = create_async_engine(url)
+    async with engine.connect() as conn:
+        flooded["messages_stored"] = (await conn.execute(select(func.count()).where(Message.chat_id == direct_chat(1)))).scalar()
+    await engine.dispose()
+    return {"rate_limits": enabled, "victim": victim, "flood": flooded, "logins": logins}
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--seconds", type=float, default=5.0)
+    parser.add_argument("--interval-ms", type=float, default=150.0)
+    parser.add_argument("--logins", type=int, default=30)
+    args = parser.parse_args()
+
+    results = [await run(enabled, args) for enabled in (True, False)]
+    print(json.dumps({"benchmark": "ratelimit", "seconds": args.seconds, "results": results}, indent=2))
+
+if __name__ == "__main__":
+    asyncio.run(main())
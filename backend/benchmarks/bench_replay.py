@@ -0,0 +1,110 @@
+"""Catching up after a reconnect: replaying missed messages versus re-reading history.
+
+Run from the backend directory:
+
+    python -m benchmarks.bench_replay
+    python -m benchmarks.bench_replay --history 1000 20000 --missed 10 500
+
+For every --history size, seeds one group of three users whose chat
+already holds that many messages, in a throwaway SQLite file, and starts
+one uvicorn worker. For every --missed count, user 2 is offline while the
+bot (user 1) sends that many messages. Once they are spilled to the
+pending_deliveries table (OFFLINE_QUEUE_SPILL_AFTER is lowered for the
+run), user 2 connects and the time until the last missed message arrives
+is measured. "history" is the old way to catch up: page through
+GET /chat/{id}/messages, 200 messages at a time, until the whole chat is
+downloaded.
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+import httpx
+import websockets
+from app.core.security import create_user_token
+from benchmarks.bench_load import group_chat, seed
+from benchmarks.bench_login_storm import BACKEND_DIR, free_port, wait_ready
+
+SPILL_AFTER = 0.5  # seconds
+
+def ws_url(port: int, uid: int) -> str:
+    return f"ws://127.0.0.1:{port}/api/v1/chat/ws/{uid}?token={create_user_token(uid, f'load{uid}@example.com')}"
+
+async def receive_texts(ws, count: int):
+    received = 0
+    while received < count:
+        frame = json.loads(await ws.recv())
+        received += frame.get("type") == "text"
+
+async def replay(port: int, chat_id: int, missed: int) -> float:
+    async with websockets.connect(ws_url(port, 1), max_queue=None) as bot:
+        for n in range(missed):
+            await bot.send(json.dumps({"type": "text", "chat_id": chat_id, "content": f"missed {n}"}))
+        await receive_texts(bot, missed)
+    await asyncio.sleep(SPILL_AFTER * 3)
+
+    start = time.perf_counter()
+    async with websockets.connect(ws_url(port, 2), max_queue=None) as ws:
+        await receive_texts(ws, missed)
+        return time.perf_counter() - start
+
+async def history(client: httpx.AsyncClient, chat_id: int) -> tuple:
+    headers = {"Authorization": f"Bearer {create_user_token(2, 'load2@example.com')}"}
+    start = time.perf_counter()
+    downloaded, before = 0, None
+    while True:
+        params = {"limit": 200} if before is None else {"limit": 200, "before": before}
+        page = (await client.get(f"/api/v1/chat/{chat_id}/messages", params=params, headers=headers)).json()
+        if not page:
+            return time.perf_counter() - start, downloaded
+        downloaded += len(page)
+        before = page[0]["message_id"]
+
+async def run(history_size: int, missed_counts, timeout: float) -> list:
+    workdir = tempfile.mkdtemp()
+    url = f"sqlite+aiosqlite:///{os.path.join(workdir, 'bench.db')}"
+    await seed(url, 3, 3, history_size)
+    chat_id = group_chat(1, 3, 3)
+    port = free_port()
+    server = await asyncio.create_subprocess_exec(
+        sys.executable, "-m", "uvicorn", "app.main:app", "--port", str(port), "--log-level", "warning",
+        cwd=workdir, env=dict(os.environ, DATABASE_URL=url, PYTHONPATH=BACKEND_DIR, OFFLINE_QUEUE_SPILL_AFTER=str(SPILL_AFTER),
+                              RATE_LIMIT_ENABLED="false"),
+        stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL,
+    )
+    results = []
+    try:
+        async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}", timeout=timeout) as client:
+            await wait_ready(client)
+            for missed in missed_counts:
+                replay_seconds = await asyncio.wait_for(replay(port, chat_id, missed), timeout)
+                history_seconds, downloaded = await history(client, chat_id)
+                results.append({
+                    "history": history_size,
+                    "missed": missed,
+                    "replay_ms": round(replay_seconds * 1000, 1),
+                    "history_ms": round(history_seconds * 1000, 1),
+                    "history_messages": downloaded,
+                })
+    finally:
+        server.terminate()
+        await server.wait()
+    return results
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--history", type=int, nargs="+", default=[1000, 10000])
+    parser.add_argument("--missed", type=int, nargs="+", default=[10, 200])
+    parser.add_argument("--timeout", type=float, default=120.0)
+    args = parser.parse_args()
+
+    results = []
+    for history_size in args.history:
+        results += await run(history_size, args.missed, args.timeout)
+    print(json.dumps({"benchmark": "replay", "results": results}, indent=2))
+
+if __name__ == "__main__":
+    asyncio.run(main())
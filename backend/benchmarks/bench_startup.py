@@ -0,0 +1,114 @@
+"""Worker cold start: time from spawning uvicorn to its first answered request.
+
+Run from the backend directory:
+
+    python -m benchmarks.bench_startup
+    python -m benchmarks.bench_startup --runs 10 --users 50000
+
+Migrates a throwaway SQLite file with `alembic upgrade head`, adds --users
+users, then starts a single uvicorn worker --runs times per mode:
+
+- "migrated": the default, no DDL at startup.
+- "create_all": DB_CREATE_SCHEMA=true, the old startup hook (create_all
+  and the search DDL on every boot, against an already migrated file).
+
+Reported per mode, in ms:
+
+- first_response: process spawn until GET / answers.
+- first_auth_response: the first authenticated request after that, which
+  is where the token library gets imported now.
+
+Also reported once: how long `import app.main` takes in a fresh interpreter,
+and what jose and passlib alone cost to import (no longer paid at startup).
+"""
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import httpx
+from sqlalchemy import insert
+from sqlalchemy.ext.asyncio import create_async_engine
+from app.core.security import create_user_token
+from app.models.user import User
+from benchmarks.bench_load import percentiles
+from benchmarks.bench_login_storm import BACKEND_DIR, free_port
+
+def import_ms(statement: str, runs: int) -> dict:
+    code = f"import time; start = time.perf_counter(); {statement}; print(time.perf_counter() - start)"
+    samples = []
+    for _ in range(runs):
+        out = subprocess.run([sys.executable, "-c", code], cwd=BACKEND_DIR, check=True, capture_output=True, text=True)
+        samples.append(float(out.stdout) * 1000)
+    return percentiles(samples)
+
+async def prepare(url: str, users: int):
+    subprocess.run([sys.executable, "-m", "alembic", "upgrade", "head"], cwd=BACKEND_DIR, check=True,
+                   env=dict(os.environ, DATABASE_URL=url), capture_output=True)
+    engine = create_async_engine(url)
+    async with engine.begin() as conn:
+        rows = [{"user_id": uid, "email": f"load{uid}@example.com", "username": f"user{uid}", "password_hash": "x"}
+                for uid in range(1, users + 1)]
+        for start in range(0, len(rows), 5000):
+            await conn.execute(insert(User), rows[start:start + 5000])
+    await engine.dispose()
+
+async def boot(url: str, workdir: str, create_schema: bool) -> tuple:
+    port = free_port()
+    token = create_user_token(1, "load1@example.com")
+    start = time.perf_counter()
+    server = await asyncio.create_subprocess_exec(
+        sys.executable, "-m", "uvicorn", "app.main:app", "--port", str(port), "--log-level", "warning",
+        cwd=workdir, env=dict(os.environ, DATABASE_URL=url, PYTHONPATH=BACKEND_DIR, DB_CREATE_SCHEMA=str(create_schema).lower()),
+        stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL,
+    )
+    try:
+        async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}") as client:
+            for _ in range(4000):
+                try:
+                    (await client.get("/")).raise_for_status()
+                    break
+                except httpx.TransportError:
+                    await asyncio.sleep(0.005)
+            else:
+                raise RuntimeError("server did not start")
+            first = time.perf_counter() - start
+            start = time.perf_counter()
+            response = await client.get("/api/v1/users/directory", headers={"Authorization": f"Bearer {token}"})
+            response.raise_for_status()
+            auth = time.perf_counter() - start
+    finally:
+        server.terminate()
+        await server.wait()
+    return first * 1000, auth * 1000
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--users", type=int, default=10000)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    url = f"sqlite+aiosqlite:///{os.path.join(workdir, 'bench.db')}"
+    await prepare(url, args.users)
+    results = []
+    for mode in ("migrated", "create_all"):
+        first, auth = [], []
+        for _ in range(args.runs):
+            first_ms, auth_ms = await boot(url, workdir, mode == "create_all")
+            first.append(first_ms)
+            auth.append(auth_ms)
+        results.append({"mode": mode, "first_response": percentiles(first), "first_auth_response": percentiles(auth)})
+    print(json.dumps({
+        "benchmark": "startup",
+        "runs": args.runs,
+        "import_app_main_ms": import_ms("import app.main", args.runs),
+        "import_jose_passlib_ms": import_ms("import jose.jwt, passlib.context", args.runs),
+        "results": results,
+    }, indent=2))
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,132 @@
+"""Upload throughput and event-loop blocking, old handler vs. streaming store.
+
+Run from the backend directory:
+
+    python -m benchmarks.bench_uploads
+    python -m benchmarks.bench_uploads --uploads 32 --size-mb 8 --concurrency 8
+
+Drives the media routes in-process (httpx + ASGI transport) with UPLOAD_DIR
+in a temp directory. A probe task sleeps 1 ms in a loop and records how
+late it wakes up; that lateness is time the loop spent blocked. Compares:
+- legacy: the previous handler (multipart, shutil.copyfileobj on the loop,
+  a new uuid name per upload)
+- multipart: POST /media/upload
+- stream: POST /media/upload/stream (raw body, no multipart spooling)
+
+Half of the uploads repeat the same bytes, so the disk usage shows dedup.
+"""
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import tempfile
+import time
+import uuid
+
+os.environ["DATABASE_URL"] = f"sqlite+aiosqlite:///{os.path.join(tempfile.mkdtemp(), 'bench.db')}"
+os.environ["UPLOAD_DIR"] = tempfile.mkdtemp()
+# One login; no need for the hashing pool
+os.environ["PASSWORD_HASH_EXECUTOR"] = "inline"
+
+import httpx
+from fastapi import Depends, FastAPI, File, UploadFile
+from app.core.config import settings
+from app.core.database import Base, engine
+from app.core.security import get_current_user
+from app.routes import auth, media
+
+app = FastAPI()
+app.include_router(auth.router, prefix="/auth")
+app.include_router(media.router, prefix="/media")
+
+@app.post("/legacy/upload")
+async def legacy_upload(file: UploadFile = File(...), current_user=Depends(get_current_user)):
+    path = os.path.join(settings.UPLOAD_DIR, "legacy", f"{uuid.uuid4()}{os.path.splitext(file.filename)[1]}")
+    with open(path, "wb") as buffer:
+        shutil.copyfileobj(file.file, buffer)
+    return {"url": path}
+
+def disk_usage(directory: str) -> int:
+    return sum(
+        os.path.getsize(os.path.join(root, name))
+        for root, dirs, files in os.walk(directory) if "/." not in root
+        for name in files
+    )
+
+async def probe(lags: list, stop: asyncio.Event):
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(0.001)
+        lags.append((time.perf_counter() - start - 0.001) * 1000)
+
+async def network_chunks(data: bytes, size: int = 64 * 1024):
+    for i in range(0, len(data), size):
+        yield data[i:i + size]
+
+async def run(client, mode: str, payloads, concurrency: int) -> dict:
+    slots = asyncio.Semaphore(concurrency)
+
+    async def upload(data: bytes):
+        async with slots:
+            if mode == "stream":
+                response = await client.post("/media/upload/stream", params={"filename": "clip.mp4"}, content=network_chunks(data))
+            else:
+                path = "/legacy/upload" if mode == "legacy" else "/media/upload"
+                response = await client.post(path, files={"file": ("clip.mp4", data, "video/mp4")})
+            response.raise_for_status()
+
+    before = disk_usage(settings.UPLOAD_DIR)
+    lags, stop = [], asyncio.Event()
+    probe_task = asyncio.create_task(probe(lags, stop))
+    start = time.perf_counter()
+    await asyncio.gather(*(upload(data) for data in payloads))
+    elapsed = time.perf_counter() - start
+    stop.set()
+    await probe_task
+
+    lags.sort()
+    total = sum(len(data) for data in payloads)
+    return {
+        "mb_per_sec": round(total / elapsed / 1e6, 1),
+        "loop_lag_p99_ms": round(lags[int(len(lags) * 0.99) - 1], 2),
+        "loop_lag_max_ms": round(lags[-1], 2),
+        "loop_blocked_ms": round(sum(lag for lag in lags if lag > 1), 1),
+        "disk_mb_written": round((disk_usage(settings.UPLOAD_DIR) - before) / 1e6, 1),
+        "sent_mb": round(total / 1e6, 1),
+    }
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--uploads", type=int, default=16)
+    parser.add_argument("--size-mb", type=float, default=4.0)
+    parser.add_argument("--concurrency", type=int, default=8)
+    args = parser.parse_args()
+
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    os.makedirs(os.path.join(settings.UPLOAD_DIR, "legacy"))
+
+    size = int(args.size_mb * 1024 * 1024)
+    results = {}
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=300) as client:
+        login = await client.post("/auth/login", json={"email": "bench@example.com", "password": "pw"})
+        client.headers["Authorization"] = f"Bearer {login.json()['access_token']}"
+        for mode in ("legacy", "multipart", "stream"):
+            repeated = os.urandom(size)
+            payloads = [repeated if i % 2 else os.urandom(size) for i in range(args.uploads)]
+            results[mode] = await run(client, mode, payloads, args.concurrency)
+    await engine.dispose()
+    shutil.rmtree(settings.UPLOAD_DIR, ignore_errors=True)
+
+    print(json.dumps({
+        "benchmark": "uploads",
+        "uploads": args.uploads,
+        "size_mb": args.size_mb,
+        "concurrency": args.concurrency,
+        **results,
+    }, indent=2))
+
+if __name__ == "__main__":
+    asyncio.run(main())
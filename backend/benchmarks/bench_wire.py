@@ -0,0 +1,137 @@
+"""Bytes and CPU per delivered message for each WebSocket wire format.
+
+Run from the backend directory:
+
+    python -m benchmarks.bench_wire
+    python -m benchmarks.bench_wire --members 1000 --content-bytes 2000
+
+Fans --messages chat messages out to a group of --members connections
+through the real ConnectionManager. The sockets only count what they are
+given. "legacy" is the path before wire formats existed: json.dumps once
+per fan-out, then the same text to everyone. Each format runs twice; with
+"permessage_deflate" every send is also compressed with a zlib stream of
+its own, as the server does per connection when a client negotiates that
+extension. CPU is process time for the fan-out plus the writers
+draining their queues. Inbound decode cost is measured separately on a
+typical client frame.
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+import zlib
+from app.websocket.manager import ConnectionManager
+from app.websocket.protocol import CODECS, DEFAULT_CODEC, Frame
+
+WORDS = "the a to and of you i it is that in we for on this see be at with are can send photo later tonight meeting call ok thanks".split()
+
+class CountingSocket:
+    def __init__(self, permessage_deflate: bool):
+        self.bytes = 0
+        self.frames = 0
+        # Same settings as the websockets permessage-deflate extension
+        self.compressor = zlib.compressobj(wbits=-15) if permessage_deflate else None
+
+    async def accept(self, subprotocol=None):
+        pass
+
+    async def send_text(self, data: str):
+        self._count(data.encode())
+
+    async def send_bytes(self, data: bytes):
+        self._count(data)
+
+    def _count(self, data: bytes):
+        if self.compressor is not None:
+            data = (self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH))[:-4]
+        self.bytes += len(data)
+        self.frames += 1
+
+def message_payload(message_id: int, content_bytes: int, rng: random.Random) -> dict:
+    content = ""
+    while len(content) < content_bytes:
+        content += rng.choice(WORDS) + " "
+    return {
+        "type": "text",
+        "message_id": message_id,
+        "chat_id": 42,
+        "sender_id": 1001,
+        "content": content[:content_bytes],
+        "media_url": None,
+        "derivatives": None,
+        "status": "sent",
+        "created_at": "2026-10-18T12:34:56.789012",
+    }
+
+async def drain(manager: ConnectionManager):
+    while any(connection.queue for connections in manager.active_connections.values() for connection in connections):
+        await asyncio.sleep(0)
+
+async def run(format_name: str, members: int, payloads, permessage_deflate: bool) -> dict:
+    manager = ConnectionManager()
+    codec = DEFAULT_CODEC if format_name == "legacy" else CODECS[format_name]
+    sockets = []
+    for user_id in range(1, members + 1):
+        socket = CountingSocket(permessage_deflate)
+        sockets.append(socket)
+        await manager.connect(socket, user_id, codec)
+
+    cpu_start = time.process_time()
+    for payload in payloads:
+        # Legacy: one json.dumps per fan-out, sent as text to every member
+        message = json.dumps(payload) if format_name == "legacy" else Frame(payload)
+        for user_id in range(1, members + 1):
+            await manager.send_personal_message(message, user_id)
+        await drain(manager)
+    cpu = time.process_time() - cpu_start
+
+    for connections in list(manager.active_connections.values()):
+        for connection in connections:
+            connection.writer.cancel()
+    delivered = sum(socket.frames for socket in sockets)
+    return {
+        "format": format_name,
+        "permessage_deflate": permessage_deflate,
+        "delivered": delivered,
+        "bytes_per_message": round(sum(socket.bytes for socket in sockets) / delivered, 1),
+        "cpu_us_per_message": round(cpu / delivered * 1e6, 2),
+    }
+
+def decode_cost(format_name: str, rounds: int = 20000) -> float:
+    inbound = {"type": "text", "chat_id": 42, "content": "see you at the meeting tonight, bringing the photos"}
+    if format_name == "legacy":
+        data, decode = json.dumps(inbound), json.loads
+    else:
+        codec = CODECS[format_name]
+        data, decode = codec.encode(inbound), codec.decode
+    start = time.process_time()
+    for _ in range(rounds):
+        decode(data)
+    return round((time.process_time() - start) / rounds * 1e6, 2)
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--members", type=int, default=500)
+    parser.add_argument("--messages", type=int, default=50)
+    parser.add_argument("--content-bytes", type=int, default=120)
+    args = parser.parse_args()
+
+    rng = random.Random(7)
+    payloads = [message_payload(i, args.content_bytes, rng) for i in range(1, args.messages + 1)]
+    results = []
+    for format_name in ("legacy", *CODECS):
+        for permessage_deflate in (False, True):
+            result = await run(format_name, args.members, payloads, permessage_deflate)
+            result["decode_us_per_frame"] = decode_cost(format_name)
+            results.append(result)
+    print(json.dumps({
+        "benchmark": "wire",
+        "members": args.members,
+        "messages": args.messages,
+        "content_bytes": args.content_bytes,
+        "results": results,
+    }, indent=2))
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,125 @@
+"""REST latency and pool occupancy while many idle WebSockets are open.
+
+Run from the backend directory:
+
+    python -m benchmarks.bench_ws_pool
+    python -m benchmarks.bench_ws_pool --sockets 500 --pool-size 5 --max-overflow 5
+
+Seeds --sockets users (paired into direct chats) in a throwaway SQLite file,
+starts one uvicorn worker with a deliberately small pool, opens one socket
+per user and sends a typing frame on each, then leaves them idle and times
+GET /api/v1/chat/. When every socket pins a pooled connection, the sockets
+beyond the pool size wait DB_POOL_TIMEOUT seconds and fail, and REST calls
+queue behind them.
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+import httpx
+import websockets
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+from app.core.database import Base
+from app.core.security import create_user_token
+from app.models.chat import Chat, ChatMember
+from app.models.user import User
+from benchmarks.bench_login_storm import BACKEND_DIR, free_port, wait_ready
+
+async def seed(path: str, users: int):
+    engine = create_async_engine(f"sqlite+aiosqlite:///{path}")
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    Session = sessionmaker(bind=engine, class_=AsyncSession)
+    async with Session() as db:
+        db.add_all(User(user_id=i, email=f"u{i}@example.com", username=f"u{i}", password_hash="x", phone_number=str(i)) for i in range(1, users + 1))
+        for chat_id, uid in enumerate(range(1, users + 1, 2), 1):
+            db.add(Chat(chat_id=chat_id, is_group=False, created_by=uid))
+            db.add_all(ChatMember(chat_id=chat_id, user_id=member) for member in (uid, uid + 1) if member <= users)
+        await db.commit()
+    await engine.dispose()
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sockets", type=int, default=200)
+    parser.add_argument("--pool-size", type=int, default=5)
+    parser.add_argument("--max-overflow", type=int, default=5)
+    parser.add_argument("--pool-timeout", type=float, default=3.0)
+    parser.add_argument("--requests", type=int, default=50)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    db_path = os.path.join(workdir, "bench.db")
+    await seed(db_path, args.sockets)
+    port = free_port()
+    env = dict(
+        os.environ,
+        DATABASE_URL=f"sqlite+aiosqlite:///{db_path}",
+        DB_POOL_SIZE=str(args.pool_size),
+        DB_MAX_OVERFLOW=str(args.max_overflow),
+        DB_POOL_TIMEOUT=str(args.pool_timeout),
+        RATE_LIMIT_ENABLED="false",
+        PYTHONPATH=BACKEND_DIR,
+    )
+    server = await asyncio.create_subprocess_exec(
+        sys.executable, "-m", "uvicorn", "app.main:app", "--port", str(port), "--log-level", "warning",
+        cwd=workdir, env=env, stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL,
+    )
+    sockets = []
+    try:
+        async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}", timeout=60) as client:
+            await wait_ready(client)
+            slots = asyncio.Semaphore(50)
+
+            async def open_socket(uid: int):
+                token = create_user_token(uid, f"u{uid}@example.com")
+                async with slots:
+                    try:
+                        ws = await websockets.connect(f"ws://127.0.0.1:{port}/api/v1/chat/ws/{uid}?token={token}", max_queue=None)
+                        await ws.send(json.dumps({"type": "typing", "chat_id": (uid + 1) // 2}))
+                        sockets.append(ws)
+                    except Exception:
+                        pass
+
+            start = time.perf_counter()
+            await asyncio.gather(*(open_socket(uid) for uid in range(1, args.sockets + 1)))
+            connect_seconds = time.perf_counter() - start
+
+            headers = {"Authorization": f"Bearer {create_user_token(1, 'u1@example.com')}"}
+            latencies, errors = [], 0
+            for _ in range(args.requests):
+                start = time.perf_counter()
+                try:
+                    response = await client.get("/api/v1/chat/", headers=headers)
+                    errors += response.status_code != 200
+                except httpx.TransportError:
+                    # Pool timeout surfacing as a dropped connection
+                    errors += 1
+                latencies.append((time.perf_counter() - start) * 1000)
+            health = await client.get("/health")
+    finally:
+        for ws in sockets:
+            await ws.close()
+        server.terminate()
+        await server.wait()
+
+    latencies.sort()
+    print(json.dumps({
+        "benchmark": "ws_pool",
+        "sockets": args.sockets,
+        "pool_size": args.pool_size,
+        "max_overflow": args.max_overflow,
+        "sockets_open": len(sockets),
+        "connect_seconds": round(connect_seconds, 2),
+        "rest_p50_ms": round(statistics.median(latencies), 2),
+        "rest_max_ms": round(latencies[-1], 2),
+        "rest_errors": errors,
+        "db_pool": health.json()["db_pool"] if health.status_code == 200 else None,
+    }, indent=2))
+
+if __name__ == "__main__":
+    asyncio.run(main())
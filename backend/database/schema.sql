@@ -60,6 +60,28 @@ CREATE TABLE message_status (
     UNIQUE(message_id, user_id)
 );
 
+-- Per-member receipt watermarks (everything up to these ids is delivered / read)
+CREATE TABLE chat_read_states (
+    chat_id INT REFERENCES chats(chat_id) ON DELETE CASCADE,
+    user_id INT REFERENCES users(user_id) ON DELETE CASCADE,
+    last_read_message_id INT NOT NULL DEFAULT 0,
+    last_delivered_message_id INT NOT NULL DEFAULT 0,
+    updated_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (chat_id, user_id)
+);
+
+-- Per chat, the range of messages missed by offline users and not yet
+-- replayed (spilled from memory)
+CREATE TABLE pending_deliveries (
+    user_id INT REFERENCES users(user_id) ON DELETE CASCADE,
+    chat_id INT REFERENCES chats(chat_id) ON DELETE CASCADE,
+    first_message_id INT NOT NULL,
+    last_message_id INT NOT NULL,
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (user_id, chat_id, first_message_id)
+);
+
 -- Media Files Table
 CREATE TABLE media_files (
     media_id SERIAL PRIMARY KEY,
@@ -85,7 +107,19 @@ CREATE TABLE calls (
 
 -- Indexes for Performance
 CREATE INDEX idx_users_phone ON users(phone_number);
+CREATE INDEX ix_users_lower_username ON users(lower(username), user_id);
+CREATE INDEX ix_users_lower_email ON users(lower(email), user_id);
 CREATE INDEX idx_messages_chat_id ON messages(chat_id);
+CREATE INDEX idx_messages_chat_message ON messages(chat_id, message_id);
+CREATE INDEX ix_messages_chat_id_created_at ON messages(chat_id, created_at);
 CREATE INDEX idx_messages_sender ON messages(sender_id);
 CREATE INDEX idx_chat_members_user ON chat_members(user_id);
 CREATE INDEX idx_message_status_msg ON message_status(message_id);
+
+-- Full-text search (see app/services/search_service.py)
+ALTER TABLE messages ADD COLUMN search_vector tsvector
+    GENERATED ALWAYS AS (to_tsvector('simple', coalesce(content, ''))) STORED;
+CREATE INDEX ix_messages_search_vector ON messages USING GIN (search_vector);
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+CREATE INDEX ix_users_username_trgm ON users USING GIN (lower(username) gin_trgm_ops);
+CREATE INDEX ix_users_email_trgm ON users USING GIN (lower(email) gin_trgm_ops);
@@ -0,0 +1,45 @@
+"""search indexes
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2026-10-18 18:02:11.417305
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+from app.services import search_service
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0004'
+down_revision: Union[str, Sequence[str], None] = '0003'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    bind = op.get_bind()
+    search_service.ensure_search_schema(bind)
+    if bind.dialect.name == "sqlite":
+        # External-content FTS tables start empty; index existing rows
+        op.execute("INSERT INTO messages_fts(messages_fts) VALUES ('rebuild')")
+        op.execute("INSERT INTO users_fts(users_fts) VALUES ('rebuild')")
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    bind = op.get_bind()
+    if bind.dialect.name == "sqlite":
+        for trigger in ("messages_fts_insert", "messages_fts_delete", "messages_fts_update",
+                        "users_fts_insert", "users_fts_delete", "users_fts_update"):
+            op.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+        op.execute("DROP TABLE IF EXISTS messages_fts")
+        op.execute("DROP TABLE IF EXISTS users_fts")
+    elif bind.dialect.name == "postgresql":
+        op.execute("DROP INDEX IF EXISTS ix_users_email_trgm")
+        op.execute("DROP INDEX IF EXISTS ix_users_username_trgm")
+        op.execute("DROP INDEX IF EXISTS ix_messages_search_vector")
+        op.execute("ALTER TABLE messages DROP COLUMN IF EXISTS search_vector")
@@ -0,0 +1,31 @@
+"""users lower username and email indexes
+
+Revision ID: 0007
+Revises: 0006
+Create Date: 2026-10-18 18:51:37.260914
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0007'
+down_revision: Union[str, Sequence[str], None] = '0006'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # Expression indexes; autogenerate does not compare these
+    op.create_index('ix_users_lower_username', 'users', [sa.text('lower(username)'), 'user_id'], unique=False)
+    op.create_index('ix_users_lower_email', 'users', [sa.text('lower(email)'), 'user_id'], unique=False)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_users_lower_email', table_name='users')
+    op.drop_index('ix_users_lower_username', table_name='users')
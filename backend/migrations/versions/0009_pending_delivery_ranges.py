@@ -0,0 +1,62 @@
+"""pending delivery ranges
+
+Revision ID: 0009
+Revises: 0008
+Create Date: 2026-10-18 21:04:12.581377
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0009'
+down_revision: Union[str, Sequence[str], None] = '0008'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # One row per run of a chat's messages a user missed, instead of one per
+    # message; each stored message becomes a run of its own
+    op.create_table('pending_deliveries_new',
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('chat_id', sa.Integer(), nullable=False),
+    sa.Column('first_message_id', sa.Integer(), nullable=False),
+    sa.Column('last_message_id', sa.Integer(), nullable=False),
+    sa.Column('created_at', sa.DateTime(timezone=True), server_default=sa.text('(CURRENT_TIMESTAMP)'), nullable=True),
+    sa.Column('updated_at', sa.DateTime(timezone=True), server_default=sa.text('(CURRENT_TIMESTAMP)'), nullable=True),
+    sa.ForeignKeyConstraint(['chat_id'], ['chats.chat_id'], ondelete='CASCADE'),
+    sa.ForeignKeyConstraint(['user_id'], ['users.user_id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('user_id', 'chat_id', 'first_message_id')
+    )
+    op.execute(
+        "INSERT INTO pending_deliveries_new (user_id, chat_id, first_message_id, last_message_id, created_at, updated_at) "
+        "SELECT p.user_id, m.chat_id, p.message_id, p.message_id, p.created_at, p.created_at "
+        "FROM pending_deliveries p JOIN messages m ON m.message_id = p.message_id"
+    )
+    op.drop_table('pending_deliveries')
+    op.rename_table('pending_deliveries_new', 'pending_deliveries')
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.create_table('pending_deliveries_old',
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('message_id', sa.Integer(), nullable=False),
+    sa.Column('created_at', sa.DateTime(timezone=True), server_default=sa.text('(CURRENT_TIMESTAMP)'), nullable=True),
+    sa.ForeignKeyConstraint(['message_id'], ['messages.message_id'], ondelete='CASCADE'),
+    sa.ForeignKeyConstraint(['user_id'], ['users.user_id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('user_id', 'message_id')
+    )
+    op.execute(
+        "INSERT INTO pending_deliveries_old (user_id, message_id, created_at) "
+        "SELECT p.user_id, m.message_id, p.created_at "
+        "FROM pending_deliveries p JOIN messages m ON m.chat_id = p.chat_id "
+        "AND m.message_id BETWEEN p.first_message_id AND p.last_message_id"
+    )
+    op.drop_table('pending_deliveries')
+    op.rename_table('pending_deliveries_old', 'pending_deliveries')
@@ -0,0 +1,103 @@
+"""Two ConnectionManagers ("nodes") sharing a backplane, each holding one
+user's socket. Run from the backend directory: python -m pytest tests
+"""
+import asyncio
+import json
+import fakeredis
+import pytest
+from app.websocket.backplane import InProcessBackplane, InProcessBroker, RedisBackplane
+from app.websocket.manager import ConnectionManager
+from app.websocket.protocol import Frame
+
+class FakeSocket:
+    def __init__(self):
+        self.sent = []
+
+    async def accept(self, subprotocol=None):
+        pass
+
+    async def send_text(self, data):
+        self.sent.append(json.loads(data))
+
+    async def send_bytes(self, data):
+        self.sent.append(data)
+
+    async def close(self, code=1000, reason=None):
+        pass
+
+def in_process_pair():
+    broker = InProcessBroker()
+    return InProcessBackplane(broker), InProcessBackplane(broker)
+
+def redis_pair():
+    server = fakeredis.FakeServer()
+    return (RedisBackplane(client=fakeredis.FakeAsyncRedis(server=server)),
+            RedisBackplane(client=fakeredis.FakeAsyncRedis(server=server)))
+
+async def wait_for(condition, timeout=2.0):
+    async with asyncio.timeout(timeout):
+        while not condition():
+            await asyncio.sleep(0.01)
+
+async def two_nodes(backplanes, scenario):
+    nodes = [ConnectionManager(), ConnectionManager()]
+    sockets = [FakeSocket(), FakeSocket()]
+    for user_id, (node, backplane, socket) in enumerate(zip(nodes, backplanes, sockets), 1):
+        await node.start(backplane)
+        await node.connect(socket, user_id)
+    # Let the Redis listeners pick up their subscriptions
+    await asyncio.sleep(0.1)
+    try:
+        await scenario(nodes, sockets)
+    finally:
+        for user_id, (node, socket) in enumerate(zip(nodes, sockets), 1):
+            node.disconnect(socket, user_id)
+            await node.stop()
+
+@pytest.mark.parametrize("make_backplanes", [in_process_pair, redis_pair], ids=["memory", "redis"])
+def test_chat_fanout_reaches_other_node_once(make_backplanes):
+    async def scenario(nodes, sockets):
+        unreached = await nodes[0].send_all_to_chat(7, [Frame({"type": "text", "chat_id": 7, "content": "hi"})], [1, 2, 3])
+        assert unreached == [3]
+        await wait_for(lambda: sockets[1].sent)
+        # Give a Redis echo of node 0's own publish time to (not) arrive
+        await asyncio.sleep(0.1)
+        assert [frame["content"] for frame in sockets[0].sent] == ["hi"]
+        assert [frame["content"] for frame in sockets[1].sent] == ["hi"]
+
+    asyncio.run(two_nodes(make_backplanes(), scenario))
+
+@pytest.mark.parametrize("make_backplanes", [in_process_pair, redis_pair], ids=["memory", "redis"])
+def test_personal_messages_cross_nodes_in_order(make_backplanes):
+    async def scenario(nodes, sockets):
+        messages = [Frame({"type": "text", "content": str(i)}) for i in range(5)]
+        assert await nodes[1].send_personal_messages(messages, 1)
+        assert not await nodes[1].send_personal_message(Frame({"type": "text", "content": "x"}), 3)
+        await wait_for(lambda: len(sockets[0].sent) == 5)
+        assert [frame["content"] for frame in sockets[0].sent] == ["0", "1", "2", "3", "4"]
+        assert sockets[1].sent == []
+
+    asyncio.run(two_nodes(make_backplanes(), scenario))
+
+def test_redis_listener_resubscribes_after_a_failed_read():
+    backplanes = redis_pair()
+    backplanes[1].retry_delay = 0.01
+
+    async def scenario(nodes, sockets):
+        broken = backplanes[1].pubsub
+        read = broken.get_message
+        failures = []
+
+        async def get_message(**kwargs):
+            if not failures:
+                failures.append(1)
+                raise ConnectionError("connection reset")
+            return await read(**kwargs)
+
+        broken.get_message = get_message
+        await wait_for(lambda: backplanes[1].pubsub is not broken and backplanes[1].pubsub.subscribed)
+        assert await nodes[0].send_personal_message(Frame({"type": "text", "content": "back"}), 2)
+        await wait_for(lambda: sockets[1].sent)
+        assert [frame["content"] for frame in sockets[1].sent] == ["back"]
+
+    asyncio.run(two_nodes(backplanes, scenario))
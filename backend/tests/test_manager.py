@@ -0,0 +1,39 @@
+"""ConnectionManager delivery on a single node (no backplane).
+Run from the backend directory: python -m pytest tests
+"""
+import asyncio
+from app.websocket.manager import ConnectionManager
+from app.websocket.protocol import Frame
+from test_backplane import FakeSocket
+
+def frames(count):
+    return [Frame({"type": "text", "chat_id": 7, "content": str(n)}) for n in range(count)]
+
+def test_full_queue_leaves_member_unreached():
+    async def scenario():
+        manager = ConnectionManager()
+        subscribed = await manager.connect(FakeSocket(), 1, chats=[7])
+        slow = await manager.connect(FakeSocket(), 2, chats=[7])
+        # Not registered for the chat, found through the per-user fallback
+        unregistered = await manager.connect(FakeSocket(), 3)
+        slow.max_queue = unregistered.max_queue = 1
+        unreached = await manager.send_all_to_chat(7, frames(2), [1, 2, 3])
+        assert sorted(unreached) == [2, 3]
+        assert slow.closed and unregistered.closed and not subscribed.closed
+        assert manager.fanout_stats.chats[7][1] == 1
+        assert 2 not in manager.active_connections and 3 not in manager.active_connections
+        manager.disconnect(subscribed.websocket, 1)
+        await asyncio.sleep(0)
+
+    asyncio.run(scenario())
+
+def test_personal_messages_count_only_sockets_that_took_all():
+    async def scenario():
+        manager = ConnectionManager()
+        slow = await manager.connect(FakeSocket(), 1)
+        slow.max_queue = 1
+        assert not await manager.send_personal_messages(frames(2), 1)
+        assert slow.closed
+        await asyncio.sleep(0)
+
+    asyncio.run(scenario())
@@ -0,0 +1,46 @@
+"""Wire format codecs.
+Run from the backend directory: python -m pytest tests
+"""
+import zlib
+import pytest
+from app.core.config import settings
+from app.websocket.protocol import CODECS, FrameTooLarge, Frame, ProtocolError, negotiate
+
+EVENT = {"type": "text", "chat_id": 7, "message_id": 42, "sender_id": 1, "content": "hi", "media_url": None,
+         "derivatives": {"thumb": "/t.jpg"}, "status": "sent", "created_at": "2026-01-01T00:00:00"}
+
+@pytest.mark.parametrize("name", sorted(CODECS))
+@pytest.mark.parametrize("content", ["hi", "x" * (settings.WS_COMPRESS_MIN_BYTES * 2)], ids=["small", "large"])
+def test_codec_round_trip(name, content):
+    codec = CODECS[name]
+    event = {**EVENT, "content": content}
+    data = codec.encode(event)
+    if codec.compress and len(content) > settings.WS_COMPRESS_MIN_BYTES:
+        assert data[:1] == b"\x78"
+    assert codec.decode(data) == event
+
+@pytest.mark.parametrize("name", sorted(CODECS))
+def test_batch_decodes_with_long_keys(name):
+    codec = CODECS[name]
+    items = [Frame(EVENT).encode(codec.plain), Frame({"type": "typing", "chat_id": 7, "is_typing": True}).encode(codec.plain)]
+    assert codec.decode(codec.batch(3, items)) == {
+        "type": "batch", "seq": 3, "frames": [EVENT, {"type": "typing", "chat_id": 7, "is_typing": True}],
+    }
+
+def test_compressed_frame_inflating_past_the_limit_is_refused():
+    codec = CODECS["json-deflate"]
+    bomb = zlib.compress(b'{"type":"text","content":"' + b"a" * settings.WS_MAX_MESSAGE_BYTES + b'"}')
+    assert len(bomb) < settings.WS_MAX_MESSAGE_BYTES // 100
+    with pytest.raises(FrameTooLarge):
+        codec.decode(bomb)
+
+def test_malformed_frames_raise_protocol_error():
+    with pytest.raises(ProtocolError):
+        CODECS["json"].decode("[1, 2]")
+    with pytest.raises(ProtocolError):
+        CODECS["json-deflate"].decode(b"\x78not zlib")
+
+def test_negotiate_prefers_a_known_subprotocol():
+    assert negotiate({"subprotocols": ["convo.nope", "convo.compact"]}) == (CODECS["compact"], "convo.compact")
+    assert negotiate({}, "json-deflate") == (CODECS["json-deflate"], None)
+    assert negotiate({}, "nope") == (None, None)
@@ -0,0 +1,89 @@
+"""Token buckets and the rate limiter backends.
+Run from the backend directory: python -m pytest tests
+"""
+import asyncio
+from types import SimpleNamespace
+import fakeredis
+import pytest
+from app.core import ratelimit
+from app.core.ratelimit import Limit, MemoryRateLimiter, RedisRateLimiter, TokenBucket
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(ratelimit, "time", SimpleNamespace(monotonic=clock))
+    return clock
+
+def test_bucket_allows_a_burst_then_returns_the_wait(clock):
+    limit = Limit(rate=2.0, burst=3.0)
+    bucket = TokenBucket(limit)
+    assert [bucket.take(limit) for _ in range(3)] == [0.0, 0.0, 0.0]
+    # Empty: one token comes back every half second
+    assert bucket.take(limit) == pytest.approx(0.5)
+    assert bucket.take(limit, cost=2) == pytest.approx(1.0)
+
+def test_bucket_refills_up_to_the_burst(clock):
+    limit = Limit(rate=2.0, burst=3.0)
+    bucket = TokenBucket(limit)
+    bucket.take(limit, cost=3)
+    clock.now += 1.0
+    assert bucket.take(limit, cost=2) == 0.0
+    assert bucket.take(limit) == pytest.approx(0.5)
+    # Idle for long, but never more than a full bucket
+    clock.now += 60.0
+    assert bucket.take(limit, cost=3) == 0.0
+    assert bucket.take(limit) > 0.0
+
+def test_bucket_charges_a_full_bucket_for_a_cost_above_the_burst(clock):
+    limit = Limit(rate=1.0, burst=2.0)
+    bucket = TokenBucket(limit)
+    assert bucket.take(limit, cost=10) == 0.0
+    assert bucket.take(limit) == pytest.approx(1.0)
+
+def test_memory_limiter_evicts_the_least_recently_used_bucket(clock):
+    limit = Limit(rate=1.0, burst=1.0)
+    limiter = MemoryRateLimiter(maxsize=2)
+    limiter.take("a", limit)
+    limiter.take("b", limit)
+    # "a" is used again, so "b" is the one to go
+    assert limiter.take("a", limit) > 0.0
+    limiter.take("c", limit)
+    assert len(limiter) == 2
+    assert limiter.take("a", limit) > 0.0
+    assert limiter.take("c", limit) > 0.0
+    # Evicted: a new, full bucket
+    assert limiter.take("b", limit) == 0.0
+
+def test_redis_limiter_fails_open_when_redis_is_down(caplog):
+    server = fakeredis.FakeServer()
+    server.connected = False
+    limiter = RedisRateLimiter(client=fakeredis.FakeAsyncRedis(server=server))
+    limit = Limit(rate=1.0, burst=1.0)
+
+    async def scenario():
+        assert [await limiter.acquire("user:1", limit) for _ in range(3)] == [0.0, 0.0, 0.0]
+
+    asyncio.run(scenario())
+    assert "Rate limit check failed" in caplog.text
+
+def test_redis_limiter_shares_buckets_between_clients():
+    # fakeredis runs Lua scripts only with lupa installed
+    pytest.importorskip("lupa")
+    server = fakeredis.FakeServer()
+    limiters = [RedisRateLimiter(client=fakeredis.FakeAsyncRedis(server=server)) for _ in range(2)]
+    limit = Limit(rate=1.0, burst=2.0)
+
+    async def scenario():
+        assert await limiters[0].acquire("user:1", limit) == 0.0
+        assert await limiters[1].acquire("user:1", limit) == 0.0
+        assert 0.0 < await limiters[0].acquire("user:1", limit) <= 1.0
+        assert await limiters[1].acquire("user:2", limit) == 0.0
+
+    asyncio.run(scenario())
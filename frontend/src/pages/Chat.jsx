@@ -107,7 +107,8 @@ const Chat = () => {
     // WebSocket Connection
     useEffect(() => {
         if (user?.user_id) {
-            const wsUrl = `ws://localhost:8000/api/v1/chat/ws/${user.user_id}`;
+            const token = localStorage.getItem('token');
+            const wsUrl = `ws://localhost:8000/api/v1/chat/ws/${user.user_id}?token=${encodeURIComponent(token)}`;
             socketRef.current = new WebSocket(wsUrl);
 
             socketRef.current.onmessage = (event) => {
@@ -132,11 +133,15 @@ const Chat = () => {
                         setIsPartnerTyping(data.is_typing);
                     }
 
-                    if (data.type === 'status') {
+                    if (data.type === 'status' || data.type === 'presence') {
+                        // "presence" batches the changes of several contacts
+                        const changes = data.type === 'presence' ? data.changes : [data];
                         setOnlineUsers((prev) => {
                             const next = new Set(prev);
-                            if (data.status === 'online') next.add(data.user_id);
-                            else next.delete(data.user_id);
+                            for (const change of changes) {
+                                if (change.status === 'online') next.add(change.user_id);
+                                else next.delete(change.user_id);
+                            }
                             return next;
                         });
                     }
@@ -1067,7 +1072,16 @@ const Chat = () => {
                                         {msg.media_url ? (
                                             msg.media_url.match(/\.(jpg|jpeg|png|gif)$/i) ? (
                                                 <div className="relative overflow-hidden rounded-lg mb-1 shadow-inner">
-                                                    <img src={`http://localhost:8000${msg.media_url}`} alt="sent" className="w-full object-cover max-h-80" />
+                                                    <img
+                                                        src={`http://localhost:8000${msg.derivatives?.thumb_640 || msg.media_url}`}
+                                                        onError={(e) => {
+                                                            // Thumbnail not generated (yet): show the original
+                                                            const original = `http://localhost:8000${msg.media_url}`;
+                                                            if (e.currentTarget.src !== original) e.currentTarget.src = original;
+                                                        }}
+                                                        alt="sent"
+                                                        className="w-full object-cover max-h-80"
+                                                    />
                                                 </div>
                                             ) : (
                                                 <div className="flex items-center space-x-3 p-3 bg-black/5 dark:bg-white/10 rounded-lg mb-2 border border-black/5 dark:border-white/10">